@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 import pickle
 import numpy as np
@@ -15,8 +16,10 @@ import tools.compute_softscore
 import itertools
 import re
 
-import pandas as pd
-import base64
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from pvqa_features import OtherImageSampler, QuestionEntries, open_features, open_questions, share_features
+from pvqa_features.collate import ImageSample
+from pvqa_features.targets import SparseTarget
 
 COUNTING_ONLY = False
 
@@ -473,38 +476,8 @@ def _load_dataset_pvqa(dataroot, name, imd_id2val, label2ans, ans2label):
     return entries
 
 
-FIELDNAMES = ['image_id', 'image_w', 'image_h', 'num_boxes', 'boxes', 'features']
-
-
-def load_tsv(tsv_file: str):
-    split = tsv_file.split('/')[-1].split('.')[0]
-    df = pd.read_csv(tsv_file, delimiter='\t', names=FIELDNAMES)
-
-    data = []
-    for i in range(df.shape[0]):
-        datum = {}
-        datum['img_id'] = '%s_%04d' % (split, df['image_id'][i])
-        datum['img_w'] = df['image_w'][i]
-        datum['img_h'] = df['image_h'][i]
-        datum['num_boxes'] = df['num_boxes'][i]
-
-        boxes = df['boxes'][i]
-        buf = base64.b64decode(boxes[1:])
-        temp = np.frombuffer(buf, dtype=np.float64).astype(np.float32)
-        datum['boxes'] = temp.reshape(datum['num_boxes'], -1)
-
-        features = df['features'][i]
-        buf = base64.b64decode(features[1:])
-        temp = np.frombuffer(buf, dtype=np.float32)
-        datum['features'] = temp.reshape(datum['num_boxes'], -1)
-
-        data.append(datum)
-
-    return data
-
-
 class PVQAFeatureDataset(Dataset):
-    def __init__(self, name, dictionary, dataroot='data/pvqa', adaptive=False, img_v=''):
+    def __init__(self, name, dictionary, dataroot='data/pvqa', adaptive=False, img_v='', feat_backend='auto'):
         super(PVQAFeatureDataset, self).__init__()
         assert name in ['train', 'val', 'test']
 
@@ -517,87 +490,46 @@ class PVQAFeatureDataset(Dataset):
         self.dictionary = dictionary
         self.adaptive = False
 
-        self.img_id2idx = pickle.load(
-            open(os.path.join(dataroot, '%s_img_id2idx.pkl' % name), 'rb'))
+        img_id2idx_path = os.path.join(dataroot, '%s_img_id2idx.pkl' % name)
+        self.img_id2idx = pickle.load(open(img_id2idx_path, 'rb'))
 
         tsv_file = os.path.join(dataroot, 'images/%s%s.csv' % (name, img_v))
-        self.image_data = load_tsv(tsv_file)
-        self.features = np.array([datum['features'] for datum in self.image_data])
-        self.spatials = np.array([datum['boxes'] for datum in self.image_data])
-
-        self.entries = _load_dataset_pvqa(dataroot, name, self.img_id2idx, self.label2ans, self.ans2label)
-        self.tokenize()
-        self.tensorize()
-        self.v_dim = self.features.size(1 if self.adaptive else 2)
-        self.s_dim = self.spatials.size(1 if self.adaptive else 2)
-
-    def tokenize(self, max_length=14):
-        """Tokenizes the questions.
-
-        This will add q_token in each entry of the dataset.
-        -1 represent nil, and should be treated as padding_idx in embedding
-        """
-
-        for entry in self.entries:
-
-            for k, v in {'question': 'q_token', 'ans_sent': 'ans_token'}.items():
-                tokens = self.dictionary.tokenize(entry[k], False)
-                tokens = tokens[:max_length]
-                if len(tokens) < max_length:
-                    # Note here we pad in front of the sentence
-                    padding = [self.dictionary.padding_idx] * (max_length - len(tokens))
-                    tokens = tokens + padding
-                utils.assert_eq(len(tokens), max_length)
-                entry[v] = tokens
-
-    def tensorize(self):
-        self.features = torch.from_numpy(self.features)
-        self.spatials = torch.from_numpy(self.spatials)
-
-        for entry in self.entries:
-            question = torch.from_numpy(np.array(entry['q_token'],dtype=np.int64))
-            entry['q_token'] = question
-
-            answer_token = torch.from_numpy(np.array(entry['ans_token']))
-            entry['ans_token'] = answer_token
-
-            answer = entry['answer']
-            if None != answer:
-                labels = np.array(answer['labels'], dtype=np.int64)
-                scores = np.array(answer['scores'], dtype=np.float32)
-                if len(labels):
-                    labels = torch.from_numpy(labels)
-                    scores = torch.from_numpy(scores)
-                    entry['answer']['labels'] = labels
-                    entry['answer']['scores'] = scores
-                else:
-                    entry['answer']['labels'] = None
-                    entry['answer']['scores'] = None
+        # one shared copy for all DataLoader workers, entries only keep the image index
+        self.image_features = share_features(open_features(tsv_file, feat_backend))
+
+        # questions and answers tokenized once into memory-mapped arrays
+        self.questions = open_questions(
+            os.path.join(dataroot, 'qas', '%s_questions' % name),
+            lambda: _load_dataset_pvqa(dataroot, name, self.img_id2idx, self.label2ans, self.ans2label),
+            lambda sentence: self.dictionary.tokenize(sentence, False), self.dictionary.padding_idx,
+            max_length=14, vocab=self.dictionary.idx2word,
+            source_files=[os.path.join(dataroot, 'qas/%s_vqa.pkl' % name), ans2label_path, img_id2idx_path])
+        self.entries = QuestionEntries(self.questions, torch.from_numpy)
+        self.v_dim = self.image_features.feat_dim
+        self.s_dim = 4
 
     def __getitem__(self, index):
-        entry = self.entries[index]
-        if not self.adaptive:
-            features = self.features[entry['image']]
-            spatials = self.spatials[entry['image']]
-        else:
-            features = self.features[self.pos_boxes[entry['image']][0]:self.pos_boxes[entry['image']][1], :]
-            spatials = self.spatials[self.pos_boxes[entry['image']][0]:self.pos_boxes[entry['image']][1], :]
+        image = self.questions.image[index]
+        features = torch.from_numpy(self.image_features.get_features(image))
+        spatials = torch.from_numpy(self.image_features.get_boxes(image))
 
-        question = entry['q_token']
-        question_id = entry['question_id']
-        answer = entry['answer']
-        if None != answer:
-            labels = answer['labels']
-            scores = answer['scores']
-            target = torch.zeros(self.num_ans_candidates)
-            if labels is not None:
-                target.scatter_(0, labels, scores)
-            return features, spatials, question, target
-        else:
-            return features, spatials, question, question_id
+        question = torch.from_numpy(self.questions.q_tokens[index])
+        # expanded into the dense batch target by sparse_collate and .cuda()
+        labels, scores = self.questions.answer(index)
+        target = SparseTarget.from_arrays(labels, scores, self.num_ans_candidates)
+        # the image is told to PaddedCollate(image_fields=...) by its index
+        return ImageSample((features, spatials, question, target), image, self.image_features)
 
     def __len__(self):
-        return len(self.entries)
+        return len(self.questions)
+
+    def box_counts(self):
+        """Number of boxes of the image of every question, for BucketBatchSampler."""
+        return self.image_features.num_boxes[self.questions.image]
+
+    def sample_images(self):
+        """Image of every question, for ImageGroupBatchSampler."""
+        return self.questions.image
 
 
 class PretrainInputExample(object):
@@ -615,6 +547,11 @@ class PretrainInputExample(object):
         self.label = label
 
 
+# the matched / valid flags of the pretraining examples, shared instead of built per sample
+MATCHED_FLAGS = {True: torch.tensor([0.0, 1.0]), False: torch.tensor([1.0, 0.0])}
+VALID_FLAGS = {0: torch.tensor(0), 1: torch.tensor(1)}
+
+
 class PretrainDataset(Dataset):
     def __init__(self, dataset, task, pretrain_tasks=[]):
         super(PretrainDataset, self).__init__()
@@ -622,60 +559,48 @@ class PretrainDataset(Dataset):
         self.task = task
         self.dataset = dataset
         self.pretrain_tasks = pretrain_tasks
-        pass
+        # negatives for vq and va: a question about another image, drawn in O(1)
+        self.other_image = OtherImageSampler(dataset.questions.image)
 
     def __getitem__(self, index):
         datum = self.dataset[index]
         feats, spatials, question, l = datum
-        entry = self.dataset.entries[index]
-        label = l if entry['answer'] is not None else question
-        ans_valid = entry['ans_valid']
+        # only the fields needed here, straight from the question store
+        questions = self.dataset.questions
+        label = l.dense()
+        ans_valid = int(questions.ans_valid[index])
 
         """
-        entry = {'question_id': qa['question_id'],
-             'image_id': qa['img_id'],
-             'image': imd_id2val[qa['img_id']],
-             'question': qa['sent'],
-             'answer': answer}
-        
         datum: features, spatials, question, target 
         """
-        # print('entry:')
-        # print(entry)
-        uid = entry['question_id']
-        # question in token form
-        feats = feats.clone()
-        spatials = spatials.clone()
+        uid = int(questions.question_id[index])
+        # feats, spatials and the token rows are only read, the collate copies them
         # obj_labels = None
         # obj_confs = None
         # attr_labels = None
         # attr_confs = None
 
-        vq_matched = [0.0, 1.0]
-        match_question = question.clone()
+        vq_matched = True
+        match_question = question
         if 'vq' in self.pretrain_tasks:
             if np.random.random() < 0.5:
-                vq_matched = [1.0, 0.0]
-                other_idx = np.random.randint(0, len(self.dataset))
-                while self.dataset.entries[other_idx]['image_id'] == entry['image_id']:
-                    other_idx = np.random.randint(0, len(self.dataset))
-                match_question = self.dataset[other_idx][2].clone()
+                vq_matched = False
+                other_idx = self.other_image(index)
+                match_question = torch.from_numpy(questions.q_tokens[other_idx])
 
         if 'qa' in self.pretrain_tasks:
             """qa does not need additional data"""
             pass
 
-        va_matched = [0.0, 1.0]
-        answer_rps = entry['ans_token']
+        va_matched = True
+        answer_rps = torch.from_numpy(questions.ans_tokens[index])
         ans_rps_valid = ans_valid
         if 'va' in self.pretrain_tasks:
             if np.random.random() < 0.5:
-                va_matched = [1.0, 0.0]
-                other_idx = np.random.randint(0, len(self.dataset))
-                while self.dataset.entries[other_idx]['image_id'] == entry['image_id']:
-                    other_idx = np.random.randint(0, len(self.dataset))
-                answer_rps = self.dataset.entries[other_idx]['ans_token']
-                ans_rps_valid = self.dataset.entries[other_idx]['ans_valid']
+                va_matched = False
+                other_idx = self.other_image(index)
+                answer_rps = torch.from_numpy(questions.ans_tokens[other_idx])
+                ans_rps_valid = int(questions.ans_valid[other_idx])
 
         if 'va2' in self.pretrain_tasks:
             """va2 does not need additional data"""
@@ -689,8 +614,8 @@ class PretrainDataset(Dataset):
         # print('example')
 
         example = (uid, question, (feats, spatials),
-                   torch.tensor(vq_matched), match_question, torch.tensor(va_matched), answer_rps, label,
-                   torch.tensor(ans_valid), torch.tensor(ans_rps_valid))
+                   MATCHED_FLAGS[vq_matched], match_question, MATCHED_FLAGS[va_matched], answer_rps, label,
+                   VALID_FLAGS[ans_valid], VALID_FLAGS[ans_rps_valid])
         # print(example)
         return example
 
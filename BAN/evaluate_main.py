@@ -23,6 +23,8 @@ from modeling import BanModel, instance_bce_with_logits, compute_score_with_logi
 from tqdm import tqdm
 import utils
 from dataset import tfidf_from_questions
+from pvqa_features.collate import PaddedCollate
+from pvqa_features.sampler import ImageGroupBatchSampler, sample_images
 from nltk.translate.bleu_score import sentence_bleu
 
 
@@ -35,12 +37,16 @@ def parse_args():
     parser.add_argument('--gamma', type=int, default=8, help='glimpse')
     parser.add_argument('--data_split', type=str, default='test')
     parser.add_argument('--img_v', type=str, default='', help='pvqa img feature version')
+    parser.add_argument('--feat_backend', type=str, default='auto',
+                        help='pvqa feature backend: auto, tsv, ram, memmap or hdf5')
     parser.add_argument('--use_vg', action='store_true', help='use visual genome dataset to train?')
     parser.add_argument('--tfidf', action='store_false', help='tfidf word embedding?')
     parser.add_argument('--input', type=str, default=None)
     parser.add_argument('--output', type=str, default='saved_models/ban')
     parser.add_argument('--batch_size', type=int, default=256)  # batch_size per gpu
     parser.add_argument('--seed', type=int, default=1204, help='random seed')
+    parser.add_argument('--group_images', action='store_true',
+                        help='batch the questions of an image together and encode the image once')
 
     parser.add_argument('--qa_bl', action='store_true', help='qa without image for baseline')
 
@@ -88,14 +94,20 @@ def main_worker(gpu, args):
     if args.task == 'pvqa':
         dict_path = 'data/pvqa/pvqa_dictionary.pkl'
         dictionary = Dictionary.load_from_file(dict_path)
-        test_dset = PVQAFeatureDataset(args.data_split, dictionary, adaptive=False)
+        test_dset = PVQAFeatureDataset(args.data_split, dictionary, adaptive=False, feat_backend=args.feat_backend)
         w_emb_path = 'data/pvqa/glove_pvqa_300d.npy'
     else:
         raise Exception('%s not implemented yet' % args.task)
 
     if args.task == 'pvqa':
-        test_loader = DataLoader(test_dset, args.batch_size, shuffle=False,
-                                 num_workers=args.workers, pin_memory=True)
+        if args.group_images:
+            test_loader = DataLoader(test_dset, batch_sampler=ImageGroupBatchSampler(sample_images(test_dset),
+                                                                                     args.batch_size),
+                                     num_workers=args.workers, pin_memory=True,
+                                     collate_fn=PaddedCollate(image_fields=(0, 1)))
+        else:
+            test_loader = DataLoader(test_dset, args.batch_size, shuffle=False,
+                                     num_workers=args.workers, pin_memory=True, collate_fn=PaddedCollate())
 
     # prepare model
 
@@ -187,13 +199,15 @@ def evaluate(eval_loader: DataLoader, model, args):
     scores = []
     preds = []
     anss = []
-    for (v, b, q, a) in tqdm(eval_loader):
+    for batch in tqdm(eval_loader):
+        v, b, q, a = batch
         v = v.cuda(args.gpu)
         b = b.cuda(args.gpu)
         q = q.cuda(args.gpu)
         a = a.cuda(args.gpu)
+        v_index = None if batch.v_index is None else batch.v_index.cuda(args.gpu)
 
-        pred, att = model(v, b, q, a)
+        pred, att = model(v, b, q, a, v_index=v_index)
         #print('pred.shape=', pred.shape)
         preds.append(np.argmax(pred.detach().cpu().numpy(), axis=1))
         #print('preds[-1].shape=', preds[-1].shape)
@@ -208,6 +222,9 @@ def evaluate(eval_loader: DataLoader, model, args):
     scores = np.concatenate(scores).ravel()
     preds = np.concatenate(preds).reshape(-1)
     anss = np.concatenate(anss, axis=0)
+    # back to the order of the dataset, the batches may be grouped by image
+    order = np.argsort(np.concatenate([batch for batch in eval_loader.batch_sampler]), kind='stable')
+    scores, preds, anss = scores[order], preds[order], anss[order]
     #print('anss.shape=',anss.shape)
     anss = np.concatenate((anss, 0.2 * np.ones((anss.shape[0], 1))), axis=1)
     #print('anss.shape=', anss.shape)
@@ -6,7 +6,7 @@ import pickle
 import datetime
 import torch
 
-from torch.utils.data import DataLoader, ConcatDataset
+from torch.utils.data import DataLoader, ConcatDataset, RandomSampler
 import torch.distributed as dist
 import torch.multiprocessing as mp
 from torch.nn.parallel import DistributedDataParallel as DDP
@@ -22,6 +22,9 @@ from modeling import BanModel, instance_bce_with_logits, compute_score_with_logi
 from tqdm import tqdm
 import utils
 from dataset import tfidf_from_questions
+from pvqa_features.amp import autocast, grad_scaler, load_scaler_state, scaler_state
+from pvqa_features.collate import PaddedCollate
+from pvqa_features.sampler import BucketBatchSampler, ImageGroupBatchSampler, box_counts, sample_images
 
 
 def parse_args():
@@ -39,14 +42,22 @@ def parse_args():
     parser.add_argument('--train', type=str, default='train')
     parser.add_argument('--val', type=str, default='val')
     parser.add_argument('--img_v', type=str, default='', help='pvqa img feature version')
+    parser.add_argument('--feat_backend', type=str, default='auto',
+                        help='pvqa feature backend: auto, tsv, ram, memmap or hdf5')
     parser.add_argument('--use_vg', action='store_true', help='use visual genome dataset to train?')
     parser.add_argument('--tfidf', action='store_false', help='tfidf word embedding?')
     parser.add_argument('--input', type=str, default=None)
     parser.add_argument('--output', type=str, default='saved_models/ban')
     parser.add_argument('--batch_size', type=int, default=256)  # batch_size per gpu
     parser.add_argument('--seed', type=int, default=1204, help='random seed')
+    parser.add_argument('--bucket_boxes', action='store_true',
+                        help='batch questions whose images have similar box counts (adaptive features)')
+    parser.add_argument('--group_images', action='store_true',
+                        help='evaluate the questions of an image together and encode the image once')
 
     parser.add_argument('--qa_bl', action='store_true', help='qa without image for baseline')
+    parser.add_argument('--amp', action='store_true',
+                        help='mixed precision: autocast to float16 with a GradScaler on GPU, bfloat16 on CPU')
 
     parser.add_argument('--gpu', type=int, default=0, help='which gpu to use in single-gpu mode')
     parser.add_argument('--workers', type=int, default=0)
@@ -87,13 +98,14 @@ def main_worker(gpu, args):
         if args.gpu is not None:
             torch.cuda.set_device(args.gpu)
             args.workers = int((args.workers + args.world_size - 1) / args.world_size)
+    args.device = torch.device('cuda', args.gpu) if torch.cuda.is_available() else torch.device('cpu')
 
     # prepare data
     if args.task == 'pvqa':
         dict_path = 'data/pvqa/pvqa_dictionary.pkl'
         dictionary = Dictionary.load_from_file(dict_path)
-        train_dset = PVQAFeatureDataset(args.train, dictionary, adaptive=False)
-        val_dset = PVQAFeatureDataset(args.val, dictionary, adaptive=False)
+        train_dset = PVQAFeatureDataset(args.train, dictionary, adaptive=False, feat_backend=args.feat_backend)
+        val_dset = PVQAFeatureDataset(args.val, dictionary, adaptive=False, feat_backend=args.feat_backend)
         w_emb_path = 'data/pvqa/glove_pvqa_300d.npy'
     else:
         raise Exception('%s not implemented yet' % args.task)
@@ -104,10 +116,24 @@ def main_worker(gpu, args):
         train_sampler = None
 
     if args.task == 'pvqa':
-        train_loader = DataLoader(train_dset, args.batch_size, shuffle=(train_sampler is None),
-                                  num_workers=args.workers, pin_memory=True, sampler=train_sampler)
-        eval_loader = DataLoader(val_dset, args.batch_size, shuffle=False,
-                                 num_workers=args.workers, pin_memory=True)
+        if args.bucket_boxes:
+            # questions of images with similar box counts share a batch
+            train_batch_sampler = BucketBatchSampler(train_sampler or RandomSampler(train_dset),
+                                                     box_counts(train_dset), args.batch_size, seed=args.seed)
+            train_loader = DataLoader(train_dset, batch_sampler=train_batch_sampler,
+                                      num_workers=args.workers, pin_memory=True, collate_fn=PaddedCollate())
+        else:
+            train_loader = DataLoader(train_dset, args.batch_size, shuffle=(train_sampler is None),
+                                      num_workers=args.workers, pin_memory=True, sampler=train_sampler,
+                                      collate_fn=PaddedCollate())
+        if args.group_images:
+            eval_loader = DataLoader(val_dset, batch_sampler=ImageGroupBatchSampler(sample_images(val_dset),
+                                                                                    args.batch_size),
+                                     num_workers=args.workers, pin_memory=True,
+                                     collate_fn=PaddedCollate(image_fields=(0, 1)))
+        else:
+            eval_loader = DataLoader(val_dset, args.batch_size, shuffle=False,
+                                     num_workers=args.workers, pin_memory=True, collate_fn=PaddedCollate())
 
     # prepare model
 
@@ -130,10 +156,12 @@ def main_worker(gpu, args):
         else:
             model.cuda()
             model = DDP(model)
-    else:
+    elif args.device.type == 'cuda':
         torch.cuda.set_device(args.gpu)
         model.cuda(args.gpu)
 
+    scaler = grad_scaler(args.device, args.amp)
+
     # load snapshot
     if args.input is not None:
         print('#8')
@@ -141,8 +169,7 @@ def main_worker(gpu, args):
         if args.gpu is None:
             model_data = torch.load(args.input)
         else:
-            loc = 'cuda:{}'.format(args.gpu)
-            model_data = torch.load(args.input, map_location=loc)
+            model_data = torch.load(args.input, map_location=args.device)
         model_data_sd = model_data.get('model_state', model_data)
 
         for name, param in model.named_parameters():
@@ -152,23 +179,26 @@ def main_worker(gpu, args):
         # optimizer = torch.optim.Adamax(filter(lambda p: p.requires_grad, model.parameters()))
         # optimizer.load_state_dict(model_data.get('optimizer_state', model_data))
         args.start_epoch = model_data['epoch'] + 1
+        load_scaler_state(scaler, model_data.get('scaler_state'))
 
     optimizer = torch.optim.Adamax(filter(lambda p: p.requires_grad, model.parameters()))
 
     best_eval_score = 0
     for epoch in range(args.start_epoch, args.epochs):
-        if args.multiGPUs:
+        if args.bucket_boxes:
+            train_loader.batch_sampler.set_epoch(epoch)
+        elif args.multiGPUs:
             train_sampler.set_epoch(epoch)
         adjust_learning_rate(optimizer, epoch, args)
 
         # train for one epoch
-        train_score = train(train_loader, model, optimizer, epoch, args)
+        train_score = train(train_loader, model, optimizer, epoch, args, scaler)
 
         eval_score = evaluate(eval_loader, model, args)
 
         with open(os.path.join(args.output, 'log.log'), 'a') as f:
             f.write(str(datetime.datetime.now()))
-            f.write(' epoch=%d ' % epoch+1)
+            f.write(' epoch=%d ' % (epoch + 1))
             f.write('train_score=%.4f ' % train_score)
             f.write('eval_score=%.4f \n' % eval_score)
 
@@ -178,34 +208,41 @@ def main_worker(gpu, args):
         if not args.multiGPUs or (args.multiGPUs and args.gpu == 0):
             if eval_score > best_eval_score:
                 model_path = os.path.join(args.output, 'model_best.pth')
-                utils.save_model(model_path, model, epoch, optimizer)
+                utils.save_model(model_path, model, epoch, optimizer, scaler_state(scaler))
                 best_eval_score = eval_score
 
 
-def train(train_loader: DataLoader, model, optimizer, epoch, args):
+def train(train_loader: DataLoader, model, optimizer, epoch, args, scaler=None):
+    """:param scaler: GradScaler of --amp (pvqa_features.amp.grad_scaler), a disabled one runs in fp32."""
     model.train()
+    scaler = scaler or grad_scaler(args.device, False)
     total_loss = 0.0
     train_score = 0
     total_norm = 0
     count_norm = 0
     grad_clip = .25
     for (v, b, q, a) in tqdm(train_loader):
-        v = v.cuda(args.gpu)
-        b = b.cuda(args.gpu)
-        q = q.cuda(args.gpu)
-        a = a.cuda(args.gpu)
-
-        pred, att = model(v, b, q, a)
-        loss = instance_bce_with_logits(pred, a)
+        v = v.to(args.device, non_blocking=True)
+        b = b.to(args.device, non_blocking=True)
+        q = q.to(args.device, non_blocking=True)
+        a = a.to(args.device, non_blocking=True)
+
+        with autocast(args.device, args.amp):
+            pred, att = model(v, b, q, a)
+            loss = instance_bce_with_logits(pred, a)
         optimizer.zero_grad()
-        loss.backward()
+        scaler.scale(loss).backward()
 
+        # clip the true gradients, not the scaled ones
+        scaler.unscale_(optimizer)
         total_norm += torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
         count_norm += 1
 
         total_loss += loss.item()
 
-        optimizer.step()
+        # skipped when the fp16 gradients overflowed, the scale is lowered
+        scaler.step(optimizer)
+        scaler.update()
 
         batch_score = compute_score_with_logits(pred, a.data).sum()
         train_score += batch_score.item()
@@ -221,13 +258,16 @@ def evaluate(eval_loader: DataLoader, model, args):
     val_score = 0
 
     scores = []
-    for (v, b, q, a) in tqdm(eval_loader):
-        v = v.cuda(args.gpu)
-        b = b.cuda(args.gpu)
-        q = q.cuda(args.gpu)
-        a = a.cuda(args.gpu)
-
-        pred, att = model(v, b, q, a)
+    for batch in tqdm(eval_loader):
+        v, b, q, a = batch
+        v = v.to(args.device, non_blocking=True)
+        b = b.to(args.device, non_blocking=True)
+        q = q.to(args.device, non_blocking=True)
+        a = a.to(args.device, non_blocking=True)
+        v_index = None if batch.v_index is None else batch.v_index.to(args.device, non_blocking=True)
+
+        with autocast(args.device, args.amp):
+            pred, att = model(v, b, q, a, v_index=v_index)
 
         base_scores = compute_score_with_logits(pred, a.data)
         batch_score = base_scores.sum()
@@ -65,16 +65,22 @@ class BCNet(nn.Module):
         else:
             self.h_net = weight_norm(nn.Linear(h_dim * self.k, h_out), dim=None)
 
-    def forward(self, v, q):
+    def project_v(self, v, v_index=None):
+        """v_net(v), computed once per image of v when v_index gives the row of
+        v of every question."""
+        v_ = self.v_net(v)
+        return v_ if v_index is None else v_[v_index]
+
+    def forward(self, v, q, v_index=None):
         if None == self.h_out:
-            v_ = self.v_net(v)
+            v_ = self.project_v(v, v_index)
             q_ = self.q_net(q)
             logits = torch.einsum('bvk,bqk->bvqk', (v_, q_))
             return logits
 
         # low-rank bilinear pooling using einsum
         elif self.h_out <= self.c:
-            v_ = self.dropout(self.v_net(v))
+            v_ = self.dropout(self.project_v(v, v_index))
             q_ = self.q_net(q)
             logits = torch.einsum('xhyk,bvk,bqk->bhvq', (self.h_mat, v_, q_)) + self.h_bias
             return logits  # b x h_out x v x q
@@ -82,14 +88,14 @@ class BCNet(nn.Module):
         # batch outer product, linear projection
         # memory efficient but slow computation
         else:
-            v_ = self.dropout(self.v_net(v)).transpose(1, 2).unsqueeze(3)
+            v_ = self.dropout(self.project_v(v, v_index)).transpose(1, 2).unsqueeze(3)
             q_ = self.q_net(q).transpose(1, 2).unsqueeze(2)
             d_ = torch.matmul(v_, q_)  # b x h_dim x v x q
             logits = self.h_net(d_.transpose(1, 2).transpose(2, 3))  # b x v x q x h_out
             return logits.transpose(2, 3).transpose(1, 2)  # b x h_out x v x q
 
-    def forward_with_weights(self, v, q, w):
-        v_ = self.v_net(v)  # b x v x d
+    def forward_with_weights(self, v, q, w, v_index=None):
+        v_ = self.project_v(v, v_index)  # b x v x d
         q_ = self.q_net(q)  # b x q x d
         logits = torch.einsum('bvk,bvq,bqk->bk', (v_, w, q_))
         if 1 < self.k:
@@ -104,7 +110,7 @@ class SimpleClassifier(nn.Module):
         layers = [
             weight_norm(nn.Linear(in_dim, hid_dim), dim=None),
             nn.ReLU(),
-            nn.Dropout(dropout, inplace=True),
+            nn.Dropout(dropout),  # not in place: the ReLU backward needs its output
             weight_norm(nn.Linear(hid_dim, out_dim), dim=None)
         ]
         self.main = nn.Sequential(*layers)
@@ -130,13 +136,17 @@ class BiAttention(nn.Module):
         p, logits = self.forward_all(v, q, v_mask)
         return p, logits
 
-    def forward_all(self, v, q, v_mask=True, logit=False, mask_with=-float('inf')):
+    def forward_all(self, v, q, v_mask=True, logit=False, mask_with=-float('inf'), v_index=None):
         v_num = v.size(1)
         q_num = q.size(1)
-        logits = self.logits(v, q)  # b x g x v x q
+        # the -inf masking and the softmax stay in fp32 under autocast
+        logits = self.logits(v, q, v_index).float()  # b x g x v x q
 
         if v_mask:
-            mask = (0 == v.abs().sum(2)).unsqueeze(1).unsqueeze(3).expand(logits.size())
+            mask = 0 == v.abs().sum(2)
+            if v_index is not None:
+                mask = mask[v_index]
+            mask = mask.unsqueeze(1).unsqueeze(3).expand(logits.size())
             logits.data.masked_fill_(mask.data, mask_with)
 
         if not logit:
@@ -165,6 +175,11 @@ class Counter(nn.Module):
         `attention` has to be a tensor of shape (n, m). Each value should be in [0, 1] if already_sigmoided is set to True, but there are no restrictions if already_sigmoided is set to False. This value should be close to 1 if the corresponding boundign box is relevant and close to 0 if it is not.
         n is the batch size, m is the number of bounding boxes per image.
         """
+        # the piecewise linear functions, products and sqrt are not fp16 safe, count in fp32
+        with torch.autocast(boxes.device.type, enabled=False):
+            return self.count(boxes.float(), attention.float())
+
+    def count(self, boxes, attention):
         # only care about the highest scoring object proposals
         # the ones with low score will have a low impact on the count anyway
         boxes, attention = self.filter_most_important(self.objects, boxes, attention)
@@ -587,7 +602,7 @@ class BertLayer(nn.Module):
 def instance_bce_with_logits(logits, labels, reduction='mean'):
     assert logits.dim() == 2
 
-    loss = nn.functional.binary_cross_entropy_with_logits(logits, labels, reduction=reduction)
+    loss = nn.functional.binary_cross_entropy_with_logits(logits.float(), labels, reduction=reduction)
     if reduction == 'mean':
         loss *= labels.size(1)
     return loss
@@ -595,7 +610,7 @@ def instance_bce_with_logits(logits, labels, reduction='mean'):
 
 def compute_score_with_logits(logits, labels):
     logits = torch.max(logits, 1)[1].data  # argmax
-    one_hots = torch.zeros(*labels.size()).cuda()
+    one_hots = torch.zeros(*labels.size(), device=labels.device)
     one_hots.scatter_(1, logits.view(-1, 1), 1)
     scores = (one_hots * labels)
     # print('scores:', scores.shape)
@@ -675,12 +690,14 @@ class BanModel(nn.Module):
         self.drop = nn.Dropout(.5)
         self.tanh = nn.Tanh()
 
-    def forward(self, v, b, q, labels):
+    def forward(self, v, b, q, labels, v_index=None):
         """Forward
 
         v: [batch, num_objs, obj_dim]
         b: [batch, num_objs, b_dim]
         q: [batch_size, seq_length]
+        v_index: [batch_size] row of v and b of every question, when v and b
+            only hold the distinct images of the batch (PaddedBatch.v_index)
 
         return: logits, not probs
         """
@@ -692,14 +709,14 @@ class BanModel(nn.Module):
             return logits_qa, None
         else:
             boxes = b[:, :, :4].transpose(1, 2)
-
-
+            if v_index is not None:
+                boxes = boxes[v_index]
 
             b_emb = [0] * self.glimpse
-            att, logits = self.v_att.forward_all(v, q_emb)  # b x g x v x q
+            att, logits = self.v_att.forward_all(v, q_emb, v_index=v_index)  # b x g x v x q
 
             for g in range(self.glimpse):
-                b_emb[g] = self.b_net[g].forward_with_weights(v, q_emb, att[:, g, :, :])  # b x l x h
+                b_emb[g] = self.b_net[g].forward_with_weights(v, q_emb, att[:, g, :, :], v_index)  # b x l x h
 
                 atten, _ = logits[:, g, :, :].max(2)
                 embed = self.counter(boxes, atten)
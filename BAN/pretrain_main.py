@@ -20,6 +20,7 @@ from modeling import BanPreModel
 from tqdm import tqdm
 
 import utils
+from pvqa_features.amp import autocast, grad_scaler, load_scaler_state, scaler_state
 
 
 def parse_args():
@@ -38,6 +39,8 @@ def parse_args():
     parser.add_argument('--train', type=str, default='train')
     parser.add_argument('--val', type=str, default='')
     parser.add_argument('--img_v', type=str, default='', help='pvqa img feature version')
+    parser.add_argument('--feat_backend', type=str, default='auto',
+                        help='pvqa feature backend: auto, tsv, ram, memmap or hdf5')
     parser.add_argument('--use_vg', action='store_true', help='use visual genome dataset to train?')
     parser.add_argument('--tfidf', action='store_false', help='tfidf word embedding?')
     parser.add_argument('--input', type=str, default=None)
@@ -48,6 +51,8 @@ def parse_args():
     parser.add_argument('--gpu', type=int, default=0, help='which gpu to use in single-gpu mode')
     parser.add_argument('--pretrain_tasks', type=str, default='', help='pretrain tasks, separated by ,')
     parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--amp', action='store_true',
+                        help='mixed precision: autocast to float16 with a GradScaler on GPU, bfloat16 on CPU')
 
     args = parser.parse_args()
     return args
@@ -85,16 +90,17 @@ def main_worker(gpu, args):
         if args.gpu is not None:
             torch.cuda.set_device(args.gpu)
             args.workers = int((args.workers + args.world_size - 1) / args.world_size)
+    args.device = torch.device('cuda', args.gpu) if torch.cuda.is_available() else torch.device('cpu')
 
     # prepare data
     print('prepare dataset')
     if args.task == 'pvqa':
         dict_path = 'data/pvqa/pvqa_dictionary.pkl'
         dictionary = Dictionary.load_from_file(dict_path)
-        train_dset = PVQAFeatureDataset(args.train, dictionary, adaptive=False)
+        train_dset = PVQAFeatureDataset(args.train, dictionary, adaptive=False, feat_backend=args.feat_backend)
         train_pre_dset = PretrainDataset(train_dset, args.task)
         if args.val:
-            val_dset = PVQAFeatureDataset(args.val, dictionary, adaptive=False)
+            val_dset = PVQAFeatureDataset(args.val, dictionary, adaptive=False, feat_backend=args.feat_backend)
             val_pre_dset = PretrainDataset(val_dset, args.task)
         w_emb_path = 'data/pvqa/glove_pvqa_300d.npy'
     else:
@@ -133,22 +139,24 @@ def main_worker(gpu, args):
         else:
             model.cuda()
             model = DDP(model)
-    else:
+    elif args.device.type == 'cuda':
         torch.cuda.set_device(args.gpu)
         model.cuda(args.gpu)
 
+    scaler = grad_scaler(args.device, args.amp)
+
     # load snapshot
     if args.input is not None:
         print('loading %s' % args.input)
         if args.gpu is None:
             model_data = torch.load(args.input)
         else:
-            loc = 'cuda:{}'.format(args.gpu)
-            model_data = torch.load(args.input, map_location=loc)
+            model_data = torch.load(args.input, map_location=args.device)
         model.load_state_dict(model_data.get('model_state', model_data))
         optimizer = torch.optim.Adamax(filter(lambda p: p.requires_grad, model.parameters()))
         optimizer.load_state_dict(model_data.get('optimizer_state', model_data))
         args.start_epoch = model_data['epoch'] + 1
+        load_scaler_state(scaler, model_data.get('scaler_state'))
 
     else:
         optimizer = torch.optim.Adamax(filter(lambda p: p.requires_grad, model.parameters()))
@@ -160,31 +168,33 @@ def main_worker(gpu, args):
         adjust_learning_rate(optimizer, epoch, args)
 
         # train for one epoch
-        train(train_loader, model, optimizer, epoch, args)
+        train(train_loader, model, optimizer, epoch, args, scaler)
 
         if not args.multiGPUs or (args.multiGPUs and args.gpu == 0):
             model_path = os.path.join(args.output, 'model_epoch%d.pth' % epoch)
-            utils.save_model(model_path, model, epoch, optimizer)
+            utils.save_model(model_path, model, epoch, optimizer, scaler_state(scaler))
 
 
-def train(train_loader, model, optimizer, epoch, args):
+def train(train_loader, model, optimizer, epoch, args, scaler=None):
+    """:param scaler: GradScaler of --amp (pvqa_features.amp.grad_scaler), a disabled one runs in fp32."""
     model.train()
+    scaler = scaler or grad_scaler(args.device, False)
     total_loss = 0.0
     for examples in tqdm(train_loader):
         (uid, question, (feats, spatials),
          vq_matched, match_question, va_matched, answer_rps, label,
          ans_valid, ans_rps_valid) = examples
-        uid = uid.cuda(args.gpu)
-        question = question.cuda(args.gpu)
-        feats = feats.cuda(args.gpu)
-        spatials = spatials.cuda(args.gpu)
-        vq_matched = vq_matched.cuda(args.gpu)
-        match_question = match_question.cuda(args.gpu)
-        va_matched = va_matched.cuda(args.gpu)
-        answer_rps = answer_rps.cuda(args.gpu)
-        label = label.cuda(args.gpu)
-        ans_valid = ans_valid.cuda(args.gpu)
-        ans_rps_valid = ans_rps_valid.cuda(args.gpu)
+        uid = uid.to(args.device, non_blocking=True)
+        question = question.to(args.device, non_blocking=True)
+        feats = feats.to(args.device, non_blocking=True)
+        spatials = spatials.to(args.device, non_blocking=True)
+        vq_matched = vq_matched.to(args.device, non_blocking=True)
+        match_question = match_question.to(args.device, non_blocking=True)
+        va_matched = va_matched.to(args.device, non_blocking=True)
+        answer_rps = answer_rps.to(args.device, non_blocking=True)
+        label = label.to(args.device, non_blocking=True)
+        ans_valid = ans_valid.to(args.device, non_blocking=True)
+        ans_rps_valid = ans_rps_valid.to(args.device, non_blocking=True)
 
         # print('question.shape', question.shape)
         # print('feats.shape', feats.shape)
@@ -195,14 +205,16 @@ def train(train_loader, model, optimizer, epoch, args):
         # print('answer_rps.shape', answer_rps.shape)
         # print('label.shape', label.shape)
 
-        loss = model(question, feats, spatials,
-                     vq_matched, match_question, va_matched, answer_rps, label,
-                     ans_valid, ans_rps_valid)
-        total_loss += loss
+        with autocast(args.device, args.amp):
+            loss = model(question, feats, spatials,
+                         vq_matched, match_question, va_matched, answer_rps, label,
+                         ans_valid, ans_rps_valid)
+        total_loss += loss.item()
 
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
     print('total_loss=', total_loss)
 
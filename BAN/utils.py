@@ -90,13 +90,16 @@ def print_model(model, logger):
         logger.write('nParams=\t' + str(nParams))
 
 
-def save_model(path, model, epoch, optimizer=None):
+def save_model(path, model, epoch, optimizer=None, scaler_state=None):
     model_dict = {
         'epoch': epoch,
         'model_state': model.state_dict()
     }
     if optimizer is not None:
         model_dict['optimizer_state'] = optimizer.state_dict()
+    if scaler_state is not None:
+        # GradScaler of --amp runs
+        model_dict['scaler_state'] = scaler_state
 
     torch.save(model_dict, path)
 
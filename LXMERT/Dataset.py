@@ -4,10 +4,8 @@
 
 # coding=utf-8
 
-import base64
 import json
 import os
-import pandas as pd
 import pickle
 
 import numpy as np
@@ -15,39 +13,24 @@ import torch
 from torch.utils.data import Dataset
 
 import re
+import sys
 from sklearn.metrics import f1_score
 from nltk.translate.bleu_score import sentence_bleu
 from src.parameters import args
+from src.lxrt.entry import convert_sents_to_ids
+from src.lxrt.tokenization import BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from pvqa_features import open_features, share_features
+from pvqa_features.collate import ImageSample
+from pvqa_features.targets import SparseTarget
 
-question_types = ('where', 'what', 'how', 'how many/how much', 'when', 'why', 'who/whose', 'other', 'yes/no')
-FIELDNAMES = ['image_id', 'image_w', 'image_h', 'num_boxes', 'boxes', 'features']
-
-def load_tsv(split: str, args = ''):
-    tsv_file = 'data/pvqa/images/%s%s.csv' % (split, args)
-    df = pd.read_csv(tsv_file, delimiter='\t', names=FIELDNAMES)
-
-    data = []
-    for i in range(df.shape[0]):
-        datum = {}
-        datum['img_id'] = '%s_%04d' % (split, df['image_id'][i])
-        datum['img_w'] = df['image_w'][i]
-        datum['img_h'] = df['image_h'][i]
-        datum['num_boxes'] = df['num_boxes'][i]
-
-        boxes = df['boxes'][i]
-        buf = base64.b64decode(boxes[1:])
-        temp = np.frombuffer(buf, dtype=np.float64).astype(np.float32)
-        datum['boxes'] = temp.reshape(datum['num_boxes'], -1)
 
-        features = df['features'][i]
-        buf = base64.b64decode(features[1:])
-        temp = np.frombuffer(buf, dtype=np.float32)
-        datum['features'] = temp.reshape(datum['num_boxes'], -1)
-
-        data.append(datum)
+question_types = ('where', 'what', 'how', 'how many/how much', 'when', 'why', 'who/whose', 'other', 'yes/no')
 
-    return data
+def load_features(split: str, img_v: str = ''):
+    tsv_file = 'data/pvqa/images/%s%s.csv' % (split, img_v)
+    return open_features(tsv_file, args.feat_backend, args.decode_workers)
 
 
 def get_q_type(q: str):
@@ -102,59 +85,66 @@ class PVQADataset:
         return len(self.data)
 
 class PVQATorchDataset(Dataset):
-    def __init__(self, dataset: PVQADataset):
+    def __init__(self, dataset: PVQADataset, max_seq_length=None):
+        """
+        :param max_seq_length: If given, the questions are tokenized once here and returned as
+            [max_seq_length] input_ids for LXRTEncoder instead of strings.
+        """
         super(PVQATorchDataset, self).__init__()
         self.raw_dataset = dataset
 
-        # loading detection features to img_data
-        self.imgid2img = {}
-        for split in dataset.splits:
-            data = load_tsv(split)
-
-            for datum in data:
-                self.imgid2img[datum['img_id']] = datum
+        # loading detection features into one backend shared by the DataLoader workers
+        self.img_features = share_features([load_features(split) for split in dataset.splits])
+        # normalized to 0 ~ 1 and range checked once, the samples slice views of it
+        self.boxes = self.img_features.normalized_boxes()
 
         self.data = []
         for datum in self.raw_dataset.data:
-            if datum['img_id'] in self.imgid2img:
+            if datum['img_id'] in self.img_features:
                 self.data.append(datum)
         print('use %d data in torch dataset' % (len(self.data)))
+
+        self.sent_ids = None
+        if max_seq_length is not None:
+            tokenizer = BertTokenizer.from_pretrained("bert-base-uncased", do_lower_case=True)
+            self.sent_ids = convert_sents_to_ids([datum['sent'] for datum in self.data], max_seq_length, tokenizer)
+            print('tokenized %d questions' % len(self.sent_ids))
         print()
 
     def __len__(self):
         return len(self.data)
 
+    def sample_images(self):
+        """Image of every question, for ImageGroupBatchSampler."""
+        return [self.img_features.img_id2idx[datum['img_id']] for datum in self.data]
+
     def __getitem__(self, item: int):
         datum = self.data[item]
         img_id = datum['img_id']
         ques_id = datum['question_id']
-        ques = datum['sent']
+        ques = datum['sent'] if self.sent_ids is None else torch.from_numpy(self.sent_ids[item])
 
         # Get image info
-        img_info = self.imgid2img[img_id]
-        obj_num = img_info['num_boxes']
-        feats = img_info['features'].copy()
-        boxes = img_info['boxes'].copy()
-
-        assert obj_num == len(boxes) == len(feats)
+        idx = self.img_features.img_id2idx[img_id]
+        feats = self.img_features.get_features(idx)
+        boxes = self.boxes[self.img_features.offsets[idx]:self.img_features.offsets[idx + 1]]
 
-        img_h, img_w = img_info['img_h'], img_info['img_w']
-        boxes = boxes.copy()
-        boxes[:, (0, 2)] /= img_w
-        boxes[:, (1, 3)] /= img_h
-        np.testing.assert_array_less(boxes, 1 + 1e-5)
-        np.testing.assert_array_less(-boxes, 0 + 1e-5)
+        if args.check_boxes:
+            assert self.img_features.num_boxes[idx] == len(boxes) == len(feats)
+            self.img_features.check_normalized_boxes(idx, boxes)
 
         # Provide label (target)
         if 'label' in datum:
             label = datum['label']
-            target = torch.zeros(self.raw_dataset.num_answers)
-            for ans, score in label.items():
-                if ans in self.raw_dataset.ans2label:
-                    target[self.raw_dataset.ans2label[ans]] = score
-            return ques_id, feats, boxes, ques, target
+            answers = [ans for ans in label if ans in self.raw_dataset.ans2label]
+            # expanded into the dense batch target by sparse_collate and .cuda()
+            target = SparseTarget.from_arrays([self.raw_dataset.ans2label[ans] for ans in answers],
+                                              [label[ans] for ans in answers], self.raw_dataset.num_answers)
+            fields = ques_id, feats, boxes, ques, target
         else:
-            return ques_id, feats, boxes, ques
+            fields = ques_id, feats, boxes, ques
+        # the image is told to PaddedCollate(image_fields=...) by its index
+        return ImageSample(fields, idx, self.img_features)
 
 class PVQAEvaluator:
     def __init__(self, dataset: PVQADataset):
@@ -3,37 +3,72 @@
 
 
 import os
+import builtins
 import collections
 
 import torch
 import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data.dataloader import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm
 
 from src.pretrain.qa_answer_table import load_lxmert_qa
 #from src.parametros import args
 from src.parameters import args
-from PVQAModel import PVQAModel
+from PVQAModel import PVQAModel, MAX_PVQA_LENGTH
 
 from Dataset import PVQADataset, PVQATorchDataset, PVQAEvaluator
+from pvqa_features.targets import sparse_collate
+from pvqa_features.collate import PaddedCollate
+from pvqa_features.distributed import all_gather_objects, cleanup, get_rank, get_world_size, init_distributed, \
+    is_distributed, is_main_process, unwrap
+from pvqa_features.sampler import DistributedEvalSampler, ImageGroupBatchSampler, sample_images
 
 
 DataTuple = collections.namedtuple("DataTuple", 'dataset loader evaluator')
 
 
-def get_data_tuple(splits: str, bs: int, shuffle=False, drop_last=False) -> DataTuple:
+def get_data_tuple(splits: str, bs: int, shuffle=False, drop_last=False, group_images=False) -> DataTuple:
     dset = PVQADataset(splits)
-    tset = PVQATorchDataset(dset)
+    # questions tokenized once, the model takes their input_ids
+    tset = PVQATorchDataset(dset, max_seq_length=MAX_PVQA_LENGTH)
     evaluator = PVQAEvaluator(dset)
-    data_loader = DataLoader(
-        tset, batch_size=bs,
-        shuffle=shuffle,
-        drop_last=drop_last, pin_memory=True
-    )
+    if group_images:
+        # feats and boxes only depend on the image, they are batched once per image
+        data_loader = DataLoader(
+            tset, batch_sampler=ImageGroupBatchSampler(sample_images(tset), bs,
+                                                       num_replicas=get_world_size(), rank=get_rank()),
+            pin_memory=True,
+            collate_fn=PaddedCollate(image_fields=(1, 2))
+        )
+    else:
+        sampler = None
+        if is_distributed():
+            # every rank loads its shard: the shuffled training shards are padded to
+            # the same length, the evaluated ones hold every question once
+            if shuffle:
+                sampler = DistributedSampler(tset, shuffle=True, seed=args.seed, drop_last=drop_last)
+            else:
+                sampler = DistributedEvalSampler(tset)
+        data_loader = DataLoader(
+            tset, batch_size=bs,
+            shuffle=shuffle and sampler is None, sampler=sampler,
+            drop_last=drop_last, pin_memory=True,
+            collate_fn=sparse_collate
+        )
 
     return DataTuple(dataset=dset, loader=data_loader, evaluator=evaluator)
 
 
+def gather_answers(quesid2ans):
+    """The quesid2ans of every rank, which predicted its shard of the questions, merged."""
+    merged = {}
+    for part in all_gather_objects(quesid2ans):
+        merged.update(part)
+    return merged
+
+
 class PVQA:
     def __init__(self):
         # datasets
@@ -44,7 +79,7 @@ class PVQA:
         if args.valid != " ":
             self.valid_tuple = get_data_tuple(
                 splits=args.valid, bs=args.batch_size,
-                shuffle=False, drop_last=False
+                shuffle=False, drop_last=False, group_images=args.group_images
             )
         else:
             self.valid_tuple = None
@@ -61,9 +96,14 @@ class PVQA:
             load_lxmert_qa(args.load_lxmert_qa, self.model,
                            label2ans=self.train_tuple.dataset.label2ans)
         # GPU options
-        self.model = self.model.cuda()
-        if args.multiGPU:
-            self.model.lxrt_encoder.multi_gpu()
+        self.model = self.model.to(args.device)
+        if is_distributed():
+            # gradients are all-reduced in backward, rank 0's weights are broadcast here.
+            # The visual branch of the last cross-modality layer does not reach the
+            # pooled output and gets no gradient.
+            self.model = DDP(self.model,
+                             device_ids=[args.device.index] if args.device.type == 'cuda' else None,
+                             find_unused_parameters=True)
 
         # Loss and Optimizer
         self.bce_loss = nn.BCEWithLogitsLoss()
@@ -81,7 +121,8 @@ class PVQA:
 
         # Output Directory
         self.output =  args.output
-        os.makedirs(self.output, exist_ok=True)
+        if is_main_process():
+            os.makedirs(self.output, exist_ok=True)
 
     def train(self, train_tuple, eval_tuple):
         dset, loader, evaluator = train_tuple
@@ -90,13 +131,18 @@ class PVQA:
 
         best_valid = 0.
         for epoch in range(args.epochs):
+            if hasattr(loader.sampler, 'set_epoch'):
+                # another shuffle of the shards every epoch
+                loader.sampler.set_epoch(epoch)
             quesid2ans = {}
             for i, (ques_id, feats, boxes, sent, target) in iter_wrapper(enumerate(loader)):
 
                 self.model.train()
                 self.optim.zero_grad()
 
-                feats, boxes, target = feats.cuda(), boxes.cuda(), target.cuda()
+                feats = feats.to(args.device, non_blocking=True)
+                boxes = boxes.to(args.device, non_blocking=True)
+                target = target.to(args.device, non_blocking=True)
                 logit = self.model(feats, boxes, sent)
                 assert logit.dim() == target.dim() == 2
                 loss = self.bce_loss(logit, target)
@@ -111,6 +157,7 @@ class PVQA:
                     ans = dset.label2ans[l]
                     quesid2ans[qid.item()] = ans
 
+            quesid2ans = gather_answers(quesid2ans)
             log_str = "\nEpoch %d: Train %0.2f\n" % (
                 epoch, evaluator.evaluate(quesid2ans) * 100.)
 
@@ -125,9 +172,10 @@ class PVQA:
 
             print(log_str, end='')
 
-            with open(self.output + "/log.log", 'a') as f:
-                f.write(log_str)
-                f.flush()
+            if is_main_process():
+                with open(self.output + "/log.log", 'a') as f:
+                    f.write(log_str)
+                    f.flush()
 
         self.save("LAST")
 
@@ -137,22 +185,30 @@ class PVQA:
 
         :param eval_tuple: The data tuple to be evaluated.
         :param dump: The path of saved file to dump results.
-        :return: A dict of question_id to answer.
+        :return: A dict of question_id to answer, of the questions of every rank.
         """
         self.model.eval()
+        # no gradients to all-reduce, every rank predicts its shard on its own
+        model = unwrap(self.model)
         dset, loader, evaluator = eval_tuple
         quesid2ans = {}
         for i, datum_tuple in enumerate(loader):
             # Avoid seeing ground truth
             ques_id, feats, boxes, sent = datum_tuple[:4]
+            # image row of every question when the batches are grouped by image
+            v_index = getattr(datum_tuple, 'v_index', None)
             with torch.no_grad():
-                feats, boxes = feats.cuda(), boxes.cuda()
-                logit = self.model(feats, boxes, sent)
+                feats = feats.to(args.device, non_blocking=True)
+                boxes = boxes.to(args.device, non_blocking=True)
+                if v_index is not None:
+                    v_index = v_index.to(args.device, non_blocking=True)
+                logit = model(feats, boxes, sent, v_index=v_index)
                 score, label = logit.max(1)
                 for qid, l in zip(ques_id, label.cpu().numpy()):
                     ans = dset.label2ans[l]
                     quesid2ans[qid.item()] = ans
-        if dump is not None:
+        quesid2ans = gather_answers(quesid2ans)
+        if dump is not None and is_main_process():
             evaluator.dump_result(quesid2ans, dump)
         return quesid2ans
 
@@ -166,20 +222,34 @@ class PVQA:
         dset, loader, evaluator = data_tuple
         quesid2ans = {}
         for i, (ques_id, feats, boxes, sent, target) in enumerate(loader):
-            _, label = target.max(1)
+            _, label = target.cpu().max(1)
             for qid, l in zip(ques_id, label.cpu().numpy()):
                 ans = dset.label2ans[l]
                 quesid2ans[qid.item()] = ans
-        return evaluator.evaluate(quesid2ans)
+        return evaluator.evaluate(gather_answers(quesid2ans))
 
     def save(self, name):
-        torch.save(self.model.state_dict(),
-                   os.path.join(self.output, "%s.pth" % name))
+        # the unwrapped model: the same checkpoints with and without torchrun
+        if is_main_process():
+            torch.save(unwrap(self.model).state_dict(),
+                       os.path.join(self.output, "%s.pth" % name))
 
     def load(self, path):
         print("Load model from %s" % path)
-        state_dict = torch.load("%s.pth" % path)
-        self.model.load_state_dict(state_dict)
+        state_dict = torch.load("%s.pth" % path, map_location='cpu')
+        unwrap(self.model).load_state_dict(state_dict)
+
+# torchrun --nproc_per_node N PVQA.py ...: one process per GPU (or CPU process with
+# gloo), --batch_size is per process
+rank, local_rank, world_size = init_distributed(args.backend)
+if rank != 0:
+    def print_pass(*args, **kwargs):
+        pass
+
+    builtins.print = print_pass
+if args.multiGPU and world_size == 1:
+    print("--multiGPU is deprecated, launch with torchrun --nproc_per_node N to train on N GPUs")
+args.device = torch.device('cuda', local_rank) if torch.cuda.is_available() else torch.device('cpu')
 
 valid_bs = 32
 pvqa = PVQA()
@@ -194,13 +264,15 @@ if args.test is not None:
     if 'test' in args.test:
             result = pvqa.evaluate(
                 get_data_tuple(args.test, bs=valid_bs,
-                               shuffle=False, drop_last=False),
+                               shuffle=False, drop_last=False,
+                               group_images=args.group_images),
                 dump=os.path.join(args.output, 'test_predict.json')
             )
             print(result)
-            with open(args.output + "/log.log", 'a') as f:
-                f.write('test result=' + str(result))
-                f.flush()
+            if is_main_process():
+                with open(args.output + "/log.log", 'a') as f:
+                    f.write('test result=' + str(result))
+                    f.flush()
 
     elif 'val' in args.test:
             ## NOT USED
@@ -208,13 +280,15 @@ if args.test is not None:
             # only validate on the minival set.
             result = pvqa.evaluate(
                 get_data_tuple('test', bs=valid_bs,
-                               shuffle=False, drop_last=False),
+                               shuffle=False, drop_last=False,
+                               group_images=args.group_images),
                 dump=os.path.join(args.output, 'test_predict.json')
             )
             print(result)
-            with open(args.output + "/log.log", 'a') as f:
-                f.write('test result=' + str(result))
-                f.flush()
+            if is_main_process():
+                with open(args.output + "/log.log", 'a') as f:
+                    f.write('test result=' + str(result))
+                    f.flush()
 
 else:
     print('Splits in Train data:', pvqa.train_tuple.dataset.splits)
@@ -224,4 +298,5 @@ else:
               (pvqa.oracle_score(pvqa.valid_tuple) * 100))
     else:
         print("DO NOT USE VALIDATION")
-    pvqa.train(pvqa.train_tuple, pvqa.valid_tuple)
\ No newline at end of file
+    pvqa.train(pvqa.train_tuple, pvqa.valid_tuple)
+cleanup()
\ No newline at end of file
@@ -1,3 +1,4 @@
+import builtins
 import collections
 import os
 import random
@@ -6,45 +7,30 @@ from tqdm import tqdm
 import numpy as np
 import torch
 import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 
 from src.parameters import args
 from src.pretrain.lxmert_data import InputExample, LXMERTDataset, LXMERTTorchDataset, LXMERTEvaluator
 from src.lxrt.entry import set_visual_config
 from src.lxrt.tokenization import BertTokenizer
 from src.lxrt.modeling import LXRTPretraining
+from pvqa_features.distributed import all_gather_objects, all_reduce_sum, cleanup, init_distributed, \
+    is_distributed, is_main_process, unwrap
+from pvqa_features.sampler import DistributedEvalSampler
 
 DataTuple = collections.namedtuple("DataTuple", 'dataset torchdset loader evaluator')
 
+# Max length including [CLS] and [SEP]
+MAX_SEQ_LENGTH = 20
 
-def get_tuple(splits: str, bs: int, shuffle=False, drop_last=False, topk=-1) -> DataTuple:
-    # Decide which QA datasets would be used in pre-training.
-    # Options: vqa, gqa, visual7w
-    # Note: visual7w is a part of vgqa, we take the name here.
-    qa_sets = args.qa_sets
-    if qa_sets is not None:
-        qa_sets = set(qa_set.lower().strip() for qa_set in qa_sets.split(","))
-
-    # Build dataset, data loader, and evaluator.
-    dset = LXMERTDataset(splits, qa_sets=qa_sets)
-    tset = LXMERTTorchDataset(dset, topk)
-    data_loader = DataLoader(
-        tset, batch_size=bs,
-        shuffle=shuffle, num_workers=args.num_workers,
-        collate_fn=lambda x: x,
-        drop_last=drop_last, pin_memory=True
-    )
-    evaluator = LXMERTEvaluator(dset)
-    print()
-
-    return DataTuple(dataset=dset, torchdset=tset, loader=data_loader, evaluator=evaluator)
+tokenizer = BertTokenizer.from_pretrained(
+    "bert-base-uncased",
+    do_lower_case=True
+)
 
 
-train_tuple = get_tuple(args.train, args.batch_size, shuffle=True, drop_last=True)
-# valid_batch_size = 2048 if args.multiGPU else 512
-valid_batch_size = 64 if args.multiGPU else 32
-valid_tuple = get_tuple(args.valid, valid_batch_size, shuffle=False, drop_last=False, topk=5000)
-
 class InputFeatures(object):
     """A single set of features of data."""
 
@@ -87,14 +73,17 @@ class InputFeatures(object):
         self.lm_label_ids_a_rps = lm_label_ids_a_rps
 
 
-def random_word(tokens, tokenizer):
+def random_word(tokens, tokenizer, vocab_tokens=None):
     """
     Masking some random tokens for Language Model task with probabilities as in the original BERT paper.
     :param tokens: list of str, tokenized sentence.
     :param tokenizer: Tokenizer, object used for tokenization (we need it's vocab here)
+    :param vocab_tokens: list(tokenizer.vocab), to not rebuild it for every masked token
     :return: (list of str, list of int), masked tokens and related labels for LM prediction
     """
     output_label = []
+    if vocab_tokens is None:
+        vocab_tokens = list(tokenizer.vocab)
 
     for i, token in enumerate(tokens):
         prob = random.random()
@@ -109,7 +98,7 @@ def random_word(tokens, tokenizer):
 
             # 10% randomly change token to random token
             elif prob < 0.9:
-                tokens[i] = random.choice(list(tokenizer.vocab.items()))[0]
+                tokens[i] = random.choice(vocab_tokens)
 
             # -> rest 10% randomly keep current token
 
@@ -157,7 +146,8 @@ def get_ans_type(ans):
         return 0
 
 
-def convert_example_to_features(example: InputExample, max_seq_length, tokenizer) -> InputFeatures:
+def convert_example_to_features(example: InputExample, max_seq_length, tokenizer,
+                                vocab_tokens=None) -> InputFeatures:
     """
     Convert a raw sample (pair of sentences as tokenized strings) into a proper training sample with
     IDs, LM labels, input_mask, CLS and SEP tokens etc.
@@ -206,17 +196,17 @@ def convert_example_to_features(example: InputExample, max_seq_length, tokenizer
         tokens_a_rps = tokens_a_rps[:(max_seq_length - 2)]
 
     # Ge random words
-    masked_tokens, masked_label = random_word(tokens, tokenizer)
+    masked_tokens, masked_label = random_word(tokens, tokenizer, vocab_tokens)
     if tokens_rps is not None:
-        masked_tokens_rps, masked_label_rps = random_word(tokens_rps, tokenizer)
+        masked_tokens_rps, masked_label_rps = random_word(tokens_rps, tokenizer, vocab_tokens)
     else:
         masked_tokens_rps, masked_label_rps = None, None
     if tokens_a is not None:
-        masked_tokens_a, masked_label_a = random_word(tokens_a, tokenizer)
+        masked_tokens_a, masked_label_a = random_word(tokens_a, tokenizer, vocab_tokens)
     else:
         masked_tokens_a, masked_label_a = None, None
     if tokens_a_rps is not None:
-        masked_tokens_a_rps, masked_label_a_rps = random_word(tokens_a_rps, tokenizer)
+        masked_tokens_a_rps, masked_label_a_rps = random_word(tokens_a_rps, tokenizer, vocab_tokens)
     else:
         masked_tokens_a_rps, masked_label_a_rps = None, None
 
@@ -407,6 +397,157 @@ def convert_example_to_features(example: InputExample, max_seq_length, tokenizer
     return features
 
 
+PretrainBatch = collections.namedtuple("PretrainBatch", [
+    'uid', 'input_ids', 'input_mask', 'segment_ids',
+    'input_ids_rps', 'input_mask_rps', 'segment_ids_rps',
+    'input_ids_a', 'input_mask_a', 'segment_ids_a',
+    'input_ids_a_rps', 'input_mask_a_rps', 'segment_ids_a_rps',
+    'feats', 'pos', 'lm_labels', 'lm_labels_rps', 'lm_labels_a', 'lm_labels_a_rps', 'obj_labels',
+    'matched_labels', 'matched_labels_ans', 'ans', 'replace_ans', 'ans_types', 'ans_rps_types'])
+
+
+class PretrainCollate(object):
+    """collate_fn converting the InputExamples of a batch to features and stacking them into a
+    PretrainBatch of tensors (and the list of uids), so that the tokenization and the masking
+    run in the DataLoader workers and the batch can be pinned."""
+
+    def __init__(self, tokenizer, max_seq_length):
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.vocab_tokens = list(tokenizer.vocab)
+
+    def __call__(self, examples):
+        train_features = [convert_example_to_features(example, self.max_seq_length, self.tokenizer,
+                                                      self.vocab_tokens)
+                          for example in examples]
+
+        def long_tensor(name):
+            return torch.tensor([getattr(f, name) for f in train_features], dtype=torch.long)
+
+        # Visual Prediction
+        obj_labels = {}
+        for key in ('obj', 'attr', 'feat'):
+            if type(train_features[0].obj_labels[key][0]) == type(None):
+                visn_labels = None
+                visn_mask = None
+            else:
+                visn_labels = torch.from_numpy(np.stack([f.obj_labels[key][0] for f in train_features]))
+                visn_mask = torch.from_numpy(np.stack([f.obj_labels[key][1] for f in train_features]))
+                assert visn_labels.size(0) == visn_mask.size(0) and visn_labels.size(1) == visn_mask.size(1)
+            obj_labels[key] = (visn_labels, visn_mask)
+
+        return PretrainBatch(
+            uid=[example.uid for example in examples],
+            # language Inputs
+            input_ids=long_tensor('input_ids'),
+            input_mask=long_tensor('input_mask'),
+            segment_ids=long_tensor('segment_ids'),
+            input_ids_rps=long_tensor('input_ids_rps'),
+            input_mask_rps=long_tensor('input_mask_rps'),
+            segment_ids_rps=long_tensor('segment_ids_rps'),
+            input_ids_a=long_tensor('input_ids_a'),
+            input_mask_a=long_tensor('input_mask_a'),
+            segment_ids_a=long_tensor('segment_ids_a'),
+            input_ids_a_rps=long_tensor('input_ids_a_rps'),
+            input_mask_a_rps=long_tensor('input_mask_a_rps'),
+            segment_ids_a_rps=long_tensor('segment_ids_a_rps'),
+            # Visual Inputs
+            feats=torch.from_numpy(np.stack([f.visual_feats[0] for f in train_features])),
+            pos=torch.from_numpy(np.stack([f.visual_feats[1] for f in train_features])),
+            # Language Prediction
+            lm_labels=long_tensor('lm_label_ids'),
+            lm_labels_rps=long_tensor('lm_label_ids_rps'),
+            lm_labels_a=long_tensor('lm_label_ids_a'),
+            lm_labels_a_rps=long_tensor('lm_label_ids_a_rps'),
+            obj_labels=obj_labels,
+            # Joint Prediction
+            matched_labels=long_tensor('is_matched'),
+            matched_labels_ans=long_tensor('ans_matched'),
+            ans=torch.from_numpy(np.stack([f.ans for f in train_features])).type(torch.LongTensor),
+            replace_ans=torch.from_numpy(np.stack([f.replace_ans for f in train_features])),
+            ans_types=long_tensor('ans_type'),
+            ans_rps_types=long_tensor('ans_rps_type'),
+        )
+
+
+def seed_numpy(worker_id):
+    """worker_init_fn: the answer sampling uses numpy, which the workers would otherwise
+    all inherit in the same state."""
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+
+
+def to_device(data, device):
+    """Copy the tensors of a (pinned) PretrainBatch to the device without blocking."""
+    if torch.is_tensor(data):
+        return data.to(device, non_blocking=True)
+    if isinstance(data, dict):
+        return {key: to_device(value, device) for key, value in data.items()}
+    if isinstance(data, PretrainBatch):
+        return PretrainBatch(*[to_device(value, device) for value in data])
+    if isinstance(data, (tuple, list)):
+        return type(data)(to_device(value, device) for value in data)
+    return data
+
+
+def gather_answers(uid2ans):
+    """The uid2ans of every rank, which answered its shard of the questions, merged."""
+    merged = {}
+    for part in all_gather_objects(uid2ans):
+        merged.update(part)
+    return merged
+
+
+def get_tuple(splits: str, bs: int, shuffle=False, drop_last=False, topk=-1) -> DataTuple:
+    # Decide which QA datasets would be used in pre-training.
+    # Options: vqa, gqa, visual7w
+    # Note: visual7w is a part of vgqa, we take the name here.
+    qa_sets = args.qa_sets
+    if qa_sets is not None:
+        qa_sets = set(qa_set.lower().strip() for qa_set in qa_sets.split(","))
+
+    # Build dataset, data loader, and evaluator.
+    dset = LXMERTDataset(splits, qa_sets=qa_sets)
+    tset = LXMERTTorchDataset(dset, topk)
+    sampler = None
+    if is_distributed():
+        # every rank loads its shard: the shuffled training shards are padded to
+        # the same length, the evaluated ones hold every example once
+        if shuffle:
+            sampler = DistributedSampler(tset, shuffle=True, seed=args.seed, drop_last=drop_last)
+        else:
+            sampler = DistributedEvalSampler(tset)
+    # the examples are converted and stacked in the workers, batches arrive pinned
+    data_loader = DataLoader(
+        tset, batch_size=bs,
+        shuffle=shuffle and sampler is None, sampler=sampler, num_workers=args.num_workers,
+        collate_fn=PretrainCollate(tokenizer, MAX_SEQ_LENGTH),
+        worker_init_fn=seed_numpy,
+        drop_last=drop_last, pin_memory=True
+    )
+    evaluator = LXMERTEvaluator(dset)
+    print()
+
+    return DataTuple(dataset=dset, torchdset=tset, loader=data_loader, evaluator=evaluator)
+
+
+# torchrun --nproc_per_node N lxmert_pretrain_PVQA.py ...: one process per GPU (or CPU
+# process with gloo), the batch sizes are per process
+rank, local_rank, world_size = init_distributed(args.backend)
+if rank != 0:
+    def print_pass(*args, **kwargs):
+        pass
+
+    builtins.print = print_pass
+if args.multiGPU and world_size == 1:
+    print("--multiGPU is deprecated, launch with torchrun --nproc_per_node N to train on N GPUs")
+args.device = torch.device('cuda', local_rank) if torch.cuda.is_available() else torch.device('cpu')
+
+train_tuple = get_tuple(args.train, args.batch_size, shuffle=True, drop_last=True)
+# valid_batch_size = 2048 if args.multiGPU else 512
+valid_batch_size = 32
+valid_tuple = get_tuple(args.valid, valid_batch_size, shuffle=False, drop_last=False, topk=5000)
+
+
 LOSSES_NAME = ('Mask_LM', 'Matched', 'Obj', 'Attr', 'Feat', 'QA')
 
 
@@ -421,10 +562,7 @@ class LXMERT:
         super().__init__()
         self.max_seq_length = max_seq_length
 
-        self.tokenizer = BertTokenizer.from_pretrained(
-            "bert-base-uncased",
-            do_lower_case=True
-        )
+        self.tokenizer = tokenizer
 
         # Build model
         set_visual_config(args)
@@ -453,83 +591,38 @@ class LXMERT:
             self.load_lxmert(args.load_lxmert)
 
         # GPU Options
-        self.model = self.model.cuda()
-        if args.multiGPU:
-            self.model = nn.DataParallel(self.model)
-
-    def forward(self, examples):
-        train_features = [convert_example_to_features(example, self.max_seq_length, self.tokenizer)
-                          for example in examples]
-
-        # language Inputs
-        input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long).cuda()
-        input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long).cuda()
-        segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long).cuda()
-
-        input_ids_rps = torch.tensor([f.input_ids_rps for f in train_features], dtype=torch.long).cuda()
-        input_mask_rps = torch.tensor([f.input_mask_rps for f in train_features], dtype=torch.long).cuda()
-        segment_ids_rps = torch.tensor([f.segment_ids_rps for f in train_features], dtype=torch.long).cuda()
-
-        input_ids_a = torch.tensor([f.input_ids_a for f in train_features], dtype=torch.long).cuda()
-        input_mask_a = torch.tensor([f.input_mask_a for f in train_features], dtype=torch.long).cuda()
-        segment_ids_a = torch.tensor([f.segment_ids_a for f in train_features], dtype=torch.long).cuda()
-
-        input_ids_a_rps = torch.tensor([f.input_ids_a_rps for f in train_features], dtype=torch.long).cuda()
-        input_mask_a_rps = torch.tensor([f.input_mask_a_rps for f in train_features], dtype=torch.long).cuda()
-        segment_ids_a_rps = torch.tensor([f.segment_ids_a_rps for f in train_features], dtype=torch.long).cuda()
-
-        # Visual Inputs
-        feats = torch.from_numpy(np.stack([f.visual_feats[0] for f in train_features])).cuda()
-        pos = torch.from_numpy(np.stack([f.visual_feats[1] for f in train_features])).cuda()
-
-        # Language Prediction
-        lm_labels = torch.tensor([f.lm_label_ids for f in train_features], dtype=torch.long).cuda()
-        lm_labels_rps = torch.tensor([f.lm_label_ids_rps for f in train_features], dtype=torch.long).cuda()
-        lm_labels_a = torch.tensor([f.lm_label_ids_a for f in train_features], dtype=torch.long).cuda()
-        lm_labels_a_rps = torch.tensor([f.lm_label_ids_a_rps for f in train_features], dtype=torch.long).cuda()
-
-        # Visual Prediction
-        obj_labels = {}
-        for key in ('obj', 'attr', 'feat'):
-            if type(train_features[0].obj_labels[key][0]) == type(None):
-                visn_labels = None
-                visn_mask = None
-            else:
-                visn_labels = torch.from_numpy(np.stack([f.obj_labels[key][0] for f in train_features])).cuda()
-                visn_mask = torch.from_numpy(np.stack([f.obj_labels[key][1] for f in train_features])).cuda()
-                assert visn_labels.size(0) == visn_mask.size(0) and visn_labels.size(1) == visn_mask.size(1)
-            obj_labels[key] = (visn_labels, visn_mask)
-
-        # Joint Prediction
-        matched_labels = torch.tensor([f.is_matched for f in train_features], dtype=torch.long).cuda()
-        matched_labels_ans = torch.tensor([f.ans_matched for f in train_features], dtype=torch.long).cuda()
-        ans = torch.from_numpy(np.stack([f.ans for f in train_features]))
-        ans = ans.type(torch.LongTensor).cuda()
-        replace_ans = torch.from_numpy(np.stack([f.replace_ans for f in train_features])).cuda()
-        ans_types = torch.tensor([f.ans_type for f in train_features], dtype=torch.long).cuda()
-        ans_rps_types = torch.tensor([f.ans_rps_type for f in train_features], dtype=torch.long).cuda()
+        self.model = self.model.to(args.device)
+        if is_distributed():
+            # gradients are all-reduced in backward, rank 0's weights are broadcast here.
+            # The heads of the disabled tasks get no gradient.
+            self.model = DDP(self.model,
+                             device_ids=[args.device.index] if args.device.type == 'cuda' else None,
+                             find_unused_parameters=True)
+
+    def forward(self, batch, model=None):
+        if model is None:
+            model = self.model
+        # converted and stacked by PretrainCollate in the workers, pinned by the DataLoader
+        b = to_device(batch, args.device)
 
         """
         forward(self, input_ids, token_type_ids=None, attention_mask=None, masked_lm_labels=None,
                 visual_feats=None, pos=None, obj_labels=None, matched_label=None, ans=None):
         """
-        loss, losses, ans_logit = self.model(
-            input_ids, segment_ids, input_mask, lm_labels,
-            feats, pos, obj_labels,
-            matched_labels, matched_labels_ans,
-            ans, replace_ans, ans_types, ans_rps_types,
-            input_ids_rps, segment_ids_rps, input_mask_rps, lm_labels_rps,
-            input_ids_a, segment_ids_a, input_mask_a, lm_labels_a,
-            input_ids_a_rps, segment_ids_a_rps, input_mask_a_rps, lm_labels_a_rps,
+        loss, losses, ans_logit = model(
+            b.input_ids, b.segment_ids, b.input_mask, b.lm_labels,
+            b.feats, b.pos, b.obj_labels,
+            b.matched_labels, b.matched_labels_ans,
+            b.ans, b.replace_ans, b.ans_types, b.ans_rps_types,
+            b.input_ids_rps, b.segment_ids_rps, b.input_mask_rps, b.lm_labels_rps,
+            b.input_ids_a, b.segment_ids_a, b.input_mask_a, b.lm_labels_a,
+            b.input_ids_a_rps, b.segment_ids_a_rps, b.input_mask_a_rps, b.lm_labels_a_rps,
         )
         return loss, losses.detach().cpu(), ans_logit
 
     def train_batch(self, optim, batch):
         optim.zero_grad()
         loss, losses, ans_logit = self.forward(batch)
-        if args.multiGPU:
-            loss = loss.mean()
-            losses = losses.mean(0)
         loss.backward()
         nn.utils.clip_grad_norm_(self.model.parameters(), 1.)
         optim.step()
@@ -538,10 +631,8 @@ class LXMERT:
 
     def valid_batch(self, batch):
         with torch.no_grad():
-            loss, losses, ans_logit = self.forward(batch)
-            if args.multiGPU:
-                loss = loss.mean()
-                losses = losses.mean(0)
+            # no gradients to all-reduce, every rank evaluates its shard on its own
+            loss, losses, ans_logit = self.forward(batch, unwrap(self.model))
         return loss.item(), losses.cpu().numpy(), ans_logit
 
     def train(self, train_tuple: DataTuple, eval_tuple: DataTuple):
@@ -569,6 +660,9 @@ class LXMERT:
             #     # self.model.bert.encoder.qa=True
 
             # Train
+            if hasattr(train_ld.sampler, 'set_epoch'):
+                # another shuffle of the shards every epoch
+                train_ld.sampler.set_epoch(epoch)
             self.model.train()
             total_loss = 0.
             total_losses = 0.
@@ -580,18 +674,20 @@ class LXMERT:
 
                 if args.task_qa:
                     score, label = logit.max(1)
-                    for datum, l in zip(batch, label.cpu().numpy()):
-                        uid = datum.uid
+                    for uid, l in zip(batch.uid, label.cpu().numpy()):
                         ans = train_tuple.dataset.answer_table.id2ans(l)
                         uid2ans[uid] = ans
 
-            print("The training loss for Epoch %d is %0.4f" % (epoch, total_loss / batch_per_epoch))
+            # the mean batch loss of all the ranks
+            total_loss, num_batches = all_reduce_sum(
+                torch.tensor([total_loss, batch_per_epoch], dtype=torch.float64, device=args.device)).tolist()
+            print("The training loss for Epoch %d is %0.4f" % (epoch, total_loss / num_batches))
             losses_str = "The losses are "
             # for name, loss in zip(LOSSES_NAME, total_losses):
             #   losses_str += "%s: %0.4f " % (name, loss / batch_per_epoch)
             # print(losses_str)
             if args.task_qa:
-                train_tuple.evaluator.evaluate(uid2ans, pprint=True)
+                train_tuple.evaluator.evaluate(gather_answers(uid2ans), pprint=True)
 
             # Eval
             avg_eval_loss = self.evaluate_epoch(eval_tuple, iters=-1)
@@ -607,35 +703,40 @@ class LXMERT:
         eval_ld = eval_tuple.loader
         total_loss = 0.
         total_losses = 0.
+        num_batches = 0
         uid2ans = {}
         for i, batch in enumerate(eval_ld):
             loss, losses, logit = self.valid_batch(batch)
+            num_batches += 1
             total_loss += loss
             total_losses += losses
             if args.task_qa:
                 score, label = logit.max(1)
-                for datum, l in zip(batch, label.cpu().numpy()):
-                    uid = datum.uid
+                for uid, l in zip(batch.uid, label.cpu().numpy()):
                     ans = train_tuple.dataset.answer_table.id2ans(l)
                     uid2ans[uid] = ans
             if i == iters:
                 break
 
-        print("The valid loss is %0.4f" % (total_loss / len(eval_ld)))
+        total_loss, num_batches = all_reduce_sum(
+            torch.tensor([total_loss, num_batches], dtype=torch.float64, device=args.device)).tolist()
+        print("The valid loss is %0.4f" % (total_loss / num_batches))
         losses_str = "The losses are "
         # for name, loss in zip(LOSSES_NAME, total_losses / len(eval_ld)):
         #    losses_str += "%s: %0.4f " % (name, loss)
         # print(losses_str)
 
         if args.task_qa:
-            eval_tuple.evaluator.evaluate(uid2ans, pprint=True)
+            eval_tuple.evaluator.evaluate(gather_answers(uid2ans), pprint=True)
 
-        return total_loss / len(eval_ld)
+        return total_loss / num_batches
 
     def save(self, name):
-        os.makedirs(args.output, exist_ok=True)
-        torch.save(self.model.state_dict(),
-                   os.path.join(args.output, "%s_LXRT.pth" % name))
+        # the unwrapped model: the same checkpoints with and without torchrun
+        if is_main_process():
+            os.makedirs(args.output, exist_ok=True)
+            torch.save(unwrap(self.model).state_dict(),
+                       os.path.join(args.output, "%s_LXRT.pth" % name))
 
     def load(self, path):
         print("Load BERT extractor from %s" % path)
@@ -674,6 +775,7 @@ class LXMERT:
 
 
 if __name__ == "__main__":
-    lxmert = LXMERT(max_seq_length=20)
+    lxmert = LXMERT(max_seq_length=MAX_SEQ_LENGTH)
 
     lxmert.train(train_tuple, valid_tuple)
+    cleanup()
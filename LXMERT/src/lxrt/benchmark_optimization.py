@@ -0,0 +1,113 @@
+# coding=utf-8
+"""Compare the step time of BertAdam with the multi-tensor step and of the BertAdam before it,
+which updated the parameters one by one, on the parameters of an LXRT model.
+
+Usage (from the LXMERT folder):
+
+    python -m src.lxrt.benchmark_optimization --steps 20 --llayers 9 --xlayers 5 --rlayers 5
+
+The layer counts and the other model options are those of src.parameters. Both optimizers must
+leave the same parameters.
+"""
+
+import argparse
+import sys
+import time
+
+import torch
+
+from src.lxrt.optimization import SCHEDULES, BertAdam
+
+
+class ReferenceBertAdam(BertAdam):
+    """BertAdam.step as it was: a loop over the parameters, the schedule evaluated for each one."""
+
+    def step(self, closure=None):
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad = p.grad.data
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['next_m'] = torch.zeros_like(p.data)
+                    state['next_v'] = torch.zeros_like(p.data)
+
+                next_m, next_v = state['next_m'], state['next_v']
+                beta1, beta2 = group['b1'], group['b2']
+                next_m.mul_(beta1).add_(grad, alpha=1 - beta1)
+                next_v.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                update = next_m / (next_v.sqrt() + group['e'])
+                if group['weight_decay'] > 0.0:
+                    update += group['weight_decay'] * p.data
+
+                if group['t_total'] != -1:
+                    schedule_fct = SCHEDULES[group['schedule']]
+                    progress = state['step']/group['t_total']
+                    lr_scheduled = group['lr'] * schedule_fct(progress, group['warmup'])
+                else:
+                    lr_scheduled = group['lr']
+
+                update_with_lr = lr_scheduled * update
+                p.data.add_(-update_with_lr)
+                state['step'] += 1
+
+
+def build_params(vocab_size, device):
+    # the model options (--llayers, ...) are parsed by src.parameters on import
+    from src.lxrt.entry import set_visual_config
+    from src.lxrt.modeling import BertConfig, LXRTModel
+    from src.parameters import args
+    set_visual_config(args)
+    return [p.detach().to(device) for p in LXRTModel(BertConfig(vocab_size)).parameters()]
+
+
+def time_steps(optimizer_class, params, grads, args):
+    """Seconds per step of ``optimizer_class`` on copies of ``params``, and the parameters after
+    the steps."""
+    params = [torch.nn.Parameter(p.clone()) for p in params]
+    for p, grad in zip(params, grads):
+        p.grad = grad
+    optimizer = optimizer_class(params, lr=1e-4, warmup=0.1, t_total=args.steps)
+    optimizer.step()  # state initialization
+    synchronize(params[0].device)
+    start_time = time.time()
+    for _ in range(args.steps):
+        optimizer.step()
+    synchronize(params[0].device)
+    return (time.time() - start_time) / args.steps, params
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vocab_size', type=int, default=30522)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args, model_args = parser.parse_known_args()
+    # leave the model options to src.parameters
+    sys.argv = sys.argv[:1] + model_args
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    params = build_params(args.vocab_size, device)
+    grads = [torch.randn_like(p) * 1e-2 for p in params]
+    print('%d parameter tensors, %.1fM parameters on %s'
+          % (len(params), sum(p.numel() for p in params) / 1e6, device))
+
+    reference_time, expected = time_steps(ReferenceBertAdam, params, grads, args)
+    print('%-28s %8.2f ms/step' % ('reference', reference_time * 1e3))
+    step_time, result = time_steps(BertAdam, params, grads, args)
+    max_diff = max((p - q).abs().max().item() for p, q in zip(expected, result))
+    assert max_diff <= 1e-6, 'BertAdam leaves other parameters than the reference (%g)' % max_diff
+    print('%-28s %8.2f ms/step, speedup %.1fx, max difference %g'
+          % ('multi-tensor', step_time * 1e3, reference_time / step_time, max_diff))
@@ -0,0 +1,108 @@
+# coding=utf-8
+"""Compare the tokens/sec of the BertTokenizer before the word piece tries and
+the word cache with tokenize and tokenize_batch, on the PathVQA questions.
+
+Usage (from the LXMERT folder):
+
+    python -m src.lxrt.benchmark_tokenization --qas data/pvqa/qas/train_vqa.pkl
+
+Every tokenizer must give the same tokens as the reference.
+"""
+
+import argparse
+import pickle
+import time
+
+from src.lxrt.tokenization import BertTokenizer, whitespace_tokenize
+
+
+def reference_tokenize(tokenizer, text):
+    """BertTokenizer.tokenize as it was: character by character cleaning and the
+    greedy longest-match word pieces built with "".join."""
+    if not tokenizer.do_basic_tokenize:
+        return reference_wordpieces(tokenizer.wordpiece_tokenizer, text)
+    basic = tokenizer.basic_tokenizer
+    split_tokens = []
+    for token in reference_split_words(basic, text):
+        if basic.do_lower_case and token not in basic.never_split:
+            token = basic._run_strip_accents(token.lower())
+        split_tokens.extend(basic._run_split_on_punc(token))
+    return reference_wordpieces(tokenizer.wordpiece_tokenizer, " ".join(split_tokens))
+
+
+def reference_split_words(basic, text):
+    """BasicTokenizer.split_words as it was, every text cleaned character by character."""
+    return whitespace_tokenize(basic._tokenize_chinese_chars(basic._clean_text(text)))
+
+
+def reference_wordpieces(wordpiece, text):
+    """WordpieceTokenizer.tokenize as it was, the candidate pieces built with "".join."""
+    output_tokens = []
+    for token in whitespace_tokenize(text):
+        chars = list(token)
+        if len(chars) > wordpiece.max_input_chars_per_word:
+            output_tokens.append(wordpiece.unk_token)
+            continue
+        is_bad = False
+        start = 0
+        sub_tokens = []
+        while start < len(chars):
+            end = len(chars)
+            cur_substr = None
+            while start < end:
+                substr = "".join(chars[start:end])
+                if start > 0:
+                    substr = "##" + substr
+                if substr in wordpiece.vocab:
+                    cur_substr = substr
+                    break
+                end -= 1
+            if cur_substr is None:
+                is_bad = True
+                break
+            sub_tokens.append(cur_substr)
+            start = end
+        output_tokens.extend([wordpiece.unk_token] if is_bad else sub_tokens)
+    return output_tokens
+
+
+def time_fn(fn, repeat):
+    result = fn()
+    start_time = time.time()
+    for _ in range(repeat):
+        fn()
+    return result, (time.time() - start_time) / repeat
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--qas', type=str, nargs='+', default=['data/pvqa/qas/train_vqa.pkl'],
+                        help='PathVQA qas files of the LXMERT format (a list of dicts with "sent")')
+    parser.add_argument('--vocab', type=str, default='bert-base-uncased',
+                        help='pretrained model name or vocabulary file')
+    parser.add_argument('--repeat', type=int, default=3)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    sents = []
+    for path in args.qas:
+        sents.extend(datum['sent'] for datum in pickle.load(open(path, 'rb')))
+    print('%d questions, %d distinct' % (len(sents), len(set(sents))))
+
+    reference = BertTokenizer.from_pretrained(args.vocab, do_lower_case=True)
+    expected, reference_time = time_fn(lambda: [reference_tokenize(reference, sent) for sent in sents],
+                                       args.repeat)
+    num_tokens = sum(len(tokens) for tokens in expected)
+    print('%-34s %10.0f tokens/sec' % ('reference', num_tokens / reference_time))
+
+    uncached = BertTokenizer.from_pretrained(args.vocab, do_lower_case=True, cache_size=0)
+    cached = BertTokenizer.from_pretrained(args.vocab, do_lower_case=True)
+    for name, fn in (('tokenize, tries only', lambda: [uncached.tokenize(sent) for sent in sents]),
+                     ('tokenize, tries and word cache', lambda: [cached.tokenize(sent) for sent in sents]),
+                     ('tokenize_batch', lambda: cached.tokenize_batch(sents))):
+        tokens, seconds = time_fn(fn, args.repeat)
+        assert tokens == expected, '%s gives other tokens than the reference' % name
+        print('%-34s %10.0f tokens/sec, speedup %.1fx'
+              % (name, num_tokens / seconds, reference_time / seconds))
@@ -3,6 +3,7 @@
 
 import os
 
+import numpy as np
 import torch
 import torch.nn as nn
 
@@ -24,8 +25,7 @@ def convert_sents_to_features(sents, max_seq_length, tokenizer):
     """Loads a data file into a list of `InputBatch`s."""
 
     features = []
-    for (i, sent) in enumerate(sents):
-        tokens_a = tokenizer.tokenize(sent.strip())
+    for (i, tokens_a) in enumerate(tokenizer.tokenize_batch([sent.strip() for sent in sents])):
 
         # Account for [CLS] and [SEP] with "- 2"
         if len(tokens_a) > max_seq_length - 2:
@@ -58,6 +58,14 @@ def convert_sents_to_features(sents, max_seq_length, tokenizer):
     return features
 
 
+def convert_sents_to_ids(sents, max_seq_length, tokenizer):
+    """The zero padded input_ids of every sentence as one [len(sents), max_seq_length] int64
+    array, e.g. to tokenize a dataset once. LXRTEncoder takes them instead of the sentences;
+    the input mask is ``input_ids != 0`` ([PAD]) and the segment ids are zeros."""
+    features = convert_sents_to_features(sents, max_seq_length, tokenizer)
+    return np.array([f.input_ids for f in features], dtype=np.int64).reshape(len(sents), max_seq_length)
+
+
 def set_visual_config(args):
     VISUAL_CONFIG.l_layers = args.llayers
     VISUAL_CONFIG.x_layers = args.xlayers
@@ -93,17 +101,27 @@ class LXRTEncoder(nn.Module):
     def dim(self):
         return 768
 
-    def forward(self, sents, feats, visual_attention_mask=None):
-        train_features = convert_sents_to_features(
-            sents, self.max_seq_length, self.tokenizer)
-
-        input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long).cuda()
-        input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long).cuda()
-        segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long).cuda()
+    def forward(self, sents, feats, visual_attention_mask=None, visual_index=None):
+        """sents is a list of strings, or their pre-tokenized [batch, max_seq_length] input_ids
+        (see convert_sents_to_ids)."""
+        # the device of the visual features, a GPU or the CPU of a gloo process
+        device = feats[0].device
+        if torch.is_tensor(sents):
+            input_ids = sents.to(device, non_blocking=True)
+            input_mask = (input_ids != 0).long()
+            segment_ids = torch.zeros_like(input_ids)
+        else:
+            train_features = convert_sents_to_features(
+                sents, self.max_seq_length, self.tokenizer)
+
+            input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long).to(device)
+            input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long).to(device)
+            segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long).to(device)
 
         output = self.model(input_ids, segment_ids, input_mask,
                             visual_feats=feats,
-                            visual_attention_mask=visual_attention_mask)
+                            visual_attention_mask=visual_attention_mask,
+                            visual_index=visual_index)
         return output
 
     def save(self, path):
@@ -544,9 +544,12 @@ class LXRTEncoder(nn.Module):
         )
 
     def forward(self, lang_feats, lang_attention_mask,
-                visn_feats, visn_attention_mask=None, t='vqa'):
+                visn_feats, visn_attention_mask=None, t='vqa', visual_index=None):
 
         # t in ('vqa', 'qa_woi', 'va')
+        # visual_index: image row of every sentence when the images of the
+        # batch are shared by several sentences; the visual layers run once
+        # per image and the cross-modality layers once per sentence.
         # Run visual embedding layer
         # Note: Word embedding layer was executed outside this module.
         #       Keep this design to allow loading BERT weights.
@@ -560,12 +563,19 @@ class LXRTEncoder(nn.Module):
         if t == 'qa_woi':
             for layer_module in self.l_add_layers:
                 lang_feats = layer_module(lang_feats, lang_attention_mask)
+            if visual_index is not None:
+                visn_feats = visn_feats[visual_index]
             return lang_feats, visn_feats
 
         # Run relational layers
         for layer_module in self.r_layers:
             visn_feats = layer_module(visn_feats, visn_attention_mask)
 
+        if visual_index is not None:
+            visn_feats = visn_feats[visual_index]
+            if visn_attention_mask is not None:
+                visn_attention_mask = visn_attention_mask[visual_index]
+
         if t == 'va2':
             return lang_feats, visn_feats
 
@@ -888,7 +898,7 @@ class LXRTModel(BertPreTrainedModel):
         self.apply(self.init_bert_weights)
 
     def forward(self, input_ids, token_type_ids=None, attention_mask=None,
-                visual_feats=None, visual_attention_mask=None, t='vqa'):
+                visual_feats=None, visual_attention_mask=None, t='vqa', visual_index=None):
         # t in ('vqa', 'va', 'qa_woi')
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
@@ -931,7 +941,8 @@ class LXRTModel(BertPreTrainedModel):
             embedding_output,
             extended_attention_mask,
             visn_feats=visual_feats,
-            visn_attention_mask=extended_visual_attention_mask, t=t)
+            visn_attention_mask=extended_visual_attention_mask, t=t,
+            visual_index=visual_index)
         # print('lang_feats.shape = ', lang_feats.shape, '; visn_feats.shape = ', visn_feats.shape)
 
         if t == 'qa_woi':
@@ -1178,12 +1189,12 @@ class LXRTFeatureExtraction(BertPreTrainedModel):
         self.apply(self.init_bert_weights)
 
     def forward(self, input_ids, token_type_ids=None, attention_mask=None, visual_feats=None,
-                visual_attention_mask=None):
+                visual_attention_mask=None, visual_index=None):
         t = 'qa_woi' if args.qa_bl else 'vqa'
         feat_seq, pooled_output = self.bert(input_ids, token_type_ids, attention_mask,
                                             visual_feats=visual_feats,
                                             visual_attention_mask=visual_attention_mask,
-                                            t=t)
+                                            t=t, visual_index=visual_index)
         if 'x' == self.mode:
             return pooled_output
         elif 'x' in self.mode and ('l' in self.mode or 'r' in self.mode):
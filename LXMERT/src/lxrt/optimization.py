@@ -12,7 +12,7 @@ logger = logging.getLogger(__name__)
 def warmup_cosine(x, warmup=0.002):
     if x < warmup:
         return x/warmup
-    return 0.5 * (1.0 + torch.cos(math.pi * x))
+    return 0.5 * (1.0 + math.cos(math.pi * x))
 
 def warmup_constant(x, warmup=0.002):
     """ Linearly increases learning rate over `warmup`*`t_total` (as provided to BertAdam) training steps.
@@ -28,6 +28,9 @@ def warmup_linear(x, warmup=0.002):
         return x/warmup
     return max((x-1.)/(warmup-1.), 0)
 
+# Elements of the parameters updated by one multi-tensor op, bounds the temporary update lists
+MULTI_TENSOR_CHUNK = 2 ** 25
+
 SCHEDULES = {
     'warmup_cosine':   warmup_cosine,
     'warmup_constant': warmup_constant,
@@ -48,6 +51,13 @@ class BertAdam(Optimizer):
         e: Adams epsilon. Default: 1e-6
         weight_decay: Weight decay. Default: 0.01
         max_grad_norm: Maximum norm for the gradients (-1 means no clipping). Default: 1.0
+
+    The moments of the parameters of a group are views of two flat buffers per device and dtype,
+    and a step updates the parameters with the same step count together with the multi-tensor
+    torch._foreach_* ops (MULTI_TENSOR_CHUNK elements at a time), computing the learning rate
+    schedule once for them. The buffers are allocated for every parameter of the group on the first
+    step, also for frozen ones that never get a gradient, whose moments the per-parameter step
+    never created.
     """
     def __init__(self, params, lr=required, warmup=-1, t_total=-1, schedule='warmup_linear',
                  b1=0.9, b2=0.999, e=1e-6, weight_decay=0.01,
@@ -68,6 +78,8 @@ class BertAdam(Optimizer):
                         b1=b1, b2=b2, e=e, weight_decay=weight_decay,
                         max_grad_norm=max_grad_norm)
         super(BertAdam, self).__init__(params, defaults)
+        # (group index, device, dtype) -> (flat next_m, flat next_v, offset of every parameter)
+        self._flat_buffers = {}
 
     def get_lr(self):
         lr = []
@@ -76,14 +88,60 @@ class BertAdam(Optimizer):
                 state = self.state[p]
                 if len(state) == 0:
                     return [0]
-                if group['t_total'] != -1:
-                    schedule_fct = SCHEDULES[group['schedule']]
-                    lr_scheduled = group['lr'] * schedule_fct(state['step']/group['t_total'], group['warmup'])
-                else:
-                    lr_scheduled = group['lr']
-                lr.append(lr_scheduled)
+                lr.append(self._scheduled_lr(group, state['step']))
         return lr
 
+    @staticmethod
+    def _scheduled_lr(group, step):
+        if group['t_total'] == -1:
+            return group['lr']
+        schedule_fct = SCHEDULES[group['schedule']]
+        return group['lr'] * schedule_fct(step/group['t_total'], group['warmup'])
+
+    def load_state_dict(self, state_dict):
+        super(BertAdam, self).load_state_dict(state_dict)
+        # the loaded moments are copied into new flat buffers at the next step
+        self._flat_buffers = {}
+
+    def _init_state(self, group_index, group, p):
+        """State of a parameter updated for the first time, its moments are views of the flat
+        buffers of its group, device and dtype."""
+        key = (group_index, p.device, p.dtype)
+        if key not in self._flat_buffers:
+            params = [q for q in group['params'] if q.device == p.device and q.dtype == p.dtype]
+            offsets = {}
+            numel = 0
+            for q in params:
+                offsets[q] = numel
+                numel += q.numel()
+            flat_m = torch.zeros(numel, device=p.device, dtype=p.dtype)
+            flat_v = torch.zeros(numel, device=p.device, dtype=p.dtype)
+            self._flat_buffers[key] = flat_m, flat_v, offsets
+            # moments of a loaded state_dict move into the buffers
+            for q in params:
+                state = self.state[q]
+                if len(state) > 0:
+                    self._bind_moments(key, q, state)
+        state = self.state[p]
+        if len(state) == 0:
+            state['step'] = 0
+            # Exponential moving averages of gradient and squared gradient values
+            state['next_m'] = None
+            state['next_v'] = None
+            self._bind_moments(key, p, state)
+        return state
+
+    def _bind_moments(self, key, p, state):
+        flat_m, flat_v, offsets = self._flat_buffers[key]
+        offset = offsets[p]
+        next_m = flat_m[offset:offset + p.numel()].view_as(p)
+        next_v = flat_v[offset:offset + p.numel()].view_as(p)
+        if state['next_m'] is not None:
+            next_m.copy_(state['next_m'])
+            next_v.copy_(state['next_v'])
+        state['next_m'], state['next_v'] = next_m, next_v
+
+    @torch.no_grad()
     def step(self, closure=None):
         """Performs a single optimization step.
 
@@ -93,56 +151,40 @@ class BertAdam(Optimizer):
         """
         loss = None
         if closure is not None:
-            loss = closure()
+            with torch.enable_grad():
+                loss = closure()
 
         warned_for_t_total = False
 
-        for group in self.param_groups:
+        for group_index, group in enumerate(self.param_groups):
+            # parameters with a gradient, by step count (parameters without gradients in
+            # some steps fall behind): chunks of params, grads, next_m, next_v
+            by_step = {}
             for p in group['params']:
                 if p.grad is None:
                     continue
-                grad = p.grad.data
+                grad = p.grad
                 if grad.is_sparse:
                     raise RuntimeError('Adam does not support sparse gradients, please consider SparseAdam instead')
 
                 state = self.state[p]
+                if len(state) == 0 or (group_index, p.device, p.dtype) not in self._flat_buffers:
+                    state = self._init_state(group_index, group, p)
+                chunks = by_step.setdefault(state['step'], [])
+                if not chunks or chunks[-1][4] + p.numel() > MULTI_TENSOR_CHUNK:
+                    chunks.append([[], [], [], [], 0])
+                chunk = chunks[-1]
+                chunk[0].append(p)
+                chunk[1].append(grad)
+                chunk[2].append(state['next_m'])
+                chunk[3].append(state['next_v'])
+                chunk[4] += p.numel()
+                state['step'] += 1
 
-                # State initialization
-                if len(state) == 0:
-                    state['step'] = 0
-                    # Exponential moving average of gradient values
-                    state['next_m'] = torch.zeros_like(p.data)
-                    # Exponential moving average of squared gradient values
-                    state['next_v'] = torch.zeros_like(p.data)
-
-                next_m, next_v = state['next_m'], state['next_v']
-                beta1, beta2 = group['b1'], group['b2']
-
-                # LXRT: grad is clipped outside.
-                # Add grad clipping
-                # if group['max_grad_norm'] > 0:
-                #     clip_grad_norm_(p, group['max_grad_norm'])
-
-                # Decay the first and second moment running average coefficient
-                # In-place operations to update the averages at the same time
-                next_m.mul_(beta1).add_(1 - beta1, grad)
-                next_v.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-                update = next_m / (next_v.sqrt() + group['e'])
-
-                # Just adding the square of the weights to the loss function is *not*
-                # the correct way of using L2 regularization/weight decay with Adam,
-                # since that will interact with the m and v parameters in strange ways.
-                #
-                # Instead we want to decay the weights in a manner that doesn't interact
-                # with the m/v parameters. This is equivalent to adding the square
-                # of the weights to the loss with plain (non-momentum) SGD.
-                if group['weight_decay'] > 0.0:
-                    update += group['weight_decay'] * p.data
-
+            for step, chunks in by_step.items():
+                lr_scheduled = self._scheduled_lr(group, step)
                 if group['t_total'] != -1:
-                    schedule_fct = SCHEDULES[group['schedule']]
-                    progress = state['step']/group['t_total']
-                    lr_scheduled = group['lr'] * schedule_fct(progress, group['warmup'])
+                    progress = step/group['t_total']
                     # warning for exceeding t_total (only active with warmup_linear
                     if group['schedule'] == "warmup_linear" and progress > 1. and not warned_for_t_total:
                         logger.warning(
@@ -150,17 +192,41 @@ class BertAdam(Optimizer):
                             "Please set 't_total' of {} correctly.".format(group['schedule'], lr_scheduled, self.__class__.__name__))
                         warned_for_t_total = True
                     # end warning
-                else:
-                    lr_scheduled = group['lr']
-
-                update_with_lr = lr_scheduled * update
-                p.data.add_(-update_with_lr)
-
-                state['step'] += 1
-
-                # step_size = lr_scheduled * math.sqrt(bias_correction2) / bias_correction1
-                # No bias correction
-                # bias_correction1 = 1 - beta1 ** state['step']
-                # bias_correction2 = 1 - beta2 ** state['step']
+                for params, grads, next_m, next_v, _ in chunks:
+                    self._update(group, lr_scheduled, params, grads, next_m, next_v)
 
         return loss
+
+    @staticmethod
+    def _update(group, lr_scheduled, params, grads, next_m, next_v):
+        beta1, beta2 = group['b1'], group['b2']
+        # LXRT: grad is clipped outside.
+
+        # Decay the first and second moment running average coefficient
+        # In-place operations to update the averages at the same time
+        torch._foreach_mul_(next_m, beta1)
+        torch._foreach_add_(next_m, grads, alpha=1 - beta1)
+        torch._foreach_mul_(next_v, beta2)
+        torch._foreach_addcmul_(next_v, grads, grads, value=1 - beta2)
+        denom = torch._foreach_sqrt(next_v)
+        torch._foreach_add_(denom, group['e'])
+        update = torch._foreach_div(next_m, denom)
+        del denom
+
+        # Just adding the square of the weights to the loss function is *not*
+        # the correct way of using L2 regularization/weight decay with Adam,
+        # since that will interact with the m and v parameters in strange ways.
+        #
+        # Instead we want to decay the weights in a manner that doesn't interact
+        # with the m/v parameters. This is equivalent to adding the square
+        # of the weights to the loss with plain (non-momentum) SGD.
+        if group['weight_decay'] > 0.0:
+            torch._foreach_add_(update, torch._foreach_mul(params, group['weight_decay']))
+
+        torch._foreach_mul_(update, lr_scheduled)
+        torch._foreach_sub_(params, update)
+
+        # step_size = lr_scheduled * math.sqrt(bias_correction2) / bias_correction1
+        # No bias correction
+        # bias_correction1 = 1 - beta1 ** state['step']
+        # bias_correction2 = 1 - beta2 ** state['step']
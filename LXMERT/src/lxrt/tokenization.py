@@ -47,6 +47,12 @@ def load_vocab(vocab_file):
     return vocab
 
 
+# _clean_text for ASCII text: drops the control characters, tab, newline and carriage
+# return become spaces
+_ASCII_CLEAN_TABLE = {cp: None for cp in list(range(32)) + [127]}
+_ASCII_CLEAN_TABLE.update({ord("\t"): " ", ord("\n"): " ", ord("\r"): " "})
+
+
 def whitespace_tokenize(text):
     """Runs basic whitespace cleaning and splitting on a piece of text."""
     text = text.strip()
@@ -60,7 +66,7 @@ class BertTokenizer(object):
     """Runs end-to-end tokenization: punctuation splitting + wordpiece"""
 
     def __init__(self, vocab_file, do_lower_case=True, max_len=None, do_basic_tokenize=True,
-                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]")):
+                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]"), cache_size=65536):
         """Constructs a BertTokenizer.
 
         Args:
@@ -74,6 +80,7 @@ class BertTokenizer(object):
                          sequence length.
           never_split: List of tokens which will never be split during tokenization.
                          Only has an effect when do_wordpiece_only=False
+          cache_size: Number of words whose word pieces are kept in an LRU cache, 0 disables it.
         """
         if not os.path.isfile(vocab_file):
             raise ValueError(
@@ -88,17 +95,46 @@ class BertTokenizer(object):
                                                 never_split=never_split)
         self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
         self.max_len = max_len if max_len is not None else int(1e12)
+        # whitespace separated word -> its word pieces, most recently used last
+        self.cache_size = cache_size
+        self.word_cache = collections.OrderedDict()
 
     def tokenize(self, text):
         if self.do_basic_tokenize:
           split_tokens = []
-          for token in self.basic_tokenizer.tokenize(text):
-              for sub_token in self.wordpiece_tokenizer.tokenize(token):
-                  split_tokens.append(sub_token)
+          for word in self.basic_tokenizer.split_words(text):
+              split_tokens.extend(self._tokenize_word(word))
         else:
           split_tokens = self.wordpiece_tokenizer.tokenize(text)
         return split_tokens
 
+    def tokenize_batch(self, texts):
+        """Tokenizes a list of texts, like ``[self.tokenize(text) for text in texts]``.
+
+        Repeated texts are only tokenized once; every text still gets its own list.
+        """
+        unique = {}
+        for text in texts:
+            if text not in unique:
+                unique[text] = self.tokenize(text)
+        return [list(unique[text]) for text in texts]
+
+    def _tokenize_word(self, word):
+        """The word pieces of one whitespace separated word of a cleaned text."""
+        pieces = self.word_cache.get(word)
+        if pieces is not None:
+            self.word_cache.move_to_end(word)
+            return pieces
+        pieces = []
+        for token in self.basic_tokenizer.tokenize_word(word):
+            pieces.extend(self.wordpiece_tokenizer.tokenize_token(token))
+        pieces = tuple(pieces)
+        if self.cache_size > 0:
+            self.word_cache[word] = pieces
+            if len(self.word_cache) > self.cache_size:
+                self.word_cache.popitem(last=False)
+        return pieces
+
     def convert_tokens_to_ids(self, tokens):
         """Converts a sequence of tokens into ids using the vocab."""
         ids = []
@@ -174,24 +210,35 @@ class BasicTokenizer(object):
 
     def tokenize(self, text):
         """Tokenizes a piece of text."""
-        text = self._clean_text(text)
-        # This was added on November 1st, 2018 for the multilingual and Chinese
-        # models. This is also applied to the English models now, but it doesn't
-        # matter since the English models were not trained on any Chinese data
-        # and generally don't have any Chinese data in them (there are Chinese
-        # characters in the vocabulary because Wikipedia does have some Chinese
-        # words in the English Wikipedia.).
-        text = self._tokenize_chinese_chars(text)
-        orig_tokens = whitespace_tokenize(text)
         split_tokens = []
-        for token in orig_tokens:
-            if self.do_lower_case and token not in self.never_split:
-                token = token.lower()
-                token = self._run_strip_accents(token)
-            split_tokens.extend(self._run_split_on_punc(token))
+        for token in self.split_words(text):
+            split_tokens.extend(self.tokenize_word(token))
+        return split_tokens
 
-        output_tokens = whitespace_tokenize(" ".join(split_tokens))
-        return output_tokens
+    def split_words(self, text):
+        """Cleans a piece of text and splits it on whitespace, the part of tokenize that
+        depends on the whole text."""
+        if text.isascii():
+            # what _clean_text does to ASCII, there are no CJK characters
+            text = text.translate(_ASCII_CLEAN_TABLE)
+        else:
+            text = self._clean_text(text)
+            # This was added on November 1st, 2018 for the multilingual and Chinese
+            # models. This is also applied to the English models now, but it doesn't
+            # matter since the English models were not trained on any Chinese data
+            # and generally don't have any Chinese data in them (there are Chinese
+            # characters in the vocabulary because Wikipedia does have some Chinese
+            # words in the English Wikipedia.).
+            text = self._tokenize_chinese_chars(text)
+        return whitespace_tokenize(text)
+
+    def tokenize_word(self, token):
+        """Lower cases, strips the accents of and splits the punctuation off one word of
+        split_words."""
+        if self.do_lower_case and token not in self.never_split:
+            token = token.lower()
+            token = self._run_strip_accents(token)
+        return whitespace_tokenize(" ".join(self._run_split_on_punc(token)))
 
     def _run_strip_accents(self, text):
         """Strips accents from a piece of text."""
@@ -282,6 +329,14 @@ class WordpieceTokenizer(object):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
+        # character tries of the word pieces, for the first piece of a word and for the
+        # "##" pieces continuing it; a None key marks the end of a piece
+        self.trie = {}
+        self.continuation_trie = {}
+        for piece in vocab:
+            _trie_insert(self.trie, piece)
+            if piece.startswith("##") and len(piece) > 2:
+                _trie_insert(self.continuation_trie, piece[2:])
 
     def tokenize(self, text):
         """Tokenizes a piece of text into its word pieces.
@@ -303,36 +358,40 @@ class WordpieceTokenizer(object):
 
         output_tokens = []
         for token in whitespace_tokenize(text):
-            chars = list(token)
-            if len(chars) > self.max_input_chars_per_word:
-                output_tokens.append(self.unk_token)
-                continue
+            output_tokens.extend(self.tokenize_token(token))
+        return output_tokens
 
-            is_bad = False
-            start = 0
-            sub_tokens = []
-            while start < len(chars):
-                end = len(chars)
-                cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
-                        break
-                    end -= 1
-                if cur_substr is None:
-                    is_bad = True
+    def tokenize_token(self, token):
+        """The word pieces of a single token: the longest piece in the vocabulary at every
+        position, found by walking the tries."""
+        if len(token) > self.max_input_chars_per_word:
+            return [self.unk_token]
+
+        sub_tokens = []
+        start = 0
+        trie = self.trie
+        while start < len(token):
+            node = trie
+            end = None
+            for i in range(start, len(token)):
+                node = node.get(token[i])
+                if node is None:
                     break
-                sub_tokens.append(cur_substr)
-                start = end
-
-            if is_bad:
-                output_tokens.append(self.unk_token)
-            else:
-                output_tokens.extend(sub_tokens)
-        return output_tokens
+                if None in node:
+                    end = i + 1
+            if end is None:
+                return [self.unk_token]
+            sub_tokens.append(token[start:end] if start == 0 else "##" + token[start:end])
+            start = end
+            trie = self.continuation_trie
+        return sub_tokens
+
+
+def _trie_insert(trie, piece):
+    node = trie
+    for char in piece:
+        node = node.setdefault(char, {})
+    node[None] = True
 
 
 def _is_whitespace(char):
@@ -106,8 +106,28 @@ def parse_args():
     parser.add_argument("--objMaskRate", dest='obj_mask_rate', default=0.15, type=float)
 
     # Training configuration
-    parser.add_argument("--multiGPU", action='store_const', default=False, const=True)
+    parser.add_argument("--multiGPU", action='store_const', default=False, const=True,
+                        help='Deprecated: launch with torchrun --nproc_per_node N to train on N GPUs')
+    parser.add_argument("--backend", dest='backend', type=str, default=None, choices=['nccl', 'gloo'],
+                        help='Process group backend of a torchrun launch, nccl on GPUs and gloo on CPUs by default')
     parser.add_argument("--numWorkers", dest='num_workers', type=int, default=0)
+    parser.add_argument("--decodeWorkers", dest='decode_workers', type=int, default=0,
+                        help='Number of processes decoding the feature tsv files, 0 decodes serially')
+    parser.add_argument("--maxChunkMB", dest='max_chunk_mb', type=int, default=256,
+                        help='Ceiling on the decoded megabytes of a chunk of images, and on the tsv megabytes the '
+                             'decode workers read ahead of it')
+    parser.add_argument("--featBackend", dest='feat_backend', type=str, default='auto',
+                        choices=['auto', 'tsv', 'ram', 'memmap', 'hdf5'],
+                        help='Where the pvqa features are read from, auto picks a converted store when there is one')
+    parser.add_argument("--buildFeatStore", dest='build_feat_store', action='store_const', default=False, const=True,
+                        help='Stream PathVQA feature tsv files into a memory-mapped feature store '
+                             'the first time they are loaded')
+    parser.add_argument("--groupImages", dest='group_images', action='store_const', default=False, const=True,
+                        help='Batch the evaluated questions of an image together and run the visual layers '
+                             'once per image')
+    parser.add_argument("--checkBoxes", dest='check_boxes', action='store_const', default=False, const=True,
+                        help='Debug: check the boxes and features of every sample again when it is loaded; '
+                             'the boxes are always normalized and checked once when the dataset is built')
 
     # Parse the arguments.
     args = parser.parse_args()
@@ -3,12 +3,14 @@ from collections import defaultdict
 import json
 import random
 
-import numpy as np
 from torch.utils.data import Dataset
 
 from src.pretrain.qa_answer_table import AnswerTable
 from src.utils import load_obj_tsv
 from src.parameters import args
+from pvqa_features import FeatureStoreWriter, SharedMemoryFeatureWriter, open_features, share_features, store_exists, \
+    store_prefix
+from pvqa_features.tsv import split_of
 
 TINY_IMG_NUM = 500
 FAST_IMG_NUM = 5000
@@ -107,19 +109,32 @@ class LXMERTTorchDataset(Dataset):
         elif args.fast:
             topk = FAST_IMG_NUM
 
-        # Load the dataset
-        img_data = []
+        # Load the dataset into one feature backend shared by the DataLoader workers
+        img_features = []
         for source in self.raw_dataset.sources:
-            img_data.extend(load_obj_tsv(Split2ImgFeatPath[source], topk))
-
-        self.imgid2img = {}
-        for img_datum in img_data:
-            self.imgid2img[img_datum['img_id']] = img_datum
+            fname = Split2ImgFeatPath[source]
+            if args.build_feat_store and 'pvqa' in fname and not store_exists(store_prefix(fname)):
+                # decode chunk by chunk straight into the store, then memory-map it
+                with FeatureStoreWriter(store_prefix(fname), split_of(fname)) as writer:
+                    load_obj_tsv(fname, sink=writer.add_datum, max_chunk_bytes=args.max_chunk_mb * 2 ** 20,
+                                 num_workers=args.decode_workers)
+            if 'pvqa' in fname and topk in (None, -1):
+                features = open_features(fname, args.feat_backend, args.decode_workers)
+            else:
+                # decoded into shared memory, object and attribute labels are kept as extras
+                with SharedMemoryFeatureWriter() as writer:
+                    load_obj_tsv(fname, topk, sink=writer.add_datum, max_chunk_bytes=args.max_chunk_mb * 2 ** 20,
+                                 num_workers=args.decode_workers)
+                features = writer.features
+            img_features.append(features)
+        self.img_features = share_features(img_features)
+        # normalized to 0 ~ 1 and range checked once, the samples slice views of it
+        self.boxes = self.img_features.normalized_boxes()
 
         # Filter out the dataset
         used_data = []
         for datum in self.raw_dataset.data:
-            if datum['img_id'] in self.imgid2img:
+            if datum['img_id'] in self.img_features:
                 used_data.append(datum)
 
         # Flatten the dataset (into one sent + one image entries)
@@ -155,8 +170,8 @@ class LXMERTTorchDataset(Dataset):
         """Get a random obj feat from the dataset."""
         datum = self.data[random.randint(0, len(self.data) - 1)]
         img_id = datum['img_id']
-        img_info = self.imgid2img[img_id]
-        feat = img_info['features'][random.randint(0, 35)]
+        idx = self.img_features.img_id2idx[img_id]
+        feat = self.img_features.get_features(idx)[random.randint(0, 35)]
         return feat
 
     def __getitem__(self, item: int):
@@ -165,24 +180,16 @@ class LXMERTTorchDataset(Dataset):
         uid = datum['uid']
         img_id = datum['img_id']
 
-        # Get image info
-        img_info = self.imgid2img[img_id]
-        obj_num = img_info['num_boxes']
-        feats = img_info['features'].copy()
-        boxes = img_info['boxes'].copy()
-        obj_labels = img_info['objects_id'].copy() if 'objects_id' in img_info else None
-        obj_confs = img_info['objects_conf'].copy() if 'objects_conf' in img_info else None
-        attr_labels = img_info['attrs_id'].copy() if 'attrs_id' in img_info else None
-        attr_confs = img_info['attrs_conf'].copy() if 'attrs_conf' in img_info else None
-        assert obj_num == len(boxes) == len(feats)
-
-        # Normalize the boxes (to 0 ~ 1)
-        img_h, img_w = img_info['img_h'], img_info['img_w']
-        boxes = boxes.copy()
-        boxes[:, (0, 2)] /= img_w
-        boxes[:, (1, 3)] /= img_h
-        np.testing.assert_array_less(boxes, 1 + 1e-5)
-        np.testing.assert_array_less(-boxes, 0 + 1e-5)
+        # Get image info, views of the shared features and the normalized boxes
+        idx = self.img_features.img_id2idx[img_id]
+        feats = self.img_features.get_features(idx)
+        boxes = self.boxes[self.img_features.offsets[idx]:self.img_features.offsets[idx + 1]]
+        extras = self.img_features.get_extras(idx)
+        obj_labels, obj_confs = extras.get('objects_id'), extras.get('objects_conf')
+        attr_labels, attr_confs = extras.get('attrs_id'), extras.get('attrs_conf')
+        if args.check_boxes:
+            assert self.img_features.num_boxes[idx] == len(boxes) == len(feats)
+            self.img_features.check_normalized_boxes(idx, boxes)
 
         # If calculating the matched loss, replace the sentence with an sentence
         # corresponding to other image.
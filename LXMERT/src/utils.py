@@ -1,59 +1,146 @@
 # coding=utf-8
 
 
+import os
 import sys
 import csv
 import base64
+import itertools
 import time
-import pandas as pd
 
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from pvqa_features import FeatureStore, store_exists, store_prefix
+from pvqa_features.parallel import iter_parallel
+from pvqa_features.tsv import iter_tsv
+
 csv.field_size_limit(int(sys.maxsize/10000000000))
+# Default ceiling on the decoded bytes of one chunk of images
+MAX_CHUNK_BYTES = 256 * 2 ** 20
 FIELDNAMES = ["img_id", "img_h", "img_w", "objects_id", "objects_conf",
               "attrs_id", "attrs_conf", "num_boxes", "boxes", "features"]
 
 
-def load_obj_tsv(fname, topk=None):
+def _decode_obj_item(item):
+    for key in ['img_h', 'img_w', 'num_boxes']:
+        item[key] = int(item[key])
+
+    boxes = item['num_boxes']
+    decode_config = [
+        ('objects_id', (boxes,), np.int64),
+        ('objects_conf', (boxes,), np.float32),
+        ('attrs_id', (boxes,), np.int64),
+        ('attrs_conf', (boxes,), np.float32),
+        ('boxes', (boxes, 4), np.float32),
+        ('features', (boxes, -1), np.float32),
+    ]
+    for key, shape, dtype in decode_config:
+        item[key] = np.frombuffer(base64.b64decode(item[key]), dtype=dtype)
+        item[key] = item[key].reshape(shape)
+        item[key].setflags(write=False)
+    return item
+
+
+def _decode_obj_line(line):
+    return _decode_obj_item(dict(zip(FIELDNAMES, line.split('\t'))))
+
+
+def _item_nbytes(item):
+    return sum(v.nbytes for v in item.values() if isinstance(v, np.ndarray))
+
+
+def _chunked(items, chunk_size, max_chunk_bytes=None):
+    chunk, chunk_bytes = [], 0
+    for item in items:
+        item_bytes = _item_nbytes(item)
+        # hand out the chunk before the item would take it over the ceiling
+        if chunk and max_chunk_bytes is not None and chunk_bytes + item_bytes > max_chunk_bytes:
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(item)
+        chunk_bytes += item_bytes
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk, chunk_bytes = [], 0
+    if chunk:
+        yield chunk
+
+
+def _iter_obj_items(fname, num_workers=0, max_pending_bytes=MAX_CHUNK_BYTES):
+    if 'pvqa' in fname:
+        yield from iter_tsv(fname, split=_pvqa_split(fname), num_workers=num_workers,
+                            max_pending_bytes=max_pending_bytes)
+        return
+    if num_workers > 0:
+        yield from iter_parallel(fname, _decode_obj_line, num_workers, max_pending_bytes)
+        return
+    with open(fname) as f:
+        for item in csv.DictReader(f, FIELDNAMES, delimiter="\t"):
+            yield _decode_obj_item(item)
+
+
+def iter_obj_tsv(fname, topk=None, chunk_size=1000, max_chunk_bytes=MAX_CHUNK_BYTES, num_workers=0):
+    """Decode object features from a tsv file, one chunk of images at a time.
+
+    The file is read line by line and only the current chunk is held in
+    memory, so memory use does not grow with the size of the file.
+
+    :param fname: The path to the tsv file.
+    :param topk: Only decode the top K images (lines), -1 or None for all.
+    :param chunk_size: Maximum number of images per chunk.
+    :param max_chunk_bytes: Ceiling on the decoded bytes of a chunk (None for
+        no ceiling); a chunk is handed out before the next image would go over
+        it. An image larger than the ceiling forms a chunk of its own. With
+        decoding processes it also bounds the tsv bytes they decode ahead of
+        the chunks (see iter_parallel), so the two take at most twice as much.
+    :param num_workers: Decode with this many processes (0 decodes in the
+        calling process). The order of the images is kept.
+    :return: A generator of lists of image feature dicts (see load_obj_tsv).
+    """
+    if topk is not None and topk < 0:
+        topk = None
+    # islice stops pulling lines once topk images are decoded
+    items = itertools.islice(_iter_obj_items(fname, num_workers, max_chunk_bytes), topk)
+    return _chunked(items, chunk_size, max_chunk_bytes)
+
+
+def load_obj_tsv(fname, topk=None, sink=None, chunk_size=1000, max_chunk_bytes=MAX_CHUNK_BYTES, num_workers=0):
     """Load object features from tsv file.
 
     :param fname: The path to the tsv file.
     :param topk: Only load features for top K images (lines) in the tsv file.
         Will load all the features if topk is either -1 or None.
+    :param sink: Optional callable receiving every decoded image dict (e.g.
+        FeatureStoreWriter.add_datum or SharedMemoryFeatureWriter.add_datum).
+        Images handed to the sink are not kept, so the memory use is bounded
+        by one chunk.
+    :param chunk_size: Number of images decoded per chunk, see iter_obj_tsv.
+    :param max_chunk_bytes: Memory ceiling of one chunk, see iter_obj_tsv.
+    :param num_workers: Number of decoding processes, see iter_obj_tsv.
     :return: A list of image object features where each feature is a dict.
-        See FILENAMES above for the keys in the feature dict.
+        See FILENAMES above for the keys in the feature dict. If a sink is
+        given the list is empty.
     """
     if 'pvqa' in fname:
-        return pvqa_load_tsv(fname)
+        return pvqa_load_tsv(fname, topk, num_workers, sink, chunk_size, max_chunk_bytes)
+    return _load_chunks(fname, topk, sink, chunk_size, max_chunk_bytes, num_workers)
+
+
+def _load_chunks(fname, topk, sink, chunk_size, max_chunk_bytes, num_workers):
     data = []
+    count = 0
     start_time = time.time()
     print("Start to load Faster-RCNN detected objects from %s" % fname)
-    with open(fname) as f:
-        reader = csv.DictReader(f, FIELDNAMES, delimiter="\t")
-        for i, item in enumerate(reader):
-
-            for key in ['img_h', 'img_w', 'num_boxes']:
-                item[key] = int(item[key])
-
-            boxes = item['num_boxes']
-            decode_config = [
-                ('objects_id', (boxes,), np.int64),
-                ('objects_conf', (boxes,), np.float32),
-                ('attrs_id', (boxes,), np.int64),
-                ('attrs_conf', (boxes,), np.float32),
-                ('boxes', (boxes, 4), np.float32),
-                ('features', (boxes, -1), np.float32),
-            ]
-            for key, shape, dtype in decode_config:
-                item[key] = np.frombuffer(base64.b64decode(item[key]), dtype=dtype)
-                item[key] = item[key].reshape(shape)
-                item[key].setflags(write=False)
-
-            data.append(item)
-            if topk is not None and len(data) == topk:
-                break
+    for chunk in iter_obj_tsv(fname, topk, chunk_size, max_chunk_bytes, num_workers):
+        count += len(chunk)
+        if sink is not None:
+            for item in chunk:
+                sink(item)
+        else:
+            data.extend(chunk)
     elapsed_time = time.time() - start_time
-    print("Loaded %d images in file %s in %d seconds." % (len(data), fname, elapsed_time))
+    print("Loaded %d images in file %s in %d seconds." % (count, fname, elapsed_time))
     return data
 
 
@@ -64,35 +151,28 @@ FIELDNAMES = ["img_id", "img_h", "img_w", "objects_id", "objects_conf",
 pvqa_FIELDNAMES = ['image_id', 'image_w', 'image_h', 'num_boxes', 'boxes', 'features']
 
 
-def pvqa_load_tsv(fname: str):
-    start_time = time.time()
-    print("Start to load Faster-RCNN detected objects from %s" % fname)
-    df = pd.read_csv(fname, delimiter='\t', names=pvqa_FIELDNAMES)
-
+def _pvqa_split(fname):
     split = None
     for s in ('train', 'test', 'val'):
         if s in fname:
             split = s
-
-    data = []
-    for i in range(df.shape[0]):
-        datum = {}
-        datum['img_id'] = '%s_%04d' % (split, df['image_id'][i])
-        datum['img_w'] = df['image_w'][i]
-        datum['img_h'] = df['image_h'][i]
-        datum['num_boxes'] = df['num_boxes'][i]
-
-        boxes = df['boxes'][i]
-        buf = base64.b64decode(boxes[1:])
-        temp = np.frombuffer(buf, dtype=np.float64).astype(np.float32)
-        datum['boxes'] = temp.reshape(datum['num_boxes'], -1)
-
-        features = df['features'][i]
-        buf = base64.b64decode(features[1:])
-        temp = np.frombuffer(buf, dtype=np.float32)
-        datum['features'] = temp.reshape(datum['num_boxes'], -1)
-
-        data.append(datum)
-    elapsed_time = time.time() - start_time
-    print("Loaded %d images in file %s in %d seconds." % (len(data), fname, elapsed_time))
-    return data
+    return split
+
+
+def pvqa_load_tsv(fname: str, topk=None, num_workers=0, sink=None, chunk_size=1000,
+                  max_chunk_bytes=MAX_CHUNK_BYTES):
+    """load_obj_tsv of the PathVQA feature files, which reads the feature store
+    instead when there is one."""
+    if topk is not None and topk < 0:
+        topk = None
+    if store_exists(store_prefix(fname)):
+        # boxes and features of each datum are lazy memmap slices
+        store = FeatureStore(store_prefix(fname))
+        num_images = len(store) if topk is None else min(topk, len(store))
+        data = (store.datum(i) for i in range(num_images))
+        if sink is None:
+            return list(data)
+        for datum in data:
+            sink(datum)
+        return []
+    return _load_chunks(fname, topk, sink, chunk_size, max_chunk_bytes, num_workers)
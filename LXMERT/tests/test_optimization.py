@@ -0,0 +1,133 @@
+"""BertAdam against the per-parameter step it replaced (run from the LXMERT folder with
+``python -m pytest tests``)."""
+
+import copy
+import os
+import sys
+import unittest
+from unittest import mock
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from src.lxrt import optimization
+from src.lxrt.benchmark_optimization import ReferenceBertAdam
+from src.lxrt.optimization import BertAdam
+
+SHAPES = [(3, 4), (7,), (5, 5), (2,), (6, 3)]
+
+
+def make_params(seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return [torch.nn.Parameter(torch.randn(shape, generator=generator)) for shape in SHAPES]
+
+
+def param_groups(params):
+    # the biases without weight decay, as in the LXMERT scripts
+    return [{'params': params[:3]},
+            {'params': params[3:], 'weight_decay': 0.0}]
+
+
+def set_grads(params, step, skipped=()):
+    generator = torch.Generator().manual_seed(1000 + step)
+    for i, p in enumerate(params):
+        grad = torch.randn(p.shape, generator=generator)
+        p.grad = None if i in skipped else grad
+
+
+def skipped_at(step):
+    # parameters without a gradient in some steps fall behind the others
+    return {(step + i) % len(SHAPES) for i in range(step % 3)}
+
+
+class BertAdamTest(unittest.TestCase):
+
+    def run_both(self, num_steps, reload_at=None, reload_into=None, **kwargs):
+        results = []
+        for optimizer_class in (ReferenceBertAdam, BertAdam):
+            params = make_params()
+            optimizer = optimizer_class(param_groups(params), **kwargs)
+            lrs = []
+            for step in range(num_steps):
+                if step == reload_at:
+                    # continue with new parameters and optimizer from the saved state
+                    state_dict = optimizer.state_dict()
+                    params = [torch.nn.Parameter(p.detach().clone()) for p in params]
+                    optimizer = optimizer_class(param_groups(params), **kwargs)
+                    optimizer.load_state_dict(state_dict)
+                if step == reload_into:
+                    # load a saved state into an optimizer that has stepped already
+                    state_dict = copy.deepcopy(optimizer.state_dict())
+                    saved = [p.detach().clone() for p in params]
+                    set_grads(params, step, skipped_at(step))
+                    optimizer.step()
+                    optimizer.load_state_dict(state_dict)
+                    with torch.no_grad():
+                        for p, q in zip(params, saved):
+                            p.copy_(q)
+                set_grads(params, step, skipped_at(step))
+                optimizer.step()
+                lrs.append(optimizer.get_lr())
+            results.append((params, lrs, optimizer))
+        return results
+
+    def assert_same(self, expected, result):
+        self.assert_params_close(expected, result)
+        expected_lrs, lrs = expected[1], result[1]
+        self.assertEqual(len(lrs), len(expected_lrs))
+        for lr, expected_lr in zip(lrs, expected_lrs):
+            self.assertEqual(len(lr), len(expected_lr))
+            for a, b in zip(lr, expected_lr):
+                self.assertAlmostEqual(a, b, places=12)
+
+    def test_schedules(self):
+        for schedule in optimization.SCHEDULES:
+            with self.subTest(schedule=schedule):
+                self.assert_same(*self.run_both(10, lr=1e-2, warmup=0.2, t_total=8, schedule=schedule))
+
+    def test_constant_lr(self):
+        self.assert_same(*self.run_both(6, lr=1e-2))
+
+    def test_multi_tensor_chunks(self):
+        # chunks smaller than some parameters
+        with mock.patch.object(optimization, 'MULTI_TENSOR_CHUNK', 20):
+            self.assert_same(*self.run_both(6, lr=1e-2, warmup=0.1, t_total=10))
+
+    def test_state_dict_round_trip(self):
+        expected = self.run_both(10, lr=1e-2, warmup=0.1, t_total=10)[1]
+        for reload in ('reload_at', 'reload_into'):
+            with self.subTest(reload=reload):
+                results = self.run_both(10, lr=1e-2, warmup=0.1, t_total=10, **{reload: 5})
+                self.assert_same(*results)
+                self.assert_params_close(expected, results[1])
+                self.assert_moments_bound(results[1][2])
+
+    def assert_params_close(self, expected, result):
+        for p, q in zip(expected[0], result[0]):
+            torch.testing.assert_close(q, p, rtol=1e-6, atol=1e-7)
+
+    def assert_moments_bound(self, optimizer):
+        # the loaded moments are views of the new flat buffers again
+        for group_index, group in enumerate(optimizer.param_groups):
+            for p in group['params']:
+                flat_m, flat_v, offsets = optimizer._flat_buffers[(group_index, p.device, p.dtype)]
+                state = optimizer.state[p]
+                self.assertEqual(state['next_m'].data_ptr(),
+                                 flat_m.data_ptr() + offsets[p] * flat_m.element_size())
+                self.assertEqual(state['next_v'].data_ptr(),
+                                 flat_v.data_ptr() + offsets[p] * flat_v.element_size())
+
+    def test_frozen_parameters(self):
+        params = make_params()
+        optimizer = BertAdam(param_groups(params), lr=1e-2)
+        frozen = params[1]
+        before = frozen.detach().clone()
+        for step in range(3):
+            set_grads(params, step, skipped={1})
+            optimizer.step()
+        self.assertTrue(torch.equal(frozen, before))
+        self.assertEqual(len(optimizer.state[frozen]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""BertTokenizer with the word piece tries and the word cache against the tokenizer before them
+(run from the LXMERT folder with ``python -m pytest tests``)."""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from src.lxrt.benchmark_tokenization import reference_split_words, reference_tokenize, reference_wordpieces
+from src.lxrt.tokenization import BertTokenizer, whitespace_tokenize
+
+SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+WORDS = ["what", "is", "the", "in", "this", "image", "of", "un", "aff", "able", "cell", "cells", "tumor",
+         "a", "b", "c", "e", "é", "É", "u", "ü", "中", "文", "fi", "ﬁ", "?", ".", ",", "-", "'", "(", ")"]
+PIECES = ["##s", "##aff", "##able", "##ul", "##ar", "##a", "##b", "##c", "##e", "##é", "##ü", "##fi",
+          "##ﬁ", "##abl", "##le", "##ll"]
+
+# control characters, accents (precomposed, combining and upper case), CJK, a ligature and the
+# unicode spaces and replacement character _clean_text handles
+ALPHABET = ([chr(i) for i in range(128)] +
+            list("éüÉǗ̈中文字ﬁ 　​�\x85"))
+TEXTS = ["", " ", "what is in this image?", "Unaffable CELLS, unaffable cells.",
+         "what\tis\nthe\rtumor\x00\x07 of\x7fthe cell", "Éü café naïve é ü",
+         "中文 中文字 a中b", "[MASK] is [UNK] the [mask] [SEP]x", "cell" * 30, "un" + "aff" * 40,
+         "�​ ﬁ ##aff ## #"]
+
+
+def random_texts(count, seed=0):
+    rng = random.Random(seed)
+    tokens = WORDS + [piece[2:] for piece in PIECES] + SPECIAL_TOKENS
+    texts = []
+    for _ in range(count):
+        parts = []
+        for _ in range(rng.randint(0, 8)):
+            if rng.random() < 0.5:
+                parts.append(rng.choice(tokens))
+            else:
+                parts.append("".join(rng.choice(ALPHABET) for _ in range(rng.randint(1, 6))))
+        texts.append(rng.choice(["", " ", "\t"]).join(parts))
+    return texts
+
+
+class TokenizationTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.vocab_file = os.path.join(cls.tmpdir, "vocab.txt")
+        with open(cls.vocab_file, "w", encoding="utf-8") as f:
+            f.write("\n".join(SPECIAL_TOKENS + WORDS + PIECES) + "\n")
+        cls.texts = TEXTS + random_texts(2000)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def tokenizers(self):
+        for do_lower_case in (True, False):
+            for do_basic_tokenize in (True, False):
+                # a cache smaller than the distinct words evicts
+                for cache_size in (0, 16, 65536):
+                    options = dict(do_lower_case=do_lower_case, do_basic_tokenize=do_basic_tokenize,
+                                   cache_size=cache_size)
+                    yield options, BertTokenizer(self.vocab_file, **options)
+
+    def test_tokenize(self):
+        for options, tokenizer in self.tokenizers():
+            with self.subTest(**options):
+                for text in self.texts:
+                    self.assertEqual(tokenizer.tokenize(text), reference_tokenize(tokenizer, text), repr(text))
+                self.assertLessEqual(len(tokenizer.word_cache), tokenizer.cache_size)
+
+    def test_split_words(self):
+        for do_lower_case in (True, False):
+            basic = BertTokenizer(self.vocab_file, do_lower_case=do_lower_case).basic_tokenizer
+            for text in self.texts:
+                self.assertEqual(basic.split_words(text), reference_split_words(basic, text), repr(text))
+
+    def test_tokenize_token(self):
+        wordpiece = BertTokenizer(self.vocab_file).wordpiece_tokenizer
+        tokens = {token for text in self.texts for token in whitespace_tokenize(text)}
+        # "##" pieces and pieces that only exist as a continuation
+        tokens.update(PIECES + ["##", "aff", "ulaff", "cellsable", "tumors", "fiﬁ"])
+        for token in sorted(tokens):
+            self.assertEqual(wordpiece.tokenize_token(token), reference_wordpieces(wordpiece, token), repr(token))
+
+    def test_never_split(self):
+        tokenizer = BertTokenizer(self.vocab_file)
+        # only the upper case token is kept whole, "[mask]" is split at the brackets
+        self.assertEqual(tokenizer.tokenize("[MASK] what [mask]"), ["[MASK]", "what", "[UNK]", "[UNK]", "[UNK]"])
+        tokenizer = BertTokenizer(self.vocab_file, never_split=())
+        self.assertEqual(tokenizer.tokenize("[MASK]"), reference_tokenize(tokenizer, "[MASK]"))
+
+    def test_tokenize_batch(self):
+        texts = self.texts[:200] * 2
+        for options, tokenizer in self.tokenizers():
+            with self.subTest(**options):
+                result = tokenizer.tokenize_batch(texts)
+                self.assertEqual(result, [reference_tokenize(tokenizer, text) for text in texts])
+        # a separate list for every text, also for repeated ones
+        result = tokenizer.tokenize_batch(["what is", "what is"])
+        result[0].append("the")
+        self.assertEqual(result[1], ["what", "is"])
+
+
+if __name__ == '__main__':
+    unittest.main()
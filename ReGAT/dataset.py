@@ -232,9 +232,67 @@ def _find_coco_id(vgv, vgv_id):
     return None
 
 
+def _get_image(dset, image):
+    """Return features, normalized_bb, bb and the two adj matrices of an image.
+
+    Reads from dset.h5_images when the features are loaded lazily, otherwise
+    indexes the in-memory tensors of the dataset. With precomputed position
+    embeddings (dset.h5_pos_emb) the embedding of the image is returned in
+    place of bb, which is only used to compute it.
+    """
+    if dset.h5_images is not None:
+        rows = dset.h5_images[image]
+        features = torch.from_numpy(rows['image_features'])
+        normalized_bb = torch.from_numpy(rows['spatial_features'])
+        bb = torch.from_numpy(rows['image_bb'])
+        if 'image_adj_matrix' in rows:
+            spatial_adj_matrix = torch.from_numpy(
+                utils.adj_labels(rows['image_adj_matrix']))
+        else:
+            spatial_adj_matrix = torch.zeros(1, dtype=torch.uint8)
+        if 'semantic_adj_matrix' in rows:
+            semantic_adj_matrix = torch.from_numpy(
+                utils.adj_labels(rows['semantic_adj_matrix']))
+        else:
+            semantic_adj_matrix = torch.zeros(1, dtype=torch.uint8)
+    else:
+        if dset.spatial_adj_matrix is not None:
+            spatial_adj_matrix = dset.spatial_adj_matrix[image]
+        else:
+            spatial_adj_matrix = torch.zeros(1, dtype=torch.uint8)
+        if dset.semantic_adj_matrix is not None:
+            semantic_adj_matrix = dset.semantic_adj_matrix[image]
+        else:
+            semantic_adj_matrix = torch.zeros(1, dtype=torch.uint8)
+        if not dset.adaptive:
+            # fixed number of bounding boxes
+            features = dset.features[image]
+            normalized_bb = dset.normalized_bb[image]
+            bb = dset.bb[image]
+        else:
+            start, end = dset.pos_boxes[image]
+            features = dset.features[start:end, :]
+            normalized_bb = dset.normalized_bb[start:end, :]
+            bb = dset.bb[start:end, :]
+    if dset.h5_pos_emb is not None:
+        bb = torch.from_numpy(dset.h5_pos_emb[image]['image_pos_emb'])
+    return features, normalized_bb, bb, spatial_adj_matrix,\
+        semantic_adj_matrix
+
+
 class VQAFeatureDataset(Dataset):
     def __init__(self, name, dictionary, relation_type, dataroot='data',
-                 adaptive=False, pos_emb_dim=64, nongt_dim=36):
+                 adaptive=False, pos_emb_dim=64, nongt_dim=36,
+                 lazy=False, cache_size=512, prefetch=0,
+                 precomputed_pos_emb=False):
+        """
+        lazy: read the features of an image from the h5 file only when it
+        is requested (see utils.H5ImageReader) instead of loading the whole
+        file, cache_size and prefetch are passed on to the reader.
+        precomputed_pos_emb: serve the implicit position embeddings written
+        into the h5 file by tools/build_position_embedding.py instead of
+        the boxes they are computed from.
+        """
         super(VQAFeatureDataset, self).__init__()
         assert name in ['train', 'val', 'test-dev2015', 'test2015']
 
@@ -264,31 +322,60 @@ class VQAFeatureDataset(Dataset):
                                (name, '' if self.adaptive else prefix))
 
         print('loading features from h5 file %s' % h5_path)
+        self.h5_images = None
         with h5py.File(h5_path, 'r') as hf:
-            self.features = np.array(hf.get('image_features'))
-            self.normalized_bb = np.array(hf.get('spatial_features'))
-            self.bb = np.array(hf.get('image_bb'))
+            adj_keys = []
             if "semantic_adj_matrix" in hf.keys() \
                and self.relation_type == "semantic":
-                self.semantic_adj_matrix = np.array(
-                                        hf.get('semantic_adj_matrix'))
-                print("Loaded semantic adj matrix from file...",
-                      self.semantic_adj_matrix.shape)
-            else:
-                self.semantic_adj_matrix = None
-                print("Setting semantic adj matrix to None...")
+                adj_keys.append('semantic_adj_matrix')
             if "image_adj_matrix" in hf.keys()\
                and self.relation_type == "spatial":
-                self.spatial_adj_matrix = np.array(hf.get('image_adj_matrix'))
-                print("Loaded spatial adj matrix from file...",
-                      self.spatial_adj_matrix.shape)
-            else:
-                self.spatial_adj_matrix = None
-                print("Setting spatial adj matrix to None...")
+                adj_keys.append('image_adj_matrix')
 
             self.pos_boxes = None
             if self.adaptive:
                 self.pos_boxes = np.array(hf.get('pos_boxes'))
+
+            if lazy:
+                self.features = None
+                self.normalized_bb = None
+                self.bb = None
+                self.semantic_adj_matrix = None
+                self.spatial_adj_matrix = None
+            else:
+                self.features = np.array(hf.get('image_features'))
+                self.normalized_bb = np.array(hf.get('spatial_features'))
+                self.bb = np.array(hf.get('image_bb'))
+                if 'semantic_adj_matrix' in adj_keys:
+                    self.semantic_adj_matrix = utils.read_adj_matrix(
+                                            hf['semantic_adj_matrix'])
+                    print("Loaded semantic adj matrix from file...",
+                          self.semantic_adj_matrix.shape)
+                else:
+                    self.semantic_adj_matrix = None
+                    print("Setting semantic adj matrix to None...")
+                if 'image_adj_matrix' in adj_keys:
+                    self.spatial_adj_matrix = utils.read_adj_matrix(
+                                            hf['image_adj_matrix'])
+                    print("Loaded spatial adj matrix from file...",
+                          self.spatial_adj_matrix.shape)
+                else:
+                    self.spatial_adj_matrix = None
+                    print("Setting spatial adj matrix to None...")
+        if lazy:
+            self.h5_images = utils.H5ImageReader(
+                h5_path, ['image_features', 'spatial_features', 'image_bb'],
+                adj_keys, pos_boxes=self.pos_boxes, cache_size=cache_size,
+                prefetch=prefetch)
+            print("Reading features of %d images lazily (adj matrices: %s)"
+                  % (len(self.h5_images), ', '.join(adj_keys) or 'none'))
+        self.h5_pos_emb = None
+        if precomputed_pos_emb and self.relation_type != "semantic":
+            self.h5_pos_emb = utils.pos_emb_reader(
+                h5_path, nongt_dim, pos_emb_dim, cache_size=cache_size,
+                prefetch=prefetch)
+            print("Reading precomputed position embeddings from %s"
+                  % h5_path)
         self.entries = _load_dataset(dataroot, name, self.img_id2idx,
                                      self.label2ans)
         self.tokenize()
@@ -296,8 +383,12 @@ class VQAFeatureDataset(Dataset):
         self.tensorize()
         self.nongt_dim = nongt_dim
         self.emb_dim = pos_emb_dim
-        self.v_dim = self.features.size(1 if self.adaptive else 2)
-        self.s_dim = self.normalized_bb.size(1 if self.adaptive else 2)
+        if self.h5_images is not None:
+            self.v_dim = self.h5_images.shapes['image_features'][-1]
+            self.s_dim = self.h5_images.shapes['spatial_features'][-1]
+        else:
+            self.v_dim = self.features.size(1 if self.adaptive else 2)
+            self.s_dim = self.normalized_bb.size(1 if self.adaptive else 2)
 
     def tokenize(self, max_length=14):
         """Tokenizes the questions.
@@ -317,15 +408,16 @@ class VQAFeatureDataset(Dataset):
             entry['q_token'] = tokens
 
     def tensorize(self):
-        self.features = torch.from_numpy(self.features)
-        self.normalized_bb = torch.from_numpy(self.normalized_bb)
-        self.bb = torch.from_numpy(self.bb)
+        if self.h5_images is None:
+            self.features = torch.from_numpy(self.features)
+            self.normalized_bb = torch.from_numpy(self.normalized_bb)
+            self.bb = torch.from_numpy(self.bb)
         if self.semantic_adj_matrix is not None:
             self.semantic_adj_matrix = torch.from_numpy(
-                                        self.semantic_adj_matrix).double()
+                                        self.semantic_adj_matrix)
         if self.spatial_adj_matrix is not None:
             self.spatial_adj_matrix = torch.from_numpy(
-                                        self.spatial_adj_matrix).double()
+                                        self.spatial_adj_matrix)
         if self.pos_boxes is not None:
             self.pos_boxes = torch.from_numpy(self.pos_boxes)
 
@@ -353,29 +445,8 @@ class VQAFeatureDataset(Dataset):
 
         question = entry['q_token']
         question_id = entry['question_id']
-        if self.spatial_adj_matrix is not None:
-            spatial_adj_matrix = self.spatial_adj_matrix[entry["image"]]
-        else:
-            spatial_adj_matrix = torch.zeros(1).double()
-        if self.semantic_adj_matrix is not None:
-            semantic_adj_matrix = self.semantic_adj_matrix[entry["image"]]
-        else:
-            semantic_adj_matrix = torch.zeros(1).double()
-        if not self.adaptive:
-            # fixed number of bounding boxes
-            features = self.features[entry['image']]
-            normalized_bb = self.normalized_bb[entry['image']]
-            bb = self.bb[entry["image"]]
-        else:
-            features = self.features[
-                self.pos_boxes[
-                    entry['image']][0]:self.pos_boxes[entry['image']][1], :]
-            normalized_bb = self.normalized_bb[
-                self.pos_boxes[
-                    entry['image']][0]:self.pos_boxes[entry['image']][1], :]
-            bb = self.bb[
-                self.pos_boxes[
-                    entry['image']][0]:self.pos_boxes[entry['image']][1], :]
+        features, normalized_bb, bb, spatial_adj_matrix, \
+            semantic_adj_matrix = _get_image(self, entry['image'])
 
         answer = entry['answer']
         if answer is not None:
@@ -401,7 +472,8 @@ class VisualGenomeFeatureDataset(Dataset):
     def __init__(self, name, features, normalized_bb, bb,
                  spatial_adj_matrix, semantic_adj_matrix, dictionary,
                  relation_type, dataroot='data', adaptive=False,
-                 pos_boxes=None, pos_emb_dim=64):
+                 pos_boxes=None, pos_emb_dim=64, h5_images=None,
+                 h5_pos_emb=None):
         super(VisualGenomeFeatureDataset, self).__init__()
         # do not use test split images!
         assert name in ['train', 'val']
@@ -426,6 +498,9 @@ class VisualGenomeFeatureDataset(Dataset):
         self.normalized_bb = normalized_bb
         self.spatial_adj_matrix = spatial_adj_matrix
         self.semantic_adj_matrix = semantic_adj_matrix
+        # utils.H5ImageReader of a lazy VQAFeatureDataset
+        self.h5_images = h5_images
+        self.h5_pos_emb = h5_pos_emb
 
         if self.adaptive:
             self.pos_boxes = pos_boxes
@@ -436,8 +511,12 @@ class VisualGenomeFeatureDataset(Dataset):
         self.tokenize()
         self.tensorize()
         self.emb_dim = pos_emb_dim
-        self.v_dim = self.features.size(1 if self.adaptive else 2)
-        self.s_dim = self.normalized_bb.size(1 if self.adaptive else 2)
+        if self.h5_images is not None:
+            self.v_dim = self.h5_images.shapes['image_features'][-1]
+            self.s_dim = self.h5_images.shapes['spatial_features'][-1]
+        else:
+            self.v_dim = self.features.size(1 if self.adaptive else 2)
+            self.s_dim = self.normalized_bb.size(1 if self.adaptive else 2)
 
     def tokenize(self, max_length=14):
         """Tokenizes the questions.
@@ -480,27 +559,8 @@ class VisualGenomeFeatureDataset(Dataset):
         question = entry['q_token']
         question_id = entry['question_id']
         answer = entry['answer']
-        if self.spatial_adj_matrix is not None:
-            spatial_adj_matrix = self.spatial_adj_matrix[entry["image"]]
-        else:
-            spatial_adj_matrix = torch.zeros(1).double()
-        if self.semantic_adj_matrix is not None:
-            semantic_adj_matrix = self.semantic_adj_matrix[entry["image"]]
-        else:
-            semantic_adj_matrix = torch.zeros(1).double()
-        if self.adaptive:
-            features = self.features[
-                self.pos_boxes[
-                    entry['image']][0]:self.pos_boxes[entry['image']][1], :]
-            normalized_bb = self.normalized_bb[
-                self.pos_boxes[
-                    entry['image']][0]:self.pos_boxes[entry['image']][1], :]
-            bb = self.bb[self.pos_boxes[
-                entry['image']][0]:self.pos_boxes[entry['image']][1], :]
-        else:
-            features = self.features[entry['image']]
-            normalized_bb = self.normalized_bb[entry['image']]
-            bb = self.bb[entry['image']]
+        features, normalized_bb, bb, spatial_adj_matrix, \
+            semantic_adj_matrix = _get_image(self, entry['image'])
 
         labels = answer['labels']
         scores = answer['scores']
@@ -95,8 +95,8 @@ class Image_Feature_Loader():
             self.bb = np.array(hf.get('image_bb'))
             if "semantic_adj_matrix" in hf.keys() \
                and self.relation_type == "semantic":
-                self.semantic_adj_matrix = np.array(
-                                            hf.get('semantic_adj_matrix'))
+                self.semantic_adj_matrix = utils.read_adj_matrix(
+                                            hf['semantic_adj_matrix'])
                 print("Loaded semantic adj matrix from file...",
                       self.semantic_adj_matrix.shape)
             else:
@@ -104,7 +104,8 @@ class Image_Feature_Loader():
                 print("Setting semantic adj matrix to None...")
             if "image_adj_matrix" in hf.keys() \
                and self.relation_type == "spatial":
-                self.spatial_adj_matrix = np.array(hf.get('image_adj_matrix'))
+                self.spatial_adj_matrix = utils.read_adj_matrix(
+                                            hf['image_adj_matrix'])
                 print("Loaded spatial adj matrix from file...",
                       self.spatial_adj_matrix.shape)
             else:
@@ -121,10 +122,10 @@ class Image_Feature_Loader():
         self.bb = torch.from_numpy(self.bb)
         if self.semantic_adj_matrix is not None:
             self.semantic_adj_matrix = torch.from_numpy(
-                                        self.semantic_adj_matrix).double()
+                                        self.semantic_adj_matrix)
         if self.spatial_adj_matrix is not None:
             self.spatial_adj_matrix = torch.from_numpy(
-                                        self.spatial_adj_matrix).double()
+                                        self.spatial_adj_matrix)
         if self.pos_boxes is not None:
             self.pos_boxes = torch.from_numpy(self.pos_boxes)
 
@@ -214,12 +215,12 @@ class VQA_cp_Dataset(Dataset):
             spatial_adj_matrix = coco_features.spatial_adj_matrix[
                                     entry["image"]]
         else:
-            spatial_adj_matrix = torch.zeros(1).double()
+            spatial_adj_matrix = torch.zeros(1, dtype=torch.uint8)
         if coco_features.semantic_adj_matrix is not None:
             semantic_adj_matrix = coco_features.semantic_adj_matrix[
                                     entry["image"]]
         else:
-            semantic_adj_matrix = torch.zeros(1).double()
+            semantic_adj_matrix = torch.zeros(1, dtype=torch.uint8)
 
         if not self.adaptive:
             # fixed number of bounding boxes
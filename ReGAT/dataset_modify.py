@@ -8,11 +8,10 @@ MIT License
 """
 from __future__ import print_function
 import os
-import base64
+import sys
 import json
 import pickle
 import numpy as np
-import pandas as pd
 import utils
 import h5py
 import torch
@@ -25,52 +24,22 @@ import re
 from sklearn.metrics import f1_score
 from nltk.translate.bleu_score import sentence_bleu
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from pvqa_features import QuestionEntries, open_features, open_questions, share_features, store_prefix
+from pvqa_features.backends import HDF5_SUFFIX
+from pvqa_features.collate import ImageSample
+from pvqa_features.targets import SparseTarget
+
 # TODO: merge dataset_cp_v2.py with dataset.py
 
 COUNTING_ONLY = False
 question_types = ('where', 'what', 'how', 'how many/how much', 'when', 'why', 'who/whose', 'other', 'yes/no')
-FIELDNAMES = ['image_id', 'image_w', 'image_h', 'num_boxes', 'boxes', 'features']
-
-
-def load_tsv(split: str, args = ''):
-    tsv_file = 'data/pvqa/images/%s%s.csv' % (split, args)
-    df = pd.read_csv(tsv_file, delimiter='\t', names=FIELDNAMES)
-
-    data = []
-    for i in range(df.shape[0]):
-        datum = {}
-        datum['img_id'] = '%s_%04d' % (split, df['image_id'][i])
-        datum['img_w'] = df['image_w'][i]
-        datum['img_h'] = df['image_h'][i]
-        datum['num_boxes'] = df['num_boxes'][i]
-
-        boxes = df['boxes'][i]
-        buf = base64.b64decode(boxes[1:])
-        temp = np.frombuffer(buf, dtype=np.float64).astype(np.float32)
-        datum['boxes'] = temp.reshape(datum['num_boxes'], -1)
-
-        features = df['features'][i]
-        buf = base64.b64decode(features[1:])
-        temp = np.frombuffer(buf, dtype=np.float32)
-        datum['features'] = temp.reshape(datum['num_boxes'], -1)
-
-        data.append(datum)
-
-    return data
-
 def is_ans_valid(ans):
     if ans in ('yes', 'no'):
         return 0
     else:
         return 1
 
-def normalize_bbox(im_w, im_h, bbox):
-    bbox = bbox.copy()
-    bbox[:, 0] /= im_w
-    bbox[:, 1] /= im_h
-    bbox[:, 2] /= im_w
-    bbox[:, 3] /= im_h
-    return bbox 
 
 def _load_dataset_pvqa(dataroot, name, imd_id2val, label2ans, ans2label):
     vqa = pickle.load(open(os.path.join(dataroot, 'qas/%s_vqa.pkl' % name), 'rb'))
@@ -324,9 +293,67 @@ def _find_coco_id(vgv, vgv_id):
     return None
 
 
+def _get_image(dset, image):
+    """Return features, normalized_bb, bb and the two adj matrices of an image.
+
+    Reads from dset.h5_images when the features are loaded lazily, otherwise
+    indexes the in-memory tensors of the dataset. With precomputed position
+    embeddings (dset.h5_pos_emb) the embedding of the image is returned in
+    place of bb, which is only used to compute it.
+    """
+    if dset.h5_images is not None:
+        rows = dset.h5_images[image]
+        features = torch.from_numpy(rows['image_features'])
+        normalized_bb = torch.from_numpy(rows['spatial_features'])
+        bb = torch.from_numpy(rows['image_bb'])
+        if 'image_adj_matrix' in rows:
+            spatial_adj_matrix = torch.from_numpy(
+                utils.adj_labels(rows['image_adj_matrix']))
+        else:
+            spatial_adj_matrix = torch.zeros(1, dtype=torch.uint8)
+        if 'semantic_adj_matrix' in rows:
+            semantic_adj_matrix = torch.from_numpy(
+                utils.adj_labels(rows['semantic_adj_matrix']))
+        else:
+            semantic_adj_matrix = torch.zeros(1, dtype=torch.uint8)
+    else:
+        if dset.spatial_adj_matrix is not None:
+            spatial_adj_matrix = dset.spatial_adj_matrix[image]
+        else:
+            spatial_adj_matrix = torch.zeros(1, dtype=torch.uint8)
+        if dset.semantic_adj_matrix is not None:
+            semantic_adj_matrix = dset.semantic_adj_matrix[image]
+        else:
+            semantic_adj_matrix = torch.zeros(1, dtype=torch.uint8)
+        if not dset.adaptive:
+            # fixed number of bounding boxes
+            features = dset.features[image]
+            normalized_bb = dset.normalized_bb[image]
+            bb = dset.bb[image]
+        else:
+            start, end = dset.pos_boxes[image]
+            features = dset.features[start:end, :]
+            normalized_bb = dset.normalized_bb[start:end, :]
+            bb = dset.bb[start:end, :]
+    if dset.h5_pos_emb is not None:
+        bb = torch.from_numpy(dset.h5_pos_emb[image]['image_pos_emb'])
+    return features, normalized_bb, bb, spatial_adj_matrix,\
+        semantic_adj_matrix
+
+
 class VQAFeatureDataset(Dataset):
     def __init__(self, name, dictionary, relation_type, dataroot='data',
-                 adaptive=False, pos_emb_dim=64, nongt_dim=36):
+                 adaptive=False, pos_emb_dim=64, nongt_dim=36,
+                 lazy=False, cache_size=512, prefetch=0,
+                 precomputed_pos_emb=False):
+        """
+        lazy: read the features of an image from the h5 file only when it
+        is requested (see utils.H5ImageReader) instead of loading the whole
+        file, cache_size and prefetch are passed on to the reader.
+        precomputed_pos_emb: serve the implicit position embeddings written
+        into the h5 file by tools/build_position_embedding.py instead of
+        the boxes they are computed from.
+        """
         super(VQAFeatureDataset, self).__init__()
         assert name in ['train', 'val', 'test-dev2015', 'test2015']
 
@@ -356,31 +383,60 @@ class VQAFeatureDataset(Dataset):
                                (name, '' if self.adaptive else prefix))
 
         print('loading features from h5 file %s' % h5_path)
+        self.h5_images = None
         with h5py.File(h5_path, 'r') as hf:
-            self.features = np.array(hf.get('image_features'))
-            self.normalized_bb = np.array(hf.get('spatial_features'))
-            self.bb = np.array(hf.get('image_bb'))
+            adj_keys = []
             if "semantic_adj_matrix" in hf.keys() \
                and self.relation_type == "semantic":
-                self.semantic_adj_matrix = np.array(
-                                        hf.get('semantic_adj_matrix'))
-                print("Loaded semantic adj matrix from file...",
-                      self.semantic_adj_matrix.shape)
-            else:
-                self.semantic_adj_matrix = None
-                print("Setting semantic adj matrix to None...")
+                adj_keys.append('semantic_adj_matrix')
             if "image_adj_matrix" in hf.keys()\
                and self.relation_type == "spatial":
-                self.spatial_adj_matrix = np.array(hf.get('image_adj_matrix'))
-                print("Loaded spatial adj matrix from file...",
-                      self.spatial_adj_matrix.shape)
-            else:
-                self.spatial_adj_matrix = None
-                print("Setting spatial adj matrix to None...")
+                adj_keys.append('image_adj_matrix')
 
             self.pos_boxes = None
             if self.adaptive:
                 self.pos_boxes = np.array(hf.get('pos_boxes'))
+
+            if lazy:
+                self.features = None
+                self.normalized_bb = None
+                self.bb = None
+                self.semantic_adj_matrix = None
+                self.spatial_adj_matrix = None
+            else:
+                self.features = np.array(hf.get('image_features'))
+                self.normalized_bb = np.array(hf.get('spatial_features'))
+                self.bb = np.array(hf.get('image_bb'))
+                if 'semantic_adj_matrix' in adj_keys:
+                    self.semantic_adj_matrix = utils.read_adj_matrix(
+                                            hf['semantic_adj_matrix'])
+                    print("Loaded semantic adj matrix from file...",
+                          self.semantic_adj_matrix.shape)
+                else:
+                    self.semantic_adj_matrix = None
+                    print("Setting semantic adj matrix to None...")
+                if 'image_adj_matrix' in adj_keys:
+                    self.spatial_adj_matrix = utils.read_adj_matrix(
+                                            hf['image_adj_matrix'])
+                    print("Loaded spatial adj matrix from file...",
+                          self.spatial_adj_matrix.shape)
+                else:
+                    self.spatial_adj_matrix = None
+                    print("Setting spatial adj matrix to None...")
+        if lazy:
+            self.h5_images = utils.H5ImageReader(
+                h5_path, ['image_features', 'spatial_features', 'image_bb'],
+                adj_keys, pos_boxes=self.pos_boxes, cache_size=cache_size,
+                prefetch=prefetch)
+            print("Reading features of %d images lazily (adj matrices: %s)"
+                  % (len(self.h5_images), ', '.join(adj_keys) or 'none'))
+        self.h5_pos_emb = None
+        if precomputed_pos_emb and self.relation_type != "semantic":
+            self.h5_pos_emb = utils.pos_emb_reader(
+                h5_path, nongt_dim, pos_emb_dim, cache_size=cache_size,
+                prefetch=prefetch)
+            print("Reading precomputed position embeddings from %s"
+                  % h5_path)
         self.entries = _load_dataset(dataroot, name, self.img_id2idx,
                                      self.label2ans)
         self.tokenize()
@@ -388,8 +444,12 @@ class VQAFeatureDataset(Dataset):
         self.tensorize()
         self.nongt_dim = nongt_dim
         self.emb_dim = pos_emb_dim
-        self.v_dim = self.features.size(1 if self.adaptive else 2)
-        self.s_dim = self.normalized_bb.size(1 if self.adaptive else 2)
+        if self.h5_images is not None:
+            self.v_dim = self.h5_images.shapes['image_features'][-1]
+            self.s_dim = self.h5_images.shapes['spatial_features'][-1]
+        else:
+            self.v_dim = self.features.size(1 if self.adaptive else 2)
+            self.s_dim = self.normalized_bb.size(1 if self.adaptive else 2)
 
     def tokenize(self, max_length=14):
         """Tokenizes the questions.
@@ -409,15 +469,16 @@ class VQAFeatureDataset(Dataset):
             entry['q_token'] = tokens
 
     def tensorize(self):
-        self.features = torch.from_numpy(self.features)
-        self.normalized_bb = torch.from_numpy(self.normalized_bb)
-        self.bb = torch.from_numpy(self.bb)
+        if self.h5_images is None:
+            self.features = torch.from_numpy(self.features)
+            self.normalized_bb = torch.from_numpy(self.normalized_bb)
+            self.bb = torch.from_numpy(self.bb)
         if self.semantic_adj_matrix is not None:
             self.semantic_adj_matrix = torch.from_numpy(
-                                        self.semantic_adj_matrix).double()
+                                        self.semantic_adj_matrix)
         if self.spatial_adj_matrix is not None:
             self.spatial_adj_matrix = torch.from_numpy(
-                                        self.spatial_adj_matrix).double()
+                                        self.spatial_adj_matrix)
         if self.pos_boxes is not None:
             self.pos_boxes = torch.from_numpy(self.pos_boxes)
 
@@ -445,29 +506,8 @@ class VQAFeatureDataset(Dataset):
 
         question = entry['q_token']
         question_id = entry['question_id']
-        if self.spatial_adj_matrix is not None:
-            spatial_adj_matrix = self.spatial_adj_matrix[entry["image"]]
-        else:
-            spatial_adj_matrix = torch.zeros(1).double()
-        if self.semantic_adj_matrix is not None:
-            semantic_adj_matrix = self.semantic_adj_matrix[entry["image"]]
-        else:
-            semantic_adj_matrix = torch.zeros(1).double()
-        if not self.adaptive:
-            # fixed number of bounding boxes
-            features = self.features[entry['image']]
-            normalized_bb = self.normalized_bb[entry['image']]
-            bb = self.bb[entry["image"]]
-        else:
-            features = self.features[
-                self.pos_boxes[
-                    entry['image']][0]:self.pos_boxes[entry['image']][1], :]
-            normalized_bb = self.normalized_bb[
-                self.pos_boxes[
-                    entry['image']][0]:self.pos_boxes[entry['image']][1], :]
-            bb = self.bb[
-                self.pos_boxes[
-                    entry['image']][0]:self.pos_boxes[entry['image']][1], :]
+        features, normalized_bb, bb, spatial_adj_matrix, \
+            semantic_adj_matrix = _get_image(self, entry['image'])
 
         answer = entry['answer']
         if answer is not None:
@@ -490,7 +530,7 @@ class VQAFeatureDataset(Dataset):
 
 class PVQAFeatureDataset(Dataset):
     def __init__(self, name, dictionary, relation_type, dataroot='data/pvqa', adaptive=False, img_v='',
-                pos_emb_dim = 64, nongt_dim = 36):
+                pos_emb_dim = 64, nongt_dim = 36, feat_backend='auto', precomputed_pos_emb=False):
         super(PVQAFeatureDataset, self).__init__()
         assert name in ['train', 'val', 'test']
 
@@ -504,116 +544,90 @@ class PVQAFeatureDataset(Dataset):
         self.relation_type = relation_type
         self.adaptive = False
 
-        self.img_id2idx = pickle.load(
-            open(os.path.join(dataroot, '%s_img_id2idx.pkl' % name), 'rb'))
-
-        #tsv_file = os.path.join(dataroot, 'images/%s%s.csv' % (name, img_v))
-        self.image_data = load_tsv(name)
-        self.features = np.array([datum['features'] for datum in self.image_data])
-        self.spatials = np.array([datum['boxes'] for datum in self.image_data])
-        self.img_w = np.array([datum['img_w'] for datum in self.image_data])
-        self.img_h = np.array([datum['img_h'] for datum in self.image_data])
+        img_id2idx_path = os.path.join(dataroot, '%s_img_id2idx.pkl' % name)
+        self.img_id2idx = pickle.load(open(img_id2idx_path, 'rb'))
 
-        self.bb_norm = np.array([normalize_bbox(datum['img_w'], datum['img_h'], datum['boxes']) for datum in self.image_data])
+        tsv_file = os.path.join(dataroot, 'images/%s%s.csv' % (name, img_v))
+        # one shared copy for all DataLoader workers, entries only keep the image index
+        self.image_features = share_features(open_features(tsv_file, feat_backend))
         
         self.semantic_adj_matrix = None
         print("Setting semantic adj matrix to None...")
         self.spatial_adj_matrix = None
-        print("Setting spatial adj matrix to None...")
-
-        self.entries = _load_dataset_pvqa(dataroot, name, self.img_id2idx, self.label2ans, self.ans2label)
-        self.tokenize()
-        self.tensorize()
+        h5_path = store_prefix(tsv_file) + HDF5_SUFFIX
+        if self.relation_type == "spatial" and os.path.isfile(h5_path):
+            with h5py.File(h5_path, 'r') as hf:
+                if 'image_adj_matrix' in hf.keys():
+                    self.spatial_adj_matrix = torch.from_numpy(
+                        utils.read_adj_matrix(hf['image_adj_matrix']))
+        if self.spatial_adj_matrix is not None:
+            print("Loaded spatial adj matrix from file...",
+                  self.spatial_adj_matrix.shape)
+        else:
+            print("Setting spatial adj matrix to None...")
+            if self.relation_type == "spatial":
+                print("Run tools/build_spatial_graph.py on %s to build it"
+                      % h5_path)
+        self.h5_pos_emb = None
+        if precomputed_pos_emb and self.relation_type != "semantic":
+            self.h5_pos_emb = utils.pos_emb_reader(h5_path, nongt_dim, pos_emb_dim)
+            print("Reading precomputed position embeddings from %s" % h5_path)
+
+        # questions and answers tokenized once into memory-mapped arrays
+        self.questions = open_questions(
+            os.path.join(dataroot, 'qas', '%s_questions' % name),
+            lambda: _load_dataset_pvqa(dataroot, name, self.img_id2idx, self.label2ans, self.ans2label),
+            lambda sentence: self.dictionary.tokenize(sentence, False), self.dictionary.padding_idx,
+            max_length=14, vocab=self.dictionary.idx2word,
+            source_files=[os.path.join(dataroot, 'qas/%s_vqa.pkl' % name), ans2label_path, img_id2idx_path])
+        self.entries = QuestionEntries(self.questions, torch.from_numpy)
 
         self.nongt_dim = nongt_dim
         self.emb_dim = pos_emb_dim
-        self.v_dim = self.features.size(1 if self.adaptive else 2)
-        self.s_dim = self.spatials.size(1 if self.adaptive else 2)
-
-    def tokenize(self, max_length=14):
-        """Tokenizes the questions.
-        This will add q_token in each entry of the dataset.
-        -1 represent nil, and should be treated as padding_idx in embedding
-        """
-
-        for entry in self.entries:
-
-            for k, v in {'question': 'q_token', 'ans_sent': 'ans_token'}.items():
-                tokens = self.dictionary.tokenize(entry[k], False)
-                tokens = tokens[:max_length]
-                if len(tokens) < max_length:
-                    # Note here we pad in front of the sentence
-                    padding = [self.dictionary.padding_idx] * (max_length - len(tokens))
-                    tokens = tokens + padding
-                utils.assert_eq(len(tokens), max_length)
-                entry[v] = tokens
-
-    def tensorize(self):
-        self.features = torch.from_numpy(self.features)
-        self.spatials = torch.from_numpy(self.spatials)
-
-        for entry in self.entries:
-            question = torch.from_numpy(np.array(entry['q_token'],dtype=np.int64))
-            entry['q_token'] = question
-
-            answer_token = torch.from_numpy(np.array(entry['ans_token']))
-            entry['ans_token'] = answer_token
-
-            answer = entry['answer']
-            if None != answer:
-                labels = np.array(answer['labels'], dtype=np.int64)
-                scores = np.array(answer['scores'], dtype=np.float32)
-                if len(labels):
-                    labels = torch.from_numpy(labels)
-                    scores = torch.from_numpy(scores)
-                    entry['answer']['labels'] = labels
-                    entry['answer']['scores'] = scores
-                else:
-                    entry['answer']['labels'] = None
-                    entry['answer']['scores'] = None
+        self.v_dim = self.image_features.feat_dim
+        self.s_dim = 4
 
     def __getitem__(self, index):
-        entry = self.entries[index]
-        
-        if not self.adaptive:
-            features = self.features[entry['image']]
-            spatials = self.spatials[entry['image']]
-            bb_norm = self.bb_norm[entry['image']]
+        image = self.questions.image[index]
+        features = torch.from_numpy(self.image_features.get_features(image))
+        bb_norm = torch.from_numpy(self.image_features.get_normalized_boxes(image))
+        if self.h5_pos_emb is not None:
+            # served in place of the boxes, see _get_image
+            spatials = torch.from_numpy(self.h5_pos_emb[image]['image_pos_emb'])
         else:
-            features = self.features[self.pos_boxes[entry['image']][0]:self.pos_boxes[entry['image']][1], :]
-            spatials = self.spatials[self.pos_boxes[entry['image']][0]:self.pos_boxes[entry['image']][1], :]
-            bb_norm = self.bb_norm[self.pos_boxes[entry['image']][0]:self.pos_boxes[entry['image']][1], :]
+            spatials = torch.from_numpy(self.image_features.get_boxes(image))
 
-        question = entry['q_token']
-        question_id = entry['question_id']
-        image_id = entry["image_id"]
-        answer = entry['answer']
+        question = torch.from_numpy(self.questions.q_tokens[index])
+        question_id = int(self.questions.question_id[index])
+        image_id = str(self.questions.image_id[index])
 
         if self.spatial_adj_matrix is not None:
-            spatial_adj_matrix = self.spatial_adj_matrix[entry["image"]]
+            spatial_adj_matrix = self.spatial_adj_matrix[image]
         else:
-            spatial_adj_matrix = torch.zeros(1).double()
+            spatial_adj_matrix = torch.zeros(1, dtype=torch.uint8)
         if self.semantic_adj_matrix is not None:
-            semantic_adj_matrix = self.semantic_adj_matrix[entry["image"]]
+            semantic_adj_matrix = self.semantic_adj_matrix[image]
         else:
-            semantic_adj_matrix = torch.zeros(1).double()
+            semantic_adj_matrix = torch.zeros(1, dtype=torch.uint8)
 
-        if None != answer:
-            labels = answer['labels']
-            scores = answer['scores']
-            target = torch.zeros(self.num_ans_candidates)
-            if labels is not None:
-                target.scatter_(0, labels, scores)
-            return features, bb_norm, question, target,\
-                question_id, image_id, spatials, spatial_adj_matrix,\
-                semantic_adj_matrix
-        else:
-            return features, bb_norm, question, question_id, \
-                question_id, image_id, spatials, spatial_adj_matrix, \
-                semantic_adj_matrix
+        # expanded into the dense batch target by sparse_collate and .to()
+        labels, scores = self.questions.answer(index)
+        target = SparseTarget.from_arrays(labels, scores, self.num_ans_candidates)
+        # the image is told to PaddedCollate(image_fields=...) by its index
+        return ImageSample((features, bb_norm, question, target,
+                            question_id, image_id, spatials, spatial_adj_matrix,
+                            semantic_adj_matrix), image, self.image_features)
 
     def __len__(self):
-        return len(self.entries)
+        return len(self.questions)
+
+    def box_counts(self):
+        """Number of boxes of the image of every question, for BucketBatchSampler."""
+        return self.image_features.num_boxes[self.questions.image]
+
+    def sample_images(self):
+        """Image of every question, for ImageGroupBatchSampler."""
+        return self.questions.image
 
 
 class PretrainInputExample(object):
@@ -744,7 +758,8 @@ class VisualGenomeFeatureDataset(Dataset):
     def __init__(self, name, features, normalized_bb, bb,
                  spatial_adj_matrix, semantic_adj_matrix, dictionary,
                  relation_type, dataroot='data', adaptive=False,
-                 pos_boxes=None, pos_emb_dim=64):
+                 pos_boxes=None, pos_emb_dim=64, h5_images=None,
+                 h5_pos_emb=None):
         super(VisualGenomeFeatureDataset, self).__init__()
         # do not use test split images!
         assert name in ['train', 'val']
@@ -769,6 +784,9 @@ class VisualGenomeFeatureDataset(Dataset):
         self.normalized_bb = normalized_bb
         self.spatial_adj_matrix = spatial_adj_matrix
         self.semantic_adj_matrix = semantic_adj_matrix
+        # utils.H5ImageReader of a lazy VQAFeatureDataset
+        self.h5_images = h5_images
+        self.h5_pos_emb = h5_pos_emb
 
         if self.adaptive:
             self.pos_boxes = pos_boxes
@@ -779,8 +797,12 @@ class VisualGenomeFeatureDataset(Dataset):
         self.tokenize()
         self.tensorize()
         self.emb_dim = pos_emb_dim
-        self.v_dim = self.features.size(1 if self.adaptive else 2)
-        self.s_dim = self.normalized_bb.size(1 if self.adaptive else 2)
+        if self.h5_images is not None:
+            self.v_dim = self.h5_images.shapes['image_features'][-1]
+            self.s_dim = self.h5_images.shapes['spatial_features'][-1]
+        else:
+            self.v_dim = self.features.size(1 if self.adaptive else 2)
+            self.s_dim = self.normalized_bb.size(1 if self.adaptive else 2)
 
     def tokenize(self, max_length=14):
         """Tokenizes the questions.
@@ -823,27 +845,8 @@ class VisualGenomeFeatureDataset(Dataset):
         question = entry['q_token']
         question_id = entry['question_id']
         answer = entry['answer']
-        if self.spatial_adj_matrix is not None:
-            spatial_adj_matrix = self.spatial_adj_matrix[entry["image"]]
-        else:
-            spatial_adj_matrix = torch.zeros(1).double()
-        if self.semantic_adj_matrix is not None:
-            semantic_adj_matrix = self.semantic_adj_matrix[entry["image"]]
-        else:
-            semantic_adj_matrix = torch.zeros(1).double()
-        if self.adaptive:
-            features = self.features[
-                self.pos_boxes[
-                    entry['image']][0]:self.pos_boxes[entry['image']][1], :]
-            normalized_bb = self.normalized_bb[
-                self.pos_boxes[
-                    entry['image']][0]:self.pos_boxes[entry['image']][1], :]
-            bb = self.bb[self.pos_boxes[
-                entry['image']][0]:self.pos_boxes[entry['image']][1], :]
-        else:
-            features = self.features[entry['image']]
-            normalized_bb = self.normalized_bb[entry['image']]
-            bb = self.bb[entry['image']]
+        features, normalized_bb, bb, spatial_adj_matrix, \
+            semantic_adj_matrix = _get_image(self, entry['image'])
 
         labels = answer['labels']
         scores = answer['scores']
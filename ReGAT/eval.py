@@ -138,6 +138,17 @@ def parse_args():
     parser.add_argument('--split', type=str, default="val",
                         choices=["train", "val", "test", "test2015"],
                         help="test for vqa_cp, test2015 for vqa")
+    parser.add_argument('--lazy_features', action='store_true',
+                        help='read image features from the h5 file on '
+                             'demand instead of loading it into memory')
+    parser.add_argument('--feature_cache', type=int, default=512,
+                        help='images kept per worker with --lazy_features')
+    parser.add_argument('--feature_prefetch', type=int, default=0,
+                        help='images read at once with --lazy_features, '
+                             '-1 for one h5 chunk')
+    parser.add_argument('--precomputed_pos_emb', action='store_true',
+                        help='read the implicit position embeddings written '
+                             'by tools/build_position_embedding.py')
 
     args = parser.parse_args()
     return args
@@ -181,7 +192,11 @@ if __name__ == '__main__':
                 args.split, dictionary, model_hps.relation_type,
                 adaptive=model_hps.adaptive,
                 pos_emb_dim=model_hps.imp_pos_emb_dim,
-                dataroot=model_hps.data_folder)
+                nongt_dim=model_hps.nongt_dim,
+                dataroot=model_hps.data_folder, lazy=args.lazy_features,
+                cache_size=args.feature_cache,
+                prefetch=args.feature_prefetch,
+                precomputed_pos_emb=args.precomputed_pos_emb)
 
     model = build_regat(eval_dset, model_hps).to(device)
 
@@ -24,6 +24,8 @@ from train import compute_score_with_logits
 from model.position_emb import prepare_graph_variables, build_graph
 from config.parser import Struct
 import utils
+from pvqa_features.collate import PaddedCollate
+from pvqa_features.sampler import ImageGroupBatchSampler, sample_images
 
 
 @torch.no_grad()
@@ -38,13 +40,17 @@ def evaluate(model, dataloader, model_hps, args, device):
     pbar = tqdm(total=len(dataloader))
 
     if args.save_logits:
-        idx = 0
         pred_logits = np.zeros((N, num_answers))
         gt_logits = np.zeros((N, num_answers))
-
-    for i, (v, norm_bb, q, target, qid, _, bb,
-            spa_adj_matrix, sem_adj_matrix) in enumerate(dataloader):
-        batch_size = v.size(0)
+        # dataset rows of every batch, they may be grouped by image
+        batch_rows = list(dataloader.batch_sampler)
+
+    for i, batch in enumerate(dataloader):
+        (v, norm_bb, q, target, qid, _, bb,
+         spa_adj_matrix, sem_adj_matrix) = batch
+        v_index = getattr(batch, 'v_index', None)
+        if v_index is not None:
+            v_index = v_index.to(device)
         num_objects = v.size(1)
         v = Variable(v).to(device)
         norm_bb = Variable(norm_bb).to(device)
@@ -54,20 +60,20 @@ def evaluate(model, dataloader, model_hps, args, device):
             model_hps.nongt_dim, model_hps.imp_pos_emb_dim,
             model_hps.spa_label_num, model_hps.sem_label_num, device)
         pred, att = model(v, norm_bb, q, pos_emb, sem_adj_matrix,
-                          spa_adj_matrix, None)
+                          spa_adj_matrix, None, v_index=v_index)
 
-        # Check if target is a placeholder or actual targets
-        if target.size(-1) == num_answers:
-            target = Variable(target).to(device)
+        # Check if target is a placeholder or actual targets, the PathVQA
+        # datasets hand over SparseTargets
+        if not torch.is_tensor(target) or target.size(-1) == num_answers:
+            target = target.to(device)
             batch_score = compute_score_with_logits(
                 pred, target, device).sum()
             score += batch_score
             if args.save_logits:
-                gt_logits[idx:batch_size+idx, :] = target.cpu().numpy()
+                gt_logits[batch_rows[i], :] = target.cpu().numpy()
                 
         if args.save_logits:
-            pred_logits[idx:batch_size+idx, :] = pred.cpu().numpy()
-            idx += batch_size
+            pred_logits[batch_rows[i], :] = pred.cpu().numpy()
 
         if args.save_answers:
             qid = qid.cpu()
@@ -128,6 +134,9 @@ def parse_args():
                         help='save logits')
     parser.add_argument('--save_answers', action='store_true',
                         help='save poredicted answers')
+    parser.add_argument('--group_images', action='store_true',
+                        help='batch the questions of an image together and '
+                             'encode the image once for all of them')
 
     '''
     For loading expert pre-trained weights
@@ -145,6 +154,12 @@ def parse_args():
     parser.add_argument('--split', type=str, default="val",
                         choices=["train", "val", "test"],
                         help="test for vqa_cp, test2015 for vqa")
+    parser.add_argument('--feat_backend', type=str, default='auto',
+                        choices=['auto', 'tsv', 'ram', 'memmap', 'hdf5'],
+                        help='where the pvqa features are read from')
+    parser.add_argument('--precomputed_pos_emb', action='store_true',
+                        help='read the implicit position embeddings written '
+                             'by tools/build_position_embedding.py')
 
     args = parser.parse_args()
     return args
@@ -173,7 +188,10 @@ if __name__ == '__main__':
                 args.split, dictionary, model_hps.relation_type,
                 adaptive=model_hps.adaptive,
                 pos_emb_dim=model_hps.imp_pos_emb_dim,
-                dataroot=join(model_hps.data_folder,model_hps.dataset))
+                nongt_dim=model_hps.nongt_dim,
+                dataroot=join(model_hps.data_folder,model_hps.dataset),
+                feat_backend=args.feat_backend,
+                precomputed_pos_emb=args.precomputed_pos_emb)
 
     
     model = build_regat(eval_dset, model_hps).to(device)
@@ -207,8 +225,16 @@ if __name__ == '__main__':
     print("\tMissing_keys:", list(missing_keys))
     model.load_state_dict(matched_state_dict, strict=False)
 
-    eval_loader = DataLoader(
-        eval_dset, batch_size, shuffle=False, collate_fn=utils.trim_collate)
+    if args.group_images:
+        # features, normalized boxes, boxes and graphs only depend on the image
+        eval_loader = DataLoader(
+            eval_dset, batch_sampler=ImageGroupBatchSampler(
+                sample_images(eval_dset), batch_size),
+            collate_fn=PaddedCollate(image_fields=(0, 1, 6, 7, 8)))
+    else:
+        eval_loader = DataLoader(
+            eval_dset, batch_size, shuffle=False,
+            collate_fn=PaddedCollate())
 
     eval_score = evaluate(
         model, eval_loader, model_hps, args, device)
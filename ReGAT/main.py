@@ -62,6 +62,17 @@ def parse_args():
                         help='use visual genome dataset to train?')
     parser.add_argument('--adaptive', action='store_true',
                         help='adaptive or fixed number of regions')
+    parser.add_argument('--lazy_features', action='store_true',
+                        help='read image features from the h5 file on '
+                             'demand instead of loading it into memory')
+    parser.add_argument('--feature_cache', type=int, default=512,
+                        help='images kept per worker with --lazy_features')
+    parser.add_argument('--feature_prefetch', type=int, default=0,
+                        help='images read at once with --lazy_features, '
+                             '-1 for one h5 chunk')
+    parser.add_argument('--precomputed_pos_emb', action='store_true',
+                        help='read the implicit position embeddings written '
+                             'by tools/build_position_embedding.py')
     '''
     Model
     '''
@@ -165,11 +176,17 @@ if __name__ == '__main__':
     else:
         val_dset = VQAFeatureDataset(
                 'val', dictionary, args.relation_type, adaptive=args.adaptive,
-                pos_emb_dim=args.imp_pos_emb_dim, dataroot=args.data_folder)
+                pos_emb_dim=args.imp_pos_emb_dim, dataroot=args.data_folder,
+                nongt_dim=args.nongt_dim, lazy=args.lazy_features,
+                cache_size=args.feature_cache, prefetch=args.feature_prefetch,
+                precomputed_pos_emb=args.precomputed_pos_emb)
         train_dset = VQAFeatureDataset(
                 'train', dictionary, args.relation_type,
                 adaptive=args.adaptive, pos_emb_dim=args.imp_pos_emb_dim,
-                dataroot=args.data_folder)
+                dataroot=args.data_folder, nongt_dim=args.nongt_dim,
+                lazy=args.lazy_features, cache_size=args.feature_cache,
+                prefetch=args.feature_prefetch,
+                precomputed_pos_emb=args.precomputed_pos_emb)
 
     model = build_regat(val_dset, args).to(device)
 
@@ -229,14 +246,18 @@ if __name__ == '__main__':
                         train_dset.semantic_adj_matrix, dictionary,
                         adaptive=train_dset.adaptive,
                         pos_boxes=train_dset.pos_boxes,
-                        dataroot=args.data_folder)
+                        dataroot=args.data_folder,
+                        h5_images=train_dset.h5_images,
+                        h5_pos_emb=train_dset.h5_pos_emb)
             vg_val_dset = VisualGenomeFeatureDataset(
                             'val', val_dset.features, val_dset.normalized_bb,
                             val_dset.bb, val_dset.spatial_adj_matrix,
                             val_dset.semantic_adj_matrix, dictionary,
                             adaptive=val_dset.adaptive,
                             pos_boxes=val_dset.pos_boxes,
-                            dataroot=args.data_folder)
+                            dataroot=args.data_folder,
+                            h5_images=val_dset.h5_images,
+                        h5_pos_emb=val_dset.h5_pos_emb)
             concat_list.append(vg_train_dset)
             concat_list.append(vg_val_dset)
         final_train_dset = ConcatDataset(concat_list)
@@ -6,9 +6,12 @@ Licensed under the MIT license.
 import os
 from os.path import join, exists
 import argparse
+import builtins
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader, ConcatDataset, random_split
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, ConcatDataset, RandomSampler, random_split
+from torch.utils.data.distributed import DistributedSampler
 import random
 import json
 
@@ -19,7 +22,10 @@ from model.regat import build_regat
 from config.parser import parse_with_config
 from train import train
 import utils
-from utils import trim_collate
+from pvqa_features.collate import PaddedCollate
+from pvqa_features.distributed import barrier, broadcast_object, cleanup, init_distributed, is_main_process
+from pvqa_features.sampler import BucketBatchSampler, DistributedEvalSampler, ImageGroupBatchSampler, \
+    box_counts, sample_images
 
 
 def parse_args():
@@ -36,6 +42,9 @@ def parse_args():
                         help='Learning rate decay when val score descreases')
     parser.add_argument('--grad_accu_steps', type=int, default=1)
     parser.add_argument('--grad_clip', type=float, default=0.25)
+    parser.add_argument('--amp', action='store_true',
+                        help='mixed precision: float16 autocast with a '
+                             'GradScaler on GPU, bfloat16 on CPU')
     parser.add_argument('--weight_decay', type=float, default=0)
     parser.add_argument('--batch_size', type=int, default=64)
     parser.add_argument('--output', type=str, default='saved_models/')
@@ -44,6 +53,10 @@ def parse_args():
     parser.add_argument('--log_interval', type=int, default=-1,
                         help='Print log for certain steps')
     parser.add_argument('--seed', type=int, default=-1, help='random seed')
+    parser.add_argument('--backend', type=str, default=None,
+                        choices=['nccl', 'gloo'],
+                        help='process group backend of a torchrun launch, '
+                             'nccl on GPUs and gloo on CPUs by default')
 
     '''
     loading trained models
@@ -62,6 +75,19 @@ def parse_args():
                         help='use visual genome dataset to train?')
     parser.add_argument('--adaptive', action='store_true',
                         help='adaptive or fixed number of regions')
+    parser.add_argument('--feat_backend', type=str, default='auto',
+                        choices=['auto', 'tsv', 'ram', 'memmap', 'hdf5'],
+                        help='where the pvqa features are read from')
+    parser.add_argument('--precomputed_pos_emb', action='store_true',
+                        help='read the implicit position embeddings written '
+                             'by tools/build_position_embedding.py')
+    parser.add_argument('--bucket_boxes', action='store_true',
+                        help='batch questions whose images have similar box '
+                             'counts (adaptive features)')
+    parser.add_argument('--group_images', action='store_true',
+                        help='batch the validation questions of an image '
+                             'together and encode the image once for all of '
+                             'them')
     '''
     Model
     '''
@@ -120,21 +146,34 @@ def parse_args():
 
 if __name__ == '__main__':
     args = parse_args()
-    if not torch.cuda.is_available():
-        raise ValueError("CUDA is not available," +
-                         "this code currently only support GPU.")
+    # torchrun --nproc_per_node N main_modify.py ...: one process per GPU
+    # (or CPU process with gloo), --batch_size is per process
+    rank, local_rank, world_size = init_distributed(args.backend)
+    distributed = world_size > 1
+    if distributed and rank != 0:
+        def print_pass(*args, **kwargs):
+            pass
+
+        builtins.print = print_pass
     n_device = torch.cuda.device_count()
-    print("Found %d GPU cards for training" % (n_device))
-    device = torch.device("cuda")
-    batch_size = args.batch_size*n_device
+    print("Found %d GPU cards for training, %d processes" % (n_device, world_size))
+    if torch.cuda.is_available():
+        device = torch.device("cuda", local_rank)
+    else:
+        print("CUDA is not available, training on the CPU")
+        device = torch.device("cpu")
+    if distributed:
+        batch_size = args.batch_size
+    else:
+        batch_size = args.batch_size*max(n_device, 1)
 
     torch.backends.cudnn.benchmark = True
 
     if args.seed != -1:
         print("Predefined randam seed %d" % args.seed)
     else:
-        # fix seed
-        args.seed = random.randint(1, 10000)
+        # fix seed, the same on every rank for the samplers
+        args.seed = broadcast_object(random.randint(1, 10000))
         print("Choose random seed %d" % args.seed)
     torch.manual_seed(args.seed)
     torch.cuda.manual_seed_all(args.seed)
@@ -167,13 +206,19 @@ if __name__ == '__main__':
         print("PVQA Feature Dataset's beeing created")
         val_dset = PVQAFeatureDataset(
                 'val', dictionary, args.relation_type, adaptive=args.adaptive,
-                pos_emb_dim=args.imp_pos_emb_dim)
+                pos_emb_dim=args.imp_pos_emb_dim, nongt_dim=args.nongt_dim,
+                feat_backend=args.feat_backend,
+                precomputed_pos_emb=args.precomputed_pos_emb)
         train_dset = PVQAFeatureDataset(
                 'train', dictionary, args.relation_type,
-                adaptive=args.adaptive, pos_emb_dim=args.imp_pos_emb_dim)
+                adaptive=args.adaptive, pos_emb_dim=args.imp_pos_emb_dim,
+                nongt_dim=args.nongt_dim, feat_backend=args.feat_backend,
+                precomputed_pos_emb=args.precomputed_pos_emb)
         test_dset = PVQAFeatureDataset(
                 'test', dictionary, args.relation_type,
-                adaptive=args.adaptive, pos_emb_dim=args.imp_pos_emb_dim)
+                adaptive=args.adaptive, pos_emb_dim=args.imp_pos_emb_dim,
+                nongt_dim=args.nongt_dim, feat_backend=args.feat_backend,
+                precomputed_pos_emb=args.precomputed_pos_emb)
 
     model = build_regat(train_dset, args).to(device)
 
@@ -184,6 +229,12 @@ if __name__ == '__main__':
                                                 dictionary)
         model.w_emb.init_embedding(join(args.data_folder,
                                         'glove/glove6b_init_300d.npy'), tfidf, weights)
+    if distributed:
+        # gradients are all-reduced in backward, rank 0's weights are
+        # broadcast here. The BAN Counter uses only 8 of its 16 piecewise
+        # linear functions, whose other parameters never get a gradient.
+        model = DDP(model, device_ids=[local_rank] if device.type == "cuda" else None,
+                    find_unused_parameters=args.fusion == "ban")
 
 
     if args.use_both and args.dataset == "pvqa":
@@ -201,9 +252,35 @@ if __name__ == '__main__':
                                     len(trainval_concat_dset)-int(0.1*length)])
             concat_list = [trainval_concat_dsets_split[1]]
 
-    train_loader = DataLoader(train_dset, batch_size, shuffle=True, collate_fn=trim_collate)
-    eval_loader = DataLoader(val_dset, batch_size, shuffle=False, collate_fn=trim_collate)
-    test_loader = DataLoader(train_dset, batch_size, shuffle=True, collate_fn=trim_collate)
+    collate_fn = PaddedCollate()
+    train_sampler = DistributedSampler(train_dset, seed=args.seed) if distributed else None
+    if args.bucket_boxes:
+        # questions of images with similar box counts share a batch
+        train_batch_sampler = BucketBatchSampler(
+            train_sampler or RandomSampler(train_dset), box_counts(train_dset), batch_size,
+            seed=args.seed)
+        train_loader = DataLoader(train_dset, batch_sampler=train_batch_sampler, collate_fn=collate_fn,
+                                  pin_memory=True)
+    else:
+        train_loader = DataLoader(train_dset, batch_size, shuffle=train_sampler is None,
+                                  sampler=train_sampler, collate_fn=collate_fn, pin_memory=True)
+    if args.group_images:
+        # features, normalized boxes, boxes and graphs only depend on the image
+        eval_loader = DataLoader(
+            val_dset, batch_sampler=ImageGroupBatchSampler(sample_images(val_dset), batch_size,
+                                                           num_replicas=world_size, rank=rank),
+            collate_fn=PaddedCollate(image_fields=(0, 1, 6, 7, 8)), pin_memory=True)
+    else:
+        eval_loader = DataLoader(val_dset, batch_size, shuffle=False, collate_fn=collate_fn,
+                                 sampler=DistributedEvalSampler(val_dset) if distributed else None,
+                                 pin_memory=True)
+    if distributed:
+        # every question once over the ranks, merged back in order by test_evaluate
+        test_loader = DataLoader(train_dset, batch_size, sampler=DistributedEvalSampler(train_dset),
+                                 collate_fn=collate_fn, pin_memory=True)
+    else:
+        test_loader = DataLoader(train_dset, batch_size, shuffle=True, collate_fn=collate_fn,
+                                 pin_memory=True)
 
     output_meta_folder = join(args.output, "regat_%s" % args.relation_type)
     print(output_meta_folder)
@@ -211,12 +288,19 @@ if __name__ == '__main__':
     args.output = output_meta_folder+"/%s_%s_%s_%s_epochs" % (
                     fusion_methods, args.relation_type,
                     args.dataset, args.epochs)
-    if exists(args.output) and os.listdir(args.output):
+    # checked on rank 0 and raised on every rank, so none is left waiting in barrier()
+    output_used = broadcast_object(is_main_process() and exists(args.output) and
+                                   bool(os.listdir(args.output)))
+    if output_used:
         raise ValueError("Output directory ({}) already exists and is not "
-                        "empty.".format(args.output))
-    utils.create_dir(args.output)
-    with open(join(args.output, 'hps.json'), 'w') as writer:
-            json.dump(vars(args), writer, indent=4)
-    logger = utils.Logger(join(args.output, 'log.txt'))
+                         "empty.".format(args.output))
+    if is_main_process():
+        utils.create_dir(args.output)
+        with open(join(args.output, 'hps.json'), 'w') as writer:
+                json.dump(vars(args), writer, indent=4)
+    # the other ranks wait for the checked output directory
+    barrier()
+    logger = utils.Logger(join(args.output, 'log.txt'), enabled=is_main_process())
 
-    train(model, train_loader, eval_loader, test_loader, args, device)
\ No newline at end of file
+    train(model, train_loader, eval_loader, test_loader, args, device)
+    cleanup()
\ No newline at end of file
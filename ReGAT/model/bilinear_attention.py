@@ -41,7 +41,8 @@ class BiAttention(nn.Module):
         # else:
         #     logits = self.logits(v,q) # b x g x v x q
 
-        logits = self.logits(v, q)  # b x g x v x q
+        # the -inf masking and the softmax stay in fp32 under autocast
+        logits = self.logits(v, q).float()  # b x g x v x q
         if v_mask:
             mask = (0 == v.abs().sum(2)).unsqueeze(1).unsqueeze(3).expand(
                                                                 logits.size())
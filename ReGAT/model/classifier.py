@@ -14,7 +14,7 @@ class SimpleClassifier(nn.Module):
         layers = [
             weight_norm(nn.Linear(in_dim, hid_dim), dim=None),
             nn.ReLU(),
-            nn.Dropout(dropout, inplace=True),
+            nn.Dropout(dropout),  # not in place: the ReLU backward needs its output
             weight_norm(nn.Linear(hid_dim, out_dim), dim=None)
         ]
         self.main = nn.Sequential(*layers)
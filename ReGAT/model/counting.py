@@ -45,6 +45,12 @@ class Counter(nn.Module):
         and close to 0 if it is not.
         n is the batch size, m is the number of bounding boxes per image.
         """
+        # the piecewise linear functions, products and sqrt are not fp16
+        # safe, count in fp32 under autocast
+        with torch.autocast(boxes.device.type, enabled=False):
+            return self.count(boxes.float(), attention.float())
+
+    def count(self, boxes, attention):
         # only care about the highest scoring object proposals
         # the ones with low score will have a low impact on the count anyway
         boxes, attention = self.filter_most_important(
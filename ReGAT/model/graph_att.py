@@ -50,12 +50,14 @@ class GAttNet(nn.Module):
             neighbor_net.append(g_att_layer)
         self.neighbor_net = nn.ModuleList(neighbor_net)
 
-    def forward(self, v_feat, adj_matrix, pos_emb=None):
+    def forward(self, v_feat, adj_matrix, pos_emb=None, v_index=None):
         """
         Args:
             v_feat: [batch_size,num_rois, feat_dim]
             adj_matrix: [batch_size, num_rois, num_rois, num_labels]
             pos_emb: [batch_size, num_rois, pos_emb_dim]
+            v_index: [batch_size] row of adj_matrix and pos_emb of every
+                question, which then only hold the distinct images
 
         Returns:
             output: [batch_size, num_rois, feat_dim]
@@ -88,11 +90,14 @@ class GAttNet(nn.Module):
 
             # [batch_size,num_rois, nongt_dim]
             v_biases_neighbors = self.bias(input_adj_matrix).squeeze(-1)
+            if v_index is not None:
+                condensed_adj_matrix = condensed_adj_matrix[v_index]
+                v_biases_neighbors = v_biases_neighbors[v_index]
 
             # [batch_size,num_rois, out_feat_dim]
             neighbor_emb[d] = self.neighbor_net[d].forward(
                         self_feat, condensed_adj_matrix, pos_emb,
-                        v_biases_neighbors)
+                        v_biases_neighbors, v_index)
 
             # [batch_size,num_rois, out_feat_dim]
             output = output + neighbor_emb[d]
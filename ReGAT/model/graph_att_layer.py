@@ -55,12 +55,14 @@ class GraphSelfAttentionLayer(nn.Module):
                                       groups=self.fc_dim), dim=None)
 
     def forward(self, roi_feat, adj_matrix,
-                position_embedding, label_biases_att):
+                position_embedding, label_biases_att, v_index=None):
         """
         Args:
             roi_feat: [batch_size, N, feat_dim]
             adj_matrix: [batch_size, N, nongt_dim]
             position_embedding: [num_rois, nongt_dim, pos_emb_dim]
+            v_index: [batch_size] row of position_embedding of every
+                question, which then only holds the distinct images
         Returns:
             output: [batch_size, num_rois, ovr_feat_dim, output_dim]
         """
@@ -100,14 +102,18 @@ class GraphSelfAttentionLayer(nn.Module):
         aff_scale = (1.0 / math.sqrt(float(self.dim_group[1]))) * aff
         # aff_scale, [batch_size,num_rois,num_heads, nongt_dim]
         aff_scale = torch.transpose(aff_scale, 1, 2)
-        weighted_aff = aff_scale
+        # the log, the -9e15 masking and the softmax stay in fp32 under
+        # autocast, -9e15 is -inf in fp16
+        weighted_aff = aff_scale.float()
 
         if position_embedding is not None and self.pos_emb_dim > 0:
             # Adding goemetric features
             position_embedding = position_embedding.float()
+            # computed once per image, for every question below
+            num_images = position_embedding.size(0)
             # [batch_size,num_rois * nongt_dim, emb_dim]
             position_embedding_reshape = position_embedding.view(
-                (batch_size, -1, self.pos_emb_dim))
+                (num_images, -1, self.pos_emb_dim))
 
             # position_feat_1, [batch_size,num_rois * nongt_dim, fc_dim]
             position_feat_1 = self.pair_pos_fc1(position_embedding_reshape)
@@ -115,16 +121,19 @@ class GraphSelfAttentionLayer(nn.Module):
 
             # aff_weight, [batch_size,num_rois, nongt_dim, fc_dim]
             aff_weight = position_feat_1_relu.view(
-                (batch_size, -1, nongt_dim, self.fc_dim))
+                (num_images, -1, nongt_dim, self.fc_dim))
 
             # aff_weight, [batch_size,num_rois, fc_dim, nongt_dim]
-            aff_weight = torch.transpose(aff_weight, 2, 3)
+            aff_weight = torch.transpose(aff_weight, 2, 3).float()
 
-            thresh = torch.FloatTensor([1e-6]).cuda()
+            thresh = torch.tensor([1e-6], device=aff_weight.device)
             # weighted_aff, [batch_size,num_rois, fc_dim, nongt_dim]
             threshold_aff = torch.max(aff_weight, thresh)
+            log_aff = torch.log(threshold_aff)
+            if v_index is not None:
+                log_aff = log_aff[v_index]
 
-            weighted_aff += torch.log(threshold_aff)
+            weighted_aff += log_aff
 
         if adj_matrix is not None:
             # weighted_aff_transposed, [batch_size,num_rois, nongt_dim, num_heads]
@@ -11,6 +11,7 @@ This code is written by Linjie Li.
 import numpy as np
 import math
 import torch
+import torch.nn.functional as F
 from torch.autograd import Variable
 
 
@@ -43,68 +44,117 @@ def build_graph(bbox, spatial, label_num=11):
 
     Args:
         bbox: [num_boxes, 4]
+        spatial: [num_boxes, >=2], the last two columns are the box width
+            and height relative to the image
 
     Returns:
-        adj_matrix: [num_boxes, num_boxes, label_num]
+        adj_matrix: [num_boxes, num_boxes] edge labels, 0 for no edge
     """
-
-    num_box = bbox.shape[0]
-    adj_matrix = np.zeros((num_box, num_box))
     xmin, ymin, xmax, ymax = np.split(bbox, 4, axis=1)
-    # [num_boxes, 1]
-    bbox_width = xmax - xmin + 1.
-    bbox_height = ymax - ymin + 1.
-    image_h = bbox_height[0]/spatial[0, -1]
-    image_w = bbox_width[0]/spatial[0, -2]
+    # the image size is recovered from the first box
+    image_h = (ymax[0] - ymin[0] + 1.)/spatial[0, -1]
+    image_w = (xmax[0] - xmin[0] + 1.)/spatial[0, -2]
+    adj_matrix = build_graph_batch(bbox[np.newaxis], image_w, image_h,
+                                   label_num=label_num)[0]
+    return adj_matrix.astype(np.float64)
+
+
+def build_graph_batch(bbox, image_w, image_h, label_num=11):
+    """ Build the spatial graphs of a batch of images at once
+
+    Gives the labels of the pairwise definition (see bb_intersection_over_union
+    for the overlap):
+        1 / 2   box j inside / covering box i
+        3       IoU >= 0.5
+        4..11   direction of box j seen from box i, in 8 bins of 45 degrees,
+                for centers closer than half the image diagonal
+        12      on the diagonal
+    All zero boxes (padding) get no edges. Boxes sharing their center
+    without overlapping nor containing each other are left unlabeled.
+
+    Args:
+        bbox: [batch_size, num_boxes, 4]
+        image_w, image_h: [batch_size] image sizes
+
+    Returns:
+        adj_matrix: [batch_size, num_boxes, num_boxes] uint8
+    """
+    bbox = np.asarray(bbox)
+    dtype = bbox.dtype if bbox.dtype.kind == 'f' else np.dtype(np.float64)
+    bbox = bbox.astype(dtype, copy=False)
+    batch_size, num_box = bbox.shape[:2]
+    image_w = np.asarray(image_w, dtype=dtype).reshape(batch_size, 1, 1)
+    image_h = np.asarray(image_h, dtype=dtype).reshape(batch_size, 1, 1)
+    pi = dtype.type(math.pi)
+
+    # [batch_size, num_boxes, 1] for box i, [batch_size, 1, num_boxes] for j
+    xmin, ymin, xmax, ymax = [bbox[:, :, k:k+1] for k in range(4)]
+    xmin_j, ymin_j, xmax_j, ymax_j = [bbox[:, np.newaxis, :, k]
+                                      for k in range(4)]
+    valid = bbox.sum(axis=2) != 0
+    upper = np.triu(np.ones((num_box, num_box), dtype=bool), k=1)
+    pair = upper & valid[:, :, np.newaxis] & valid[:, np.newaxis, :]
+
+    # class 1: inside (j inside i), class 2: cover (j covers i)
+    inside = (xmin < xmin_j) & (xmax > xmax_j) & \
+             (ymin < ymin_j) & (ymax > ymax_j)
+    cover = (xmin_j < xmin) & (xmax_j > xmax) & \
+            (ymin_j < ymin) & (ymax_j > ymax) & ~inside
+
+    # class 3: i and j overlap
+    inter_w = np.maximum(np.minimum(xmax, xmax_j) -
+                         np.maximum(xmin, xmin_j) + 1, 0)
+    inter_h = np.maximum(np.minimum(ymax, ymax_j) -
+                         np.maximum(ymin, ymin_j) + 1, 0)
+    inter = inter_w * inter_h
+    area = (xmax - xmin + 1) * (ymax - ymin + 1)
+    area_j = (xmax_j - xmin_j + 1) * (ymax_j - ymin_j + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = inter / (area + area_j - inter)
+    overlap = ~inside & ~cover & (iou >= 0.5)
+
+    # classes 4 - 11: direction, for boxes closer than half the diagonal
     center_x = 0.5 * (xmin + xmax)
     center_y = 0.5 * (ymin + ymax)
-    image_diag = math.sqrt(image_h**2 + image_w**2)
-    for i in range(num_box):
-        bbA = bbox[i]
-        if sum(bbA) == 0:
-            continue
-        adj_matrix[i, i] = 12
-        for j in range(i+1, num_box):
-            bbB = bbox[j]
-            if sum(bbB) == 0:
-                continue
-            # class 1: inside (j inside i)
-            if xmin[i] < xmin[j] and xmax[i] > xmax[j] and \
-               ymin[i] < ymin[j] and ymax[i] > ymax[j]:
-                adj_matrix[i, j] = 1
-                adj_matrix[j, i] = 2
-            # class 2: cover (j covers i)
-            elif (xmin[j] < xmin[i] and xmax[j] > xmax[i] and
-                  ymin[j] < ymin[i] and ymax[j] > ymax[i]):
-                adj_matrix[i, j] = 2
-                adj_matrix[j, i] = 1
-            else:
-                ioU = bb_intersection_over_union(bbA, bbB)
-                # class 3: i and j overlap
-                if ioU >= 0.5:
-                    adj_matrix[i, j] = 3
-                    adj_matrix[j, i] = 3
-                else:
-                    y_diff = center_y[i] - center_y[j]
-                    x_diff = center_x[i] - center_x[j]
-                    diag = math.sqrt((y_diff)**2 + (x_diff)**2)
-                    if diag < 0.5 * image_diag:
-                        sin_ij = y_diff/diag
-                        cos_ij = x_diff/diag
-                        if sin_ij >= 0 and cos_ij >= 0:
-                            label_i = np.arcsin(sin_ij)
-                            label_j = 2*math.pi - label_i
-                        elif sin_ij < 0 and cos_ij >= 0:
-                            label_i = np.arcsin(sin_ij)+2*math.pi
-                            label_j = label_i - math.pi
-                        elif sin_ij >= 0 and cos_ij < 0:
-                            label_i = np.arccos(cos_ij)
-                            label_j = 2*math.pi - label_i
-                        else:
-                            label_i = -np.arccos(sin_ij)+2*math.pi
-                            label_j = label_i - math.pi
-                        adj_matrix[i, j] = int(np.ceil(label_i/(math.pi/4)))+3
-                        adj_matrix[j, i] = int(np.ceil(label_j/(math.pi/4)))+3
+    y_diff = center_y - np.swapaxes(center_y, 1, 2)
+    x_diff = center_x - np.swapaxes(center_x, 1, 2)
+    # distances are compared in float64, like math.sqrt does
+    diag = np.sqrt((y_diff**2 + x_diff**2).astype(np.float64))
+    image_diag = np.sqrt((image_h**2 + image_w**2).astype(np.float64))
+    near = ~inside & ~cover & ~overlap & (diag < 0.5 * image_diag) & \
+        (diag > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sin_ij = y_diff / diag.astype(dtype)
+        cos_ij = x_diff / diag.astype(dtype)
+        sin_pos = sin_ij >= 0
+        cos_pos = cos_ij >= 0
+        label_i = np.where(
+            cos_pos,
+            np.where(sin_pos, np.arcsin(sin_ij), np.arcsin(sin_ij) + 2*pi),
+            np.where(sin_pos, np.arccos(cos_ij),
+                     -np.arccos(sin_ij) + 2*pi))
+        label_j = np.where(sin_pos, 2*pi - label_i, label_i - pi)
+        bin_i = np.ceil(label_i / (pi/4)) + 3
+        bin_j = np.ceil(label_j / (pi/4)) + 3
+
+    adj_matrix = np.zeros((batch_size, num_box, num_box), dtype=np.uint8)
+    upper_ij = np.zeros_like(adj_matrix)
+    lower_ji = np.zeros_like(adj_matrix)
+    upper_ij[inside] = 1
+    lower_ji[inside] = 2
+    upper_ij[cover] = 2
+    lower_ji[cover] = 1
+    upper_ij[overlap] = 3
+    lower_ji[overlap] = 3
+    near = near & pair
+    upper_ij[near] = bin_i[near]
+    lower_ji[near] = bin_j[near]
+    upper_ij[~pair] = 0
+    lower_ji[~pair] = 0
+    adj_matrix += upper_ij
+    adj_matrix += np.swapaxes(lower_ji, 1, 2)
+    diagonal = np.arange(num_box)
+    adj_matrix[:, diagonal, diagonal] = np.where(valid, 12, 0)
     return adj_matrix
 
 
@@ -112,24 +162,22 @@ def torch_broadcast_adj_matrix(adj_matrix, label_num=11,
                                device=torch.device("cuda")):
     """ broudcast spatial relation graph
 
+    A single scatter on the device the labels live on (moved to `device`
+    first if needed). Label 0 (no edge) and labels above label_num (e.g. the
+    self-loop label of the spatial graph) scatter a 0, so they get no edge.
+
     Args:
-        adj_matrix: [batch_size,num_boxes, num_boxes]
+        adj_matrix: [batch_size,num_boxes, num_boxes] integer labels
 
     Returns:
-        result: [batch_size,num_boxes, num_boxes, label_num]
+        result: [batch_size,num_boxes, num_boxes, label_num] float one-hot
     """
-    result = []
-    for i in range(1, label_num+1):
-        index = torch.nonzero((adj_matrix == i).view(-1).data).squeeze()
-        curr_result = torch.zeros(
-            adj_matrix.shape[0], adj_matrix.shape[1], adj_matrix.shape[2])
-        curr_result = curr_result.view(-1)
-        curr_result[index] += 1
-        result.append(curr_result.view(
-            (adj_matrix.shape[0], adj_matrix.shape[1],
-             adj_matrix.shape[2], 1)))
-    result = torch.cat(result, dim=3)
-    return result
+    adj_matrix = adj_matrix.to(device, non_blocking=True).long()
+    is_edge = (adj_matrix > 0) & (adj_matrix <= label_num)
+    index = (adj_matrix - 1).clamp_(0, label_num - 1).unsqueeze(-1)
+    result = torch.zeros(adj_matrix.shape + (label_num,),
+                         device=adj_matrix.device)
+    return result.scatter_(3, index, is_edge.unsqueeze(-1).float())
 
 
 def torch_extract_position_embedding(position_mat, feat_dim, wave_length=1000,
@@ -195,22 +243,39 @@ def torch_extract_position_matrix(bbox, nongt_dim=36):
 def prepare_graph_variables(relation_type, bb, sem_adj_matrix, spa_adj_matrix,
                             num_objects, nongt_dim, pos_emb_dim, spa_label_num,
                             sem_label_num, device):
+    """
+    The adjacency matrices come from the datasets as uint8 label maps
+    [batch_size, num_boxes, num_boxes]; only those are copied to the device,
+    where they are expanded to one-hot [..., label_num] float matrices.
+
+    bb is either the [batch_size, num_boxes, 4] boxes the implicit position
+    embedding is computed from, or that embedding already precomputed by
+    tools/build_position_embedding.py and served by the dataset,
+    [batch_size, nongt_dim, max_boxes, pos_emb_dim] in half precision.
+    """
 
     pos_emb_var, sem_adj_matrix_var, spa_adj_matrix_var = None, None, None
     if relation_type == "spatial":
         assert spa_adj_matrix.dim() > 2, "Found spa_adj_matrix of wrong shape"
-        spa_adj_matrix = spa_adj_matrix.to(device)
         spa_adj_matrix = spa_adj_matrix[:, :num_objects, :num_objects]
+        spa_adj_matrix = spa_adj_matrix.to(device, non_blocking=True)
         spa_adj_matrix = torch_broadcast_adj_matrix(
                         spa_adj_matrix, label_num=spa_label_num, device=device)
         spa_adj_matrix_var = Variable(spa_adj_matrix).to(device)
     if relation_type == "semantic":
         assert sem_adj_matrix.dim() > 2, "Found sem_adj_matrix of wrong shape"
-        sem_adj_matrix = sem_adj_matrix.to(device)
         sem_adj_matrix = sem_adj_matrix[:, :num_objects, :num_objects]
+        sem_adj_matrix = sem_adj_matrix.to(device, non_blocking=True)
         sem_adj_matrix = torch_broadcast_adj_matrix(
                         sem_adj_matrix, label_num=sem_label_num, device=device)
         sem_adj_matrix_var = Variable(sem_adj_matrix).to(device)
+    elif bb.dim() == 4:
+        assert bb.size(-1) == pos_emb_dim, "Found pos_emb of wrong size"
+        # the rows and columns this batch would have computed, padding
+        # boxes are zeros either way
+        pos_emb = bb[:, :min(num_objects, nongt_dim), :num_objects]
+        pos_emb = pos_emb.to(device, non_blocking=True).float()
+        pos_emb_var = Variable(pos_emb).to(device)
     else:
         bb = bb.to(device)
         pos_mat = torch_extract_position_matrix(bb, nongt_dim=nongt_dim)
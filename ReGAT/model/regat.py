@@ -35,7 +35,7 @@ class ReGAT(nn.Module):
         self.classifier = classifier
 
     def forward(self, v, b, q, implicit_pos_emb, sem_adj_matrix,
-                spa_adj_matrix, labels):
+                spa_adj_matrix, labels, v_index=None):
         """Forward
         v: [batch, num_objs, obj_dim]
         b: [batch, num_objs, b_dim]
@@ -43,6 +43,8 @@ class ReGAT(nn.Module):
         pos: [batch_size, num_objs, nongt_dim, emb_dim]
         sem_adj_matrix: [batch_size, num_objs, num_objs, num_edge_labels]
         spa_adj_matrix: [batch_size, num_objs, num_objs, num_edge_labels]
+        v_index: [batch_size] row of v, b, pos and the adj matrices of every
+            question, when they only hold the distinct images of the batch
 
         return: logits, not probs
         """
@@ -52,12 +54,16 @@ class ReGAT(nn.Module):
 
         # [batch_size, num_rois, out_dim]
         if self.relation_type == "semantic":
-            v_emb = self.v_relation.forward(v, sem_adj_matrix, q_emb_self_att)
+            v_emb = self.v_relation.forward(v, sem_adj_matrix, q_emb_self_att,
+                                            v_index)
         elif self.relation_type == "spatial":
-            v_emb = self.v_relation.forward(v, spa_adj_matrix, q_emb_self_att)
+            v_emb = self.v_relation.forward(v, spa_adj_matrix, q_emb_self_att,
+                                            v_index)
         else:  # implicit
             v_emb = self.v_relation.forward(v, implicit_pos_emb,
-                                            q_emb_self_att)
+                                            q_emb_self_att, v_index)
+        if v_index is not None:
+            b = b[v_index]
 
         if self.fusion == "ban":
             joint_emb, att = self.joint_embedding(v_emb, q_emb_seq, b)
@@ -55,12 +55,14 @@ class ImplicitRelationEncoder(nn.Module):
                                      num_heads=num_heads,
                                      pos_emb_dim=pos_emb_dim)
 
-    def forward(self, v, position_embedding, q):
+    def forward(self, v, position_embedding, q, v_index=None):
         """
         Args:
             v: [batch_size, num_rois, v_dim]
             q: [batch_size, q_dim]
             position_embedding: [batch_size, num_rois, nongt_dim, emb_dim]
+            v_index: [batch_size] row of v and position_embedding of every
+                question, which then only hold the distinct images
 
         Returns:
             output: [batch_size, num_rois, out_dim,3]
@@ -70,14 +72,17 @@ class ImplicitRelationEncoder(nn.Module):
             torch.ones(
                 v.size(0), v.size(1), v.size(1), 1)).to(v.device)
         imp_v = self.v_transform(v) if self.v_transform else v
+        if v_index is not None:
+            imp_v = imp_v[v_index]
 
         for i in range(self.num_steps):
             v_cat_q = q_expand_v_cat(q, imp_v, mask=True)
             imp_v_rel = self.implicit_relation.forward(v_cat_q,
                                                        imp_adj_mat,
-                                                       position_embedding)
+                                                       position_embedding,
+                                                       v_index)
             if self.residual_connection:
-                imp_v += imp_v_rel
+                imp_v = imp_v + imp_v_rel  # not in place, imp_v may be a ReLU output or v
             else:
                 imp_v = imp_v_rel
         return imp_v
@@ -108,23 +113,28 @@ class ExplicitRelationEncoder(nn.Module):
                                      label_bias=label_bias,
                                      pos_emb_dim=-1)
 
-    def forward(self, v, exp_adj_matrix, q):
+    def forward(self, v, exp_adj_matrix, q, v_index=None):
         """
         Args:
             v: [batch_size, num_rois, v_dim]
             q: [batch_size, q_dim]
             exp_adj_matrix: [batch_size, num_rois, num_rois, num_labels]
+            v_index: [batch_size] row of v and exp_adj_matrix of every
+                question, which then only hold the distinct images
 
         Returns:
             output: [batch_size, num_rois, out_dim]
         """
         exp_v = self.v_transform(v) if self.v_transform else v
+        if v_index is not None:
+            exp_v = exp_v[v_index]
 
         for i in range(self.num_steps):
             v_cat_q = q_expand_v_cat(q, exp_v, mask=True)
-            exp_v_rel = self.explicit_relation.forward(v_cat_q, exp_adj_matrix)
+            exp_v_rel = self.explicit_relation.forward(v_cat_q, exp_adj_matrix,
+                                                       v_index=v_index)
             if self.residual_connection:
-                exp_v += exp_v_rel
+                exp_v = exp_v + exp_v_rel  # not in place, exp_v may be a ReLU output or v
             else:
                 exp_v = exp_v_rel
         return exp_v
@@ -0,0 +1,136 @@
+"""The vectorized spatial graph builder against the pairwise loop it replaced
+(run from the ReGAT folder with ``python -m pytest tests``)."""
+
+import math
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from model.position_emb import bb_intersection_over_union, build_graph, build_graph_batch
+
+
+def reference_build_graph(bbox, spatial):
+    """build_graph as it was, one pair of boxes at a time."""
+    num_box = bbox.shape[0]
+    adj_matrix = np.zeros((num_box, num_box))
+    xmin, ymin, xmax, ymax = [a.ravel() for a in np.split(bbox, 4, axis=1)]
+    bbox_width = xmax - xmin + 1.
+    bbox_height = ymax - ymin + 1.
+    image_h = bbox_height[0]/spatial[0, -1]
+    image_w = bbox_width[0]/spatial[0, -2]
+    center_x = 0.5 * (xmin + xmax)
+    center_y = 0.5 * (ymin + ymax)
+    image_diag = math.sqrt(image_h**2 + image_w**2)
+    for i in range(num_box):
+        bbA = bbox[i]
+        if sum(bbA) == 0:
+            continue
+        adj_matrix[i, i] = 12
+        for j in range(i+1, num_box):
+            bbB = bbox[j]
+            if sum(bbB) == 0:
+                continue
+            # class 1: inside (j inside i)
+            if xmin[i] < xmin[j] and xmax[i] > xmax[j] and \
+               ymin[i] < ymin[j] and ymax[i] > ymax[j]:
+                adj_matrix[i, j] = 1
+                adj_matrix[j, i] = 2
+            # class 2: cover (j covers i)
+            elif (xmin[j] < xmin[i] and xmax[j] > xmax[i] and
+                  ymin[j] < ymin[i] and ymax[j] > ymax[i]):
+                adj_matrix[i, j] = 2
+                adj_matrix[j, i] = 1
+            else:
+                ioU = bb_intersection_over_union(bbA, bbB)
+                # class 3: i and j overlap
+                if ioU >= 0.5:
+                    adj_matrix[i, j] = 3
+                    adj_matrix[j, i] = 3
+                else:
+                    y_diff = center_y[i] - center_y[j]
+                    x_diff = center_x[i] - center_x[j]
+                    diag = math.sqrt((y_diff)**2 + (x_diff)**2)
+                    if diag < 0.5 * image_diag:
+                        sin_ij = y_diff/diag
+                        cos_ij = x_diff/diag
+                        if sin_ij >= 0 and cos_ij >= 0:
+                            label_i = np.arcsin(sin_ij)
+                            label_j = 2*math.pi - label_i
+                        elif sin_ij < 0 and cos_ij >= 0:
+                            label_i = np.arcsin(sin_ij)+2*math.pi
+                            label_j = label_i - math.pi
+                        elif sin_ij >= 0 and cos_ij < 0:
+                            label_i = np.arccos(cos_ij)
+                            label_j = 2*math.pi - label_i
+                        else:
+                            label_i = -np.arccos(sin_ij)+2*math.pi
+                            label_j = label_i - math.pi
+                        adj_matrix[i, j] = int(np.ceil(label_i/(math.pi/4)))+3
+                        adj_matrix[j, i] = int(np.ceil(label_j/(math.pi/4)))+3
+    return adj_matrix
+
+
+def random_image(rng, num_boxes, num_padding, dtype):
+    """Boxes of one image with nested and overlapping pairs, followed by
+    num_padding all zero boxes, and the spatial features giving its size."""
+    image_w, image_h = rng.uniform(200, 800, 2)
+    xy = rng.uniform(0, 0.6, (num_boxes, 2)) * [image_w, image_h]
+    wh = rng.uniform(0.05, 0.4, (num_boxes, 2)) * [image_w, image_h]
+    boxes = np.concatenate([xy, xy + wh], 1)
+    # shrunk (inside / cover) and shifted (overlap) copies of some boxes
+    for k in range(0, num_boxes - 1, 4):
+        boxes[k + 1] = boxes[k] + [3, 3, -3, -3]
+    for k in range(2, num_boxes - 1, 4):
+        boxes[k + 1] = boxes[k] + rng.uniform(1, 4)
+    boxes = np.concatenate([boxes, np.zeros((num_padding, 4))]).astype(dtype)
+    spatial = np.zeros((len(boxes), 6), dtype=dtype)
+    spatial[:, -2] = (boxes[:, 2] - boxes[:, 0] + 1) / image_w
+    spatial[:, -1] = (boxes[:, 3] - boxes[:, 1] + 1) / image_h
+    return boxes, spatial, image_w, image_h
+
+
+class BuildGraphTest(unittest.TestCase):
+
+    def test_build_graph(self):
+        rng = np.random.default_rng(0)
+        labels = set()
+        for dtype in (np.float32, np.float64):
+            for _ in range(30):
+                boxes, spatial, _, _ = random_image(rng, rng.integers(2, 40), rng.integers(0, 5), dtype)
+                with self.subTest(dtype=dtype.__name__, num_boxes=len(boxes)):
+                    expected = reference_build_graph(boxes, spatial)
+                    adj_matrix = build_graph(boxes, spatial)
+                    self.assertEqual(adj_matrix.dtype, np.float64)
+                    np.testing.assert_array_equal(adj_matrix, expected)
+                labels.update(np.unique(expected).tolist())
+        # every edge label occurs
+        self.assertEqual(labels, set(range(13)))
+
+    def test_padding(self):
+        boxes, spatial, _, _ = random_image(np.random.default_rng(1), 6, 3, np.float64)
+        adj_matrix = build_graph(boxes, spatial)
+        self.assertFalse(adj_matrix[6:].any())
+        self.assertFalse(adj_matrix[:, 6:].any())
+        np.testing.assert_array_equal(np.diag(adj_matrix)[:6], 12)
+
+    def test_build_graph_batch(self):
+        rng = np.random.default_rng(2)
+        for dtype in (np.float32, np.float64):
+            # images zero padded to the largest box count of the batch
+            images = [random_image(rng, num_boxes, 0, dtype) for num_boxes in (12, 5, 20)]
+            bbox = np.zeros((len(images), 20, 4), dtype=dtype)
+            for k, (boxes, _, _, _) in enumerate(images):
+                bbox[k, :len(boxes)] = boxes
+            adj_matrix = build_graph_batch(bbox, [image[2] for image in images], [image[3] for image in images])
+            self.assertEqual(adj_matrix.dtype, np.uint8)
+            for k, (boxes, spatial, _, _) in enumerate(images):
+                padded_spatial = np.zeros((20, 6), dtype=dtype)
+                padded_spatial[:len(boxes)] = spatial
+                np.testing.assert_array_equal(adj_matrix[k], reference_build_graph(bbox[k], padded_spatial))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""
+Compare the one-hot expansion of the adjacency matrices
+(torch_broadcast_adj_matrix) with the former per label loop.
+
+Usage:
+    python3 tools/benchmark_adj_matrix.py --batch_size 64 128 256 512 \
+        --num_boxes 36 100
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+import torch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model.position_emb import torch_broadcast_adj_matrix
+
+
+def loop_broadcast_adj_matrix(adj_matrix, label_num=11):
+    """The former implementation, one nonzero and scatter per label."""
+    result = []
+    for i in range(1, label_num+1):
+        index = torch.nonzero((adj_matrix == i).view(-1).data).squeeze()
+        curr_result = torch.zeros(
+            adj_matrix.shape[0], adj_matrix.shape[1], adj_matrix.shape[2])
+        curr_result = curr_result.view(-1)
+        curr_result[index] += 1
+        result.append(curr_result.view(
+            (adj_matrix.shape[0], adj_matrix.shape[1],
+             adj_matrix.shape[2], 1)))
+    return torch.cat(result, dim=3)
+
+
+def time_fn(fn, repeat, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / repeat
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, nargs='+',
+                        default=[64, 128, 256, 512])
+    parser.add_argument('--num_boxes', type=int, nargs='+', default=[36, 100])
+    parser.add_argument('--label_num', type=int, default=11)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--device', type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    device = torch.device(args.device)
+    print('device %s, label_num %d' % (device, args.label_num))
+    for num_boxes in args.num_boxes:
+        for batch_size in args.batch_size:
+            # the datasets hand over uint8 labels on the cpu, up to
+            # label_num + 1 for the spatial self loops
+            adj_matrix = torch.randint(
+                0, args.label_num + 2, (batch_size, num_boxes, num_boxes),
+                dtype=torch.uint8)
+            expected = loop_broadcast_adj_matrix(adj_matrix, args.label_num)
+            assert torch.equal(torch_broadcast_adj_matrix(
+                adj_matrix, args.label_num, device).cpu(), expected)
+
+            # the loop ran on the cpu and the result was then copied over
+            loop_time = time_fn(
+                lambda: loop_broadcast_adj_matrix(
+                    adj_matrix, args.label_num).to(device),
+                args.repeat, device)
+            scatter_time = time_fn(
+                lambda: torch_broadcast_adj_matrix(
+                    adj_matrix, args.label_num, device),
+                args.repeat, device)
+            print('boxes %3d batch %3d: loop %7.1fms, scatter %7.1fms, '
+                  'speedup %.1fx' % (num_boxes, batch_size, loop_time * 1e3,
+                                     scatter_time * 1e3,
+                                     loop_time / scatter_time))
@@ -0,0 +1,106 @@
+"""
+Compare the collate time per batch of trim_collate with PaddedCollate on
+synthetic PathVQA samples with an adaptive number of boxes.
+
+Both collate into shared memory, as they do in the DataLoader workers.
+
+Usage:
+    python3 tools/benchmark_collate.py --batch_size 64 256 \
+        --min_boxes 10 --max_boxes 100
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+import torch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, os.pardir))
+from utils import trim_collate
+from pvqa_features.collate import PaddedCollate
+from pvqa_features.targets import SparseTarget
+
+
+def make_samples(num_samples, min_boxes, max_boxes, feat_dim, num_answers,
+                 sparse):
+    """Samples shaped like those of PVQAFeatureDataset with a spatial
+    graph: features, normalized boxes, question, target, question_id,
+    image_id, boxes, spatial and (placeholder) semantic adjacency."""
+    samples = []
+    for i in range(num_samples):
+        num_boxes = int(torch.randint(min_boxes, max_boxes + 1, (1,)))
+        labels = torch.randint(0, num_answers, (2,)).unique()
+        scores = torch.rand(len(labels))
+        if sparse:
+            target = SparseTarget(labels, scores, num_answers)
+        else:
+            target = torch.zeros(num_answers)
+            target[labels] = scores
+        samples.append((
+            torch.rand(num_boxes, feat_dim), torch.rand(num_boxes, 6),
+            torch.randint(0, 4000, (14,)), target, i, 'train_%04d' % i,
+            torch.rand(num_boxes, 4),
+            torch.randint(0, 12, (num_boxes, num_boxes), dtype=torch.uint8),
+            torch.zeros(1, dtype=torch.uint8)))
+    return samples
+
+
+def time_fn(fn, batches, repeat):
+    for batch in batches[:1]:
+        fn(batch)
+    start_time = time.time()
+    for _ in range(repeat):
+        for batch in batches:
+            fn(batch)
+    return (time.time() - start_time) / (repeat * len(batches))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[64, 256])
+    parser.add_argument('--min_boxes', type=int, default=10)
+    parser.add_argument('--max_boxes', type=int, default=100)
+    parser.add_argument('--feat_dim', type=int, default=2048)
+    parser.add_argument('--num_answers', type=int, default=4092)
+    parser.add_argument('--num_batches', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    for batch_size in args.batch_size:
+        batches, sparse_batches = [], []
+        for _ in range(args.num_batches):
+            state = torch.random.get_rng_state()
+            batches.append(make_samples(
+                batch_size, args.min_boxes, args.max_boxes, args.feat_dim,
+                args.num_answers, sparse=False))
+            torch.random.set_rng_state(state)
+            sparse_batches.append(make_samples(
+                batch_size, args.min_boxes, args.max_boxes, args.feat_dim,
+                args.num_answers, sparse=True))
+
+        # what trim_collate does with a batch of tuples
+        def trim(batch):
+            return [trim_collate(samples) for samples in zip(*batch)]
+        collate = PaddedCollate(shared=True)
+        for batch, sparse_batch in zip(batches, sparse_batches):
+            expected, padded = trim(batch), collate(sparse_batch)
+            assert padded.num_boxes == expected[0].size(1)
+            for i, (x, y) in enumerate(zip(expected, padded)):
+                if i == 3:
+                    y = y.cpu()
+                assert torch.equal(x, y) if torch.is_tensor(x) \
+                    else list(x) == list(y)
+
+        num_boxes = sum(collate(batch).num_boxes for batch in sparse_batches)
+        trim_time = time_fn(trim, batches, args.repeat)
+        padded_time = time_fn(collate, sparse_batches, args.repeat)
+        print('batch %3d, %d to %d boxes (%.1f padded to): trim_collate '
+              '%7.2fms, PaddedCollate %7.2fms, speedup %.1fx'
+              % (batch_size, args.min_boxes, args.max_boxes,
+                 num_boxes / len(sparse_batches), trim_time * 1e3,
+                 padded_time * 1e3, trim_time / padded_time))
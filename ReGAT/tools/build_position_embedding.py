@@ -0,0 +1,85 @@
+"""
+Write the implicit relation position embedding of every image
+(image_pos_emb) into a feature h5 file, so that training and evaluation with
+--precomputed_pos_emb read it instead of computing it for every batch.
+
+The embedding only depends on the boxes of an image: it is stored in half
+precision as [num_images, min(max_boxes, nongt_dim), max_boxes, pos_emb_dim],
+with the images padded by zero boxes like trim_collate pads a batch, and
+prepare_graph_variables slices it to the boxes of each batch. nongt_dim and
+pos_emb_dim must match the model, they are kept as attributes.
+
+Usage:
+    python3 tools/build_position_embedding.py \
+        data/Bottom-up-features-fixed/train36.hdf5 --nongt_dim 20
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+import h5py
+import torch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model.position_emb import torch_extract_position_matrix, \
+    torch_extract_position_embedding
+from tools.build_spatial_graph import padded_boxes, read_boxes
+
+
+def build_position_embedding(h5_path, nongt_dim=20, pos_emb_dim=64,
+                             batch_size=64, device=torch.device('cpu'),
+                             overwrite=False):
+    with h5py.File(h5_path, 'r+') as hf:
+        if 'image_pos_emb' in hf:
+            if not overwrite:
+                print('%s already has an image_pos_emb, use --overwrite'
+                      % h5_path)
+                return
+            del hf['image_pos_emb']
+        bb, pos_boxes, num_images, max_boxes = read_boxes(hf)
+        num_rows = min(max_boxes, nongt_dim)
+
+        print('Building the position embeddings of %d images with up to %d '
+              'boxes' % (num_images, max_boxes))
+        start_time = time.time()
+        pos_emb = hf.create_dataset(
+            'image_pos_emb', (num_images, num_rows, max_boxes, pos_emb_dim),
+            'f2', chunks=(1, num_rows, max_boxes, pos_emb_dim))
+        pos_emb.attrs['nongt_dim'] = nongt_dim
+        pos_emb.attrs['pos_emb_dim'] = pos_emb_dim
+        with torch.no_grad():
+            for start in range(0, num_images, batch_size):
+                end = min(start + batch_size, num_images)
+                batch = torch.from_numpy(
+                    padded_boxes(bb, pos_boxes, start, end, max_boxes))
+                pos_mat = torch_extract_position_matrix(
+                    batch.to(device), nongt_dim=nongt_dim)
+                emb = torch_extract_position_embedding(
+                    pos_mat, feat_dim=pos_emb_dim, device=device)
+                pos_emb[start:end] = emb.half().cpu().numpy()
+        print('Wrote image_pos_emb to %s in %d seconds.'
+              % (h5_path, time.time() - start_time))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('h5_files', nargs='+',
+                        help='feature h5 files to add the embeddings to')
+    parser.add_argument('--nongt_dim', type=int, default=20)
+    parser.add_argument('--imp_pos_emb_dim', type=int, default=64)
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='images embedded at once')
+    parser.add_argument('--device', type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='replace an existing image_pos_emb')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    for h5_path in args.h5_files:
+        build_position_embedding(h5_path, args.nongt_dim,
+                                 args.imp_pos_emb_dim, args.batch_size,
+                                 torch.device(args.device), args.overwrite)
@@ -0,0 +1,111 @@
+"""
+Write the spatial relation graph of every image (image_adj_matrix) into a
+feature h5 file, as read by the datasets with --relation_type spatial.
+
+Works on the bottom-up feature files (image_bb and spatial_features, fixed or
+adaptive with pos_boxes) and on the PathVQA files written by
+`python -m pvqa_features.convert_tsv --format hdf5` (image_bb, pos_boxes,
+image_w and image_h).
+
+Usage:
+    python3 tools/build_spatial_graph.py data/pvqa/images/train.hdf5
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+import h5py
+import numpy as np
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model.position_emb import build_graph_batch
+
+
+def image_sizes(hf, bb, pos_boxes):
+    """Image widths and heights, recovered from the first box if needed."""
+    if 'image_w' in hf and 'image_h' in hf:
+        return hf['image_w'][()], hf['image_h'][()]
+    spatial = hf['spatial_features'][()]
+    if pos_boxes is None:
+        first_bb, first_spatial = bb[:, 0], spatial[:, 0]
+    else:
+        first_bb, first_spatial = bb[pos_boxes[:, 0]], spatial[pos_boxes[:, 0]]
+    # same as build_graph
+    image_h = (first_bb[:, 3] - first_bb[:, 1] + 1.) / first_spatial[:, -1]
+    image_w = (first_bb[:, 2] - first_bb[:, 0] + 1.) / first_spatial[:, -2]
+    return image_w, image_h
+
+
+def read_boxes(hf):
+    """Return image_bb, pos_boxes (None for a fixed number of boxes), the
+    number of images and the largest number of boxes of an image."""
+    bb = hf['image_bb'][()]
+    pos_boxes = hf['pos_boxes'][()] if 'pos_boxes' in hf else None
+    if pos_boxes is None:
+        num_images, max_boxes = bb.shape[:2]
+    else:
+        num_images = len(pos_boxes)
+        num_boxes = pos_boxes[:, 1] - pos_boxes[:, 0]
+        max_boxes = int(num_boxes.max()) if num_images else 0
+    return bb, pos_boxes, num_images, max_boxes
+
+
+def padded_boxes(bb, pos_boxes, start, end, max_boxes):
+    """[end - start, max_boxes, 4] boxes of images start:end, padded like
+    trim_collate pads a batch."""
+    if pos_boxes is None:
+        return bb[start:end]
+    # zero boxes pad the images with fewer boxes
+    batch = np.zeros((end - start, max_boxes, 4), dtype=bb.dtype)
+    for i in range(start, end):
+        batch[i - start, :pos_boxes[i, 1] - pos_boxes[i, 0]] = \
+            bb[pos_boxes[i, 0]:pos_boxes[i, 1]]
+    return batch
+
+
+def build_spatial_graph(h5_path, label_num=11, batch_size=512,
+                        overwrite=False):
+    with h5py.File(h5_path, 'r+') as hf:
+        if 'image_adj_matrix' in hf:
+            if not overwrite:
+                print('%s already has an image_adj_matrix, use --overwrite'
+                      % h5_path)
+                return
+            del hf['image_adj_matrix']
+        bb, pos_boxes, num_images, max_boxes = read_boxes(hf)
+        image_w, image_h = image_sizes(hf, bb, pos_boxes)
+
+        print('Building the spatial graphs of %d images with up to %d boxes'
+              % (num_images, max_boxes))
+        start_time = time.time()
+        adj_matrix = hf.create_dataset(
+            'image_adj_matrix', (num_images, max_boxes, max_boxes), 'u1',
+            chunks=(max(min(64, num_images), 1), max_boxes, max_boxes))
+        for start in range(0, num_images, batch_size):
+            end = min(start + batch_size, num_images)
+            batch = padded_boxes(bb, pos_boxes, start, end, max_boxes)
+            adj_matrix[start:end] = build_graph_batch(
+                batch, image_w[start:end], image_h[start:end],
+                label_num=label_num)
+        print('Wrote image_adj_matrix to %s in %d seconds.'
+              % (h5_path, time.time() - start_time))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('h5_files', nargs='+',
+                        help='feature h5 files to add the graphs to')
+    parser.add_argument('--spa_label_num', type=int, default=11)
+    parser.add_argument('--batch_size', type=int, default=512,
+                        help='images labeled at once')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='replace an existing image_adj_matrix')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    for h5_path in args.h5_files:
+        build_spatial_graph(h5_path, args.spa_label_num, args.batch_size,
+                            args.overwrite)
@@ -6,12 +6,12 @@ This code is modified by Linjie Li from Jin-Hwa Kim's repository.
 https://github.com/jnhwkim/ban-vqa
 MIT License
 """
+import contextlib
 import os
 import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
 import torch.optim.lr_scheduler as lr_scheduler
 from tqdm import tqdm
 import json
@@ -21,12 +21,15 @@ import datetime
 from dataset_modify import question_types, get_q_type
 import utils
 from model.position_emb import prepare_graph_variables
+from pvqa_features.amp import autocast, grad_scaler, scaler_state
+from pvqa_features.distributed import all_gather_objects, all_reduce_sum, is_main_process, unwrap
+from pvqa_features.sampler import DistributedEvalSampler
 
 
 def instance_bce_with_logits(logits, labels, reduction='mean'):
     assert logits.dim() == 2
     loss = F.binary_cross_entropy_with_logits(
-                                logits, labels, reduction=reduction)
+                                logits.float(), labels, reduction=reduction)
     if reduction == "mean":
         loss *= labels.size(1)
     return loss
@@ -43,7 +46,19 @@ def compute_score_with_logits(logits, labels, device):
 
 
 def train(model, train_loader, eval_loader, test_loader, args, device=torch.device("cuda")):
-    N = len(train_loader.dataset)
+    """
+    Every args.grad_accu_steps mini-batches make one optimizer step: their
+    gradients are accumulated, then unscaled (--amp), clipped once and
+    applied. A last, shorter group of the epoch is stepped on its own.
+
+    model may be wrapped in DistributedDataParallel; then the loaders shard
+    the data over the ranks, the gradients are all-reduced once per optimizer
+    step (no_sync in the other mini-batches), the losses and scores are
+    reduced and averaged over the samples the ranks saw (DistributedSampler
+    pads the shards with repeated samples), and only rank 0 logs and saves
+    checkpoints.
+    """
+    core = unwrap(model)
     lr_default = args.base_lr
     num_epochs = args.epochs
     lr_decay_epochs = range(args.lr_decay_start, num_epochs,
@@ -55,23 +70,30 @@ def train(model, train_loader, eval_loader, test_loader, args, device=torch.devi
                                       model.parameters()),
                                lr=lr_default, betas=(0.9, 0.999), eps=1e-8,
                                weight_decay=args.weight_decay) 
+    # float16 loss scaling on GPU, disabled without --amp and on CPU
+    scaler = grad_scaler(device, args.amp)
 
-    logger = utils.Logger(os.path.join(args.output, 'log.txt'))
+    logger = utils.Logger(os.path.join(args.output, 'log.txt'), enabled=is_main_process())
     best_eval_score = 0
 
-    utils.print_model(model, logger)
+    utils.print_model(core, logger)
     logger.write('optim: adamax lr=%.4f, decay_step=%d, decay_rate=%.2f,'
                  % (lr_default, args.lr_decay_step,
                     args.lr_decay_rate) + 'grad_clip=%.2f' % args.grad_clip)
     logger.write('LR decay epochs: '+','.join(
                                         [str(i) for i in lr_decay_epochs]))
+    logger.write('grad_accu_steps: %d, amp: %s' % (args.grad_accu_steps, args.amp))
     last_eval_score, eval_score = 0, 0
     relation_type = train_loader.dataset.relation_type
 
     for epoch in range(0, num_epochs):
+        # reshuffles DistributedSampler and BucketBatchSampler
+        for sampler in (train_loader.sampler, train_loader.batch_sampler):
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
         pbar = tqdm(total=len(train_loader))
         total_norm, count_norm = 0, 0
-        total_loss, train_score = 0, 0
+        total_loss, train_score, num_samples = 0, 0, 0
         count, average_loss, att_entropy = 0, 0, 0
         t = time.time()
         if epoch < len(gradual_warmup_steps):
@@ -88,65 +110,90 @@ def train(model, train_loader, eval_loader, test_loader, args, device=torch.devi
             logger.write('lr: %.4f' % optim.param_groups[-1]['lr'])
         last_eval_score = eval_score
 
-        mini_batch_count = 0
-        batch_multiplier = args.grad_accu_steps
+        accu_steps = max(1, args.grad_accu_steps)
+        num_batches = len(train_loader)
+        num_steps = 0
+        optim.zero_grad(set_to_none=True)
+        train_time = time.time()
         for i, (v, norm_bb, q, target, _, _, bb, spa_adj_matrix,
                 sem_adj_matrix) in enumerate(train_loader):
             batch_size = v.size(0)
             num_objects = v.size(1)
-            if mini_batch_count == 0:
-                optim.step()
-                optim.zero_grad()
-                mini_batch_count = batch_multiplier
-
-            v = Variable(v).to(device)
-            norm_bb = Variable(norm_bb).to(device)
-            q = Variable(q).to(device)
-            target = Variable(target).to(device)
-            pos_emb, sem_adj_matrix, spa_adj_matrix = prepare_graph_variables(
-                relation_type, bb, sem_adj_matrix, spa_adj_matrix, num_objects,
-                args.nongt_dim, args.imp_pos_emb_dim, args.spa_label_num,
-                args.sem_label_num, device)
-            pred, att = model(v, norm_bb, q, pos_emb, sem_adj_matrix,
-                              spa_adj_matrix, target)
-            loss = instance_bce_with_logits(pred, target)
-
-            loss /= batch_multiplier
-            loss.backward()
-            mini_batch_count -= 1
-            total_norm += nn.utils.clip_grad_norm_(model.parameters(),
-                                                   args.grad_clip)
-            count_norm += 1
-            batch_score = compute_score_with_logits(pred, target, device).sum()
-            total_loss += loss.data.item() * batch_multiplier * v.size(0)
+            # mini-batches of this optimizer step, the last one of the
+            # epoch may be shorter
+            group_size = min(accu_steps, num_batches - i // accu_steps * accu_steps)
+            is_step = (i + 1) % accu_steps == 0 or i + 1 == num_batches
+            # DDP all-reduces the gradients only in the last mini-batch of a step
+            if isinstance(model, nn.parallel.DistributedDataParallel) and not is_step:
+                sync_context = model.no_sync()
+            else:
+                sync_context = contextlib.nullcontext()
+
+            v = v.to(device, non_blocking=True)
+            norm_bb = norm_bb.to(device, non_blocking=True)
+            q = q.to(device, non_blocking=True)
+            target = target.to(device, non_blocking=True)
+            with sync_context:
+                with autocast(device, args.amp):
+                    pos_emb, sem_adj_matrix, spa_adj_matrix = prepare_graph_variables(
+                        relation_type, bb, sem_adj_matrix, spa_adj_matrix, num_objects,
+                        args.nongt_dim, args.imp_pos_emb_dim, args.spa_label_num,
+                        args.sem_label_num, device)
+                    pred, att = model(v, norm_bb, q, pos_emb, sem_adj_matrix,
+                                      spa_adj_matrix, target)
+                    loss = instance_bce_with_logits(pred, target)
+
+                scaler.scale(loss / group_size).backward()
+            if is_step:
+                # clip the true gradients of the whole step once
+                scaler.unscale_(optim)
+                total_norm += nn.utils.clip_grad_norm_(model.parameters(),
+                                                       args.grad_clip)
+                count_norm += 1
+                # skipped when the fp16 gradients overflowed
+                scaler.step(optim)
+                scaler.update()
+                optim.zero_grad(set_to_none=True)
+                num_steps += 1
+
+            # summed on the device, no synchronization per mini-batch
+            batch_score = compute_score_with_logits(pred.detach(), target, device).sum()
+            total_loss += loss.detach() * batch_size
             train_score += batch_score
+            num_samples += batch_size
             pbar.update(1)
 
             if args.log_interval > 0:
-                average_loss += loss.data.item() * batch_multiplier
-                if model.fusion == "ban":
-                    current_att_entropy = torch.sum(calc_entropy(att.data))
+                # kept on the device, read back only when printed
+                average_loss += loss.detach()
+                if core.fusion == "ban":
+                    current_att_entropy = torch.sum(calc_entropy(att.data.float()))
                     att_entropy += current_att_entropy / batch_size / att.size(1)
                 count += 1
                 if i % args.log_interval == 0:
-                    att_entropy /= count
-                    average_loss /= count
                     print("step {} / {} (epoch {}), ave_loss {:.3f},".format(
                             i, len(train_loader), epoch,
-                            average_loss),
-                          "att_entropy {:.3f}".format(att_entropy))
+                            average_loss.item() / count),
+                          "att_entropy {:.3f}".format(float(att_entropy) / count))
                     average_loss = 0
                     count = 0
                     att_entropy = 0
 
-        total_loss /= N
-        train_score = 100 * train_score / N
+        # sums over the shards of every rank, in one all-reduce
+        total_loss, train_score, num_samples = all_reduce_sum(torch.stack(
+            [torch.as_tensor(x, dtype=torch.float64, device=device)
+             for x in (total_loss, train_score, num_samples)])).tolist()
+        train_time = time.time() - train_time
+        total_loss /= num_samples
+        train_score = 100 * train_score / num_samples
 
         if eval_loader is not None:
             eval_score, bound, entropy = evaluate(
-                model, eval_loader, device, args)
+                core, eval_loader, device, args)
 
         logger.write('epoch %d, time: %.2f' % (epoch, time.time()-t))
+        logger.write('\ttrain: %.2fs, %d steps, %.1f samples/sec'
+                     % (train_time, num_steps, num_samples / train_time))
         logger.write('\ttrain_loss: %.2f, norm: %.4f, score: %.2f'
                      % (total_loss, total_norm / count_norm, train_score))
 
@@ -161,15 +208,16 @@ def train(model, train_loader, eval_loader, test_loader, args, device=torch.devi
 
         if (eval_loader is not None)\
            or (eval_loader is None and epoch >= args.saving_epoch):
-               if last_eval_score < eval_score:
+               if last_eval_score < eval_score and is_main_process():
                     logger.write("saving current model weights to folder")
                     model_path = os.path.join(args.output, 'model_%d.pth' % epoch)
                     opt = optim if args.save_optim else None
-                    utils.save_model(model_path, model, epoch, opt)
+                    utils.save_model(model_path, core, epoch, opt,
+                                     scaler_state(scaler) if args.save_optim else None)
 
         if epoch == num_epochs - 1 and test_loader is not None:
             logger.write('Final epoch %d, time: %.2f, test evaluation' % (epoch, time.time()-t))
-            test_score = test_evaluate(model, test_loader, args, device)
+            test_score = test_evaluate(core, test_loader, args, device)
             logger.write('\ttest score: %.2f'
                          % (100 * test_score))
 
@@ -183,26 +231,30 @@ def evaluate(model, dataloader, device, args):
     score = 0
     upper_bound = 0
     num_data = 0
-    N = len(dataloader.dataset)
     entropy = None
     if model.fusion == "ban":
         entropy = torch.Tensor(model.glimpse).zero_().to(device)
     pbar = tqdm(total=len(dataloader))
 
-    for i, (v, norm_bb, q, target, _, _, bb, spa_adj_matrix,
-            sem_adj_matrix) in enumerate(dataloader):
-        batch_size = v.size(0)
+    for i, batch in enumerate(dataloader):
+        (v, norm_bb, q, target, _, _, bb, spa_adj_matrix,
+         sem_adj_matrix) = batch
+        # row of the image of every question when batches are grouped by image
+        v_index = getattr(batch, 'v_index', None)
+        if v_index is not None:
+            v_index = v_index.to(device, non_blocking=True)
         num_objects = v.size(1)
-        v = Variable(v).to(device)
-        norm_bb = Variable(norm_bb).to(device)
-        q = Variable(q).to(device)
-        target = Variable(target).to(device)
-        pos_emb, sem_adj_matrix, spa_adj_matrix = prepare_graph_variables(
-            relation_type, bb, sem_adj_matrix, spa_adj_matrix, num_objects,
-            args.nongt_dim, args.imp_pos_emb_dim, args.spa_label_num,
-            args.sem_label_num, device)
-        pred, att = model(v, norm_bb, q, pos_emb, sem_adj_matrix,
-                          spa_adj_matrix, target)
+        v = v.to(device, non_blocking=True)
+        norm_bb = norm_bb.to(device, non_blocking=True)
+        q = q.to(device, non_blocking=True)
+        target = target.to(device, non_blocking=True)
+        with autocast(device, getattr(args, 'amp', False)):
+            pos_emb, sem_adj_matrix, spa_adj_matrix = prepare_graph_variables(
+                relation_type, bb, sem_adj_matrix, spa_adj_matrix, num_objects,
+                args.nongt_dim, args.imp_pos_emb_dim, args.spa_label_num,
+                args.sem_label_num, device)
+            pred, att = model(v, norm_bb, q, pos_emb, sem_adj_matrix,
+                              spa_adj_matrix, target, v_index=v_index)
         batch_score = compute_score_with_logits(
                         pred, target, device).sum()
         score += batch_score
@@ -210,14 +262,18 @@ def evaluate(model, dataloader, device, args):
         num_data += pred.size(0)
         if att is not None and 0 < model.glimpse\
                 and entropy is not None:
-            entropy += calc_entropy(att.data)[:model.glimpse]
+            entropy += calc_entropy(att.data.float())[:model.glimpse]
         pbar.update(1)
 
-    score = score / len(dataloader.dataset)
-    upper_bound = upper_bound / len(dataloader.dataset)
+    # sums over the shards of every rank, averaged over the samples they saw
+    score = all_reduce_sum(torch.as_tensor(score, dtype=torch.float, device=device))
+    upper_bound = all_reduce_sum(torch.as_tensor(upper_bound, dtype=torch.float, device=device))
+    num_data = all_reduce_sum(torch.as_tensor(num_data, dtype=torch.float, device=device))
+    score = score / num_data
+    upper_bound = upper_bound / num_data
 
     if entropy is not None:
-        entropy = entropy / len(dataloader.dataset)
+        entropy = all_reduce_sum(entropy) / num_data
     model.train()
     return score, upper_bound, entropy
 
@@ -227,27 +283,30 @@ def test_evaluate(model, dataloader, args, device):
     label2ans = dataloader.dataset.label2ans
     num_answers = len(label2ans)
     relation_type = dataloader.dataset.relation_type
-    N = len(dataloader.dataset)
+    num_data = 0
     results = []
     scores = []
     score = 0
 
     for i, (v, norm_bb, q, target, qid, _, bb, spa_adj_matrix, sem_adj_matrix) in enumerate(dataloader):
         batch_size = v.size(0)
+        num_data += batch_size
         num_objects = v.size(1)
-        v = Variable(v).to(device)
-        norm_bb = Variable(norm_bb).to(device)
-        q = Variable(q).to(device)
-        pos_emb, sem_adj_matrix, spa_adj_matrix = prepare_graph_variables(
-            relation_type, bb, sem_adj_matrix, spa_adj_matrix, num_objects,
-            args.nongt_dim, args.imp_pos_emb_dim,
-            args.spa_label_num, args.sem_label_num, device)
-        pred, att = model(v, norm_bb, q, pos_emb, sem_adj_matrix,
-                          spa_adj_matrix, None)
-
-        # Check if target is a placeholder or actual targets
-        if target.size(-1) == num_answers:
-            target = Variable(target).to(device)
+        v = v.to(device, non_blocking=True)
+        norm_bb = norm_bb.to(device, non_blocking=True)
+        q = q.to(device, non_blocking=True)
+        with autocast(device, getattr(args, 'amp', False)):
+            pos_emb, sem_adj_matrix, spa_adj_matrix = prepare_graph_variables(
+                relation_type, bb, sem_adj_matrix, spa_adj_matrix, num_objects,
+                args.nongt_dim, args.imp_pos_emb_dim,
+                args.spa_label_num, args.sem_label_num, device)
+            pred, att = model(v, norm_bb, q, pos_emb, sem_adj_matrix,
+                              spa_adj_matrix, None)
+
+        # Check if target is a placeholder or actual targets, the PathVQA
+        # datasets hand over SparseTargets
+        if not torch.is_tensor(target) or target.size(-1) == num_answers:
+            target = target.to(device)
             base_scores = compute_score_with_logits(
                 pred, target, device)
             batch_score = base_scores.sum()
@@ -255,16 +314,25 @@ def test_evaluate(model, dataloader, args, device):
             scores.append(base_scores.detach().cpu().numpy().sum(-1))
             
         qid = qid.cpu()
-        pred = pred.cpu()
+        pred = pred.float().cpu()
         target = target.cpu()
         current_results = make_json(pred, qid, dataloader, target)
         results.extend(current_results)
-        results_folder = f"{args.output}/results"
-        utils.create_dir(results_folder)
-        save_to = f"{results_folder}/{args.dataset}.json"
-        json.dump(results, open(save_to, "w"))
 
     scores = np.concatenate(scores).ravel()
+    score = all_reduce_sum(torch.as_tensor(score, dtype=torch.float, device=device))
+    num_data = all_reduce_sum(torch.as_tensor(num_data, dtype=torch.float, device=device))
+    if isinstance(dataloader.sampler, DistributedEvalSampler):
+        # back to dataset order, from the shards of every rank
+        results = DistributedEvalSampler.merge(all_gather_objects(results))
+        scores = np.asarray(DistributedEvalSampler.merge(all_gather_objects(scores.tolist())))
+    if not is_main_process():
+        return score / num_data
+
+    results_folder = f"{args.output}/results"
+    utils.create_dir(results_folder)
+    save_to = f"{results_folder}/{args.dataset}.json"
+    json.dump(results, open(save_to, "w"))
 
     qtype_score = {qtype: 0. for qtype in question_types}
     qtype_cnt = {qtype: 0 for qtype in question_types}
@@ -282,7 +350,7 @@ def test_evaluate(model, dataloader, args, device):
         f.write(info)
         print(info)
 
-    score = score / N
+    score = score / num_data
     return score
 
 
@@ -15,6 +15,7 @@ import collections
 import numpy as np
 import operator
 import functools
+import h5py
 from PIL import Image
 import torch
 import torch.nn as nn
@@ -73,13 +74,16 @@ def print_model(model, logger):
         logger.write('nParams=\t'+str(nParams))
 
 
-def save_model(path, model, epoch, optimizer=None):
+def save_model(path, model, epoch, optimizer=None, scaler_state=None):
     model_dict = {
             'epoch': epoch,
             'model_state': model.state_dict()
         }
     if optimizer is not None:
         model_dict['optimizer_state'] = optimizer.state_dict()
+    if scaler_state is not None:
+        # GradScaler of --amp runs
+        model_dict['scaler_state'] = scaler_state
 
     torch.save(model_dict, path)
 
@@ -104,7 +108,7 @@ def trim_collate(batch):
     if torch.is_tensor(batch[0]):
         out = None
 
-        if 1 < batch[0].dim():  # image features
+        if 2 == batch[0].dim():  # image features
             max_num_boxes = max([x.size(0) for x in batch])
             if _use_shared_memory:
                 # If we're in a background process, concatenate directly into a
@@ -130,7 +134,7 @@ def trim_collate(batch):
                            (0, max_num_boxes-x.size(0),
                             0, max_num_boxes-x.size(0))).data for x in batch],
                     0, out=out)
-        else:
+        else:  # same size in every sample, e.g. precomputed pos_emb
             if _use_shared_memory:
                 # If we're in a background process, concatenate directly into a
                 # shared memory tensor to avoid an extra copy
@@ -168,7 +172,15 @@ def trim_collate(batch):
 
 
 class Logger(object):
-    def __init__(self, output_name, reset=False):
+    def __init__(self, output_name, reset=False, enabled=True):
+        """
+        :param enabled: False on the other ranks of a distributed run, which
+            then neither open the file nor write or print anything.
+        """
+        self.enabled = enabled
+        self.infos = {}
+        if not enabled:
+            return
         dirname = os.path.dirname(output_name)
         if not os.path.exists(dirname):
             os.mkdir(dirname)
@@ -176,7 +188,6 @@ class Logger(object):
             self.log_file = open(output_name, 'a')
         else:
             self.log_file = open(output_name, 'w')
-        self.infos = {}
 
     def append(self, key, val):
         vals = self.infos.setdefault(key, [])
@@ -187,17 +198,157 @@ class Logger(object):
         for key, vals in self.infos.iteritems():
             msgs.append('%s %.6f' % (key, np.mean(vals)))
         msg = '\n'.join(msgs)
-        self.log_file.write(msg + '\n')
-        self.log_file.flush()
+        if self.enabled:
+            self.log_file.write(msg + '\n')
+            self.log_file.flush()
         self.infos = {}
         return msg
 
     def write(self, msg):
+        if not self.enabled:
+            return
         self.log_file.write(msg + '\n')
         self.log_file.flush()
         print(msg)
 
 
+
+def adj_labels(adj_matrix):
+    """Edge labels of an adjacency matrix as uint8.
+
+    The spatial and semantic graphs only hold small integer labels (0 for no
+    edge), they are expanded to one-hot on the device by
+    prepare_graph_variables.
+    """
+    return np.asarray(adj_matrix, dtype=np.uint8)
+
+
+def read_adj_matrix(dataset):
+    """Read an h5 adjacency dataset straight into a uint8 array."""
+    adj_matrix = np.empty(dataset.shape, dtype=np.uint8)
+    dataset.read_direct(adj_matrix)
+    return adj_matrix
+
+
+class H5ImageReader(object):
+    """Read the rows of single images from a feature HDF5 file on demand.
+
+    Every process (i.e. every DataLoader worker) opens the file once, the
+    first time it reads from it. Decoded images are kept in a small LRU
+    cache; with prefetch > 0 the aligned block of `prefetch` images around a
+    missed image is read at once and cached as well, which turns scattered
+    small reads into chunk sized ones for (mostly) sequential access.
+
+    image_keys are indexed by image, box_keys by box: with pos_boxes
+    (adaptive features) image i owns the rows pos_boxes[i, 0]:pos_boxes[i, 1]
+    of the box datasets, otherwise box datasets are indexed by image too.
+    """
+
+    def __init__(self, path, box_keys, image_keys=(), pos_boxes=None,
+                 cache_size=512, prefetch=0):
+        self.path = path
+        self.box_keys = list(box_keys)
+        self.image_keys = list(image_keys)
+        self.pos_boxes = pos_boxes
+        self.cache_size = cache_size
+        first_key = (self.box_keys + self.image_keys)[0]
+        with h5py.File(path, 'r') as hf:
+            self.shapes = {key: hf[key].shape
+                           for key in self.box_keys + self.image_keys}
+            chunks = hf[first_key].chunks
+        self.num_images = len(pos_boxes) if pos_boxes is not None \
+            else self.shapes[first_key][0]
+        if prefetch < 0:
+            # one HDF5 chunk of the first dataset, at least one image
+            prefetch = max(chunks[0] if chunks else 1, 1)
+            if pos_boxes is not None and len(pos_boxes):
+                prefetch = max(prefetch * len(pos_boxes) //
+                               int(pos_boxes[-1][1]), 1)
+        self.prefetch = prefetch
+        self._h5 = None
+        self._pid = None
+        self._cache = collections.OrderedDict()
+
+    def _file(self):
+        if self._h5 is None or self._pid != os.getpid():
+            self._h5 = h5py.File(self.path, 'r')
+            self._pid = os.getpid()
+            self._cache.clear()
+        return self._h5
+
+    def _read(self, start, end):
+        """Read images start:end with one read per dataset."""
+        hf = self._file()
+        blocks = {}
+        for key in self.image_keys:
+            blocks[key] = hf[key][start:end]
+        if self.pos_boxes is None:
+            for key in self.box_keys:
+                blocks[key] = hf[key][start:end]
+            return [{key: block[i] for key, block in blocks.items()}
+                    for i in range(end - start)]
+        first = int(self.pos_boxes[start][0])
+        last = int(self.pos_boxes[end - 1][1])
+        for key in self.box_keys:
+            blocks[key] = hf[key][first:last]
+        images = []
+        for i in range(end - start):
+            rows = {key: blocks[key][i] for key in self.image_keys}
+            lo = int(self.pos_boxes[start + i][0]) - first
+            hi = int(self.pos_boxes[start + i][1]) - first
+            for key in self.box_keys:
+                rows[key] = blocks[key][lo:hi]
+            images.append(rows)
+        return images
+
+    def __getitem__(self, idx):
+        self._file()
+        if idx in self._cache:
+            self._cache.move_to_end(idx)
+            return self._cache[idx]
+        if self.prefetch > 1:
+            start = idx // self.prefetch * self.prefetch
+            end = min(start + self.prefetch, self.num_images)
+        else:
+            start, end = idx, idx + 1
+        for i, rows in enumerate(self._read(start, end), start):
+            self._cache[i] = rows
+            self._cache.move_to_end(i)
+        while len(self._cache) > max(self.cache_size, end - start):
+            self._cache.popitem(last=False)
+        return self._cache[idx]
+
+    def __len__(self):
+        return self.num_images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_h5'] = None
+        state['_cache'] = collections.OrderedDict()
+        return state
+
+
+def pos_emb_reader(h5_path, nongt_dim, pos_emb_dim, cache_size=512,
+                   prefetch=0):
+    """H5ImageReader of the implicit position embeddings (image_pos_emb)
+    written into a feature h5 file by tools/build_position_embedding.py.
+    """
+    with h5py.File(h5_path, 'r') as hf:
+        if 'image_pos_emb' not in hf:
+            raise ValueError(
+                f"{h5_path} has no image_pos_emb, build it with "
+                f"tools/build_position_embedding.py")
+        attrs = hf['image_pos_emb'].attrs
+        if (attrs['nongt_dim'], attrs['pos_emb_dim']) != \
+                (nongt_dim, pos_emb_dim):
+            raise ValueError(
+                f"image_pos_emb of {h5_path} was built with nongt_dim "
+                f"{attrs['nongt_dim']} and pos_emb_dim {attrs['pos_emb_dim']}"
+                f", not {nongt_dim} and {pos_emb_dim}")
+    return H5ImageReader(h5_path, (), ['image_pos_emb'],
+                         cache_size=cache_size, prefetch=prefetch)
+
+
 def create_glove_embedding_init(idx2word, glove_file):
     word2emb = {}
     with open(glove_file, 'r', encoding='utf-8') as f:
@@ -0,0 +1,6 @@
+from pvqa_features.base import FeatureBackend, find_invalid_box, normalize_bbox
+from pvqa_features.backends import BACKENDS, Hdf5Features, InMemoryFeatures, open_features
+from pvqa_features.store import FeatureStore, FeatureStoreWriter, store_exists, store_prefix
+from pvqa_features.tsv import FIELDNAMES, load_tsv
+from pvqa_features.shared import ChainedFeatures, SharedMemoryFeatures, SharedMemoryFeatureWriter, share_features
+from pvqa_features.questions import OtherImageSampler, QuestionEntries, QuestionStore, open_questions
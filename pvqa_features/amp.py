@@ -0,0 +1,46 @@
+# coding=utf-8
+"""Mixed precision for the training scripts (``--amp``).
+
+On GPUs the forward passes autocast to float16 and the loss is scaled by a
+``GradScaler`` so that small gradients do not underflow. On CPUs they
+autocast to bfloat16, which has the exponent range of float32: the scaler is
+then disabled and its calls are plain ``backward`` / ``optimizer.step``, so
+the same training loop runs (and can be tested) without a GPU.
+
+Numerically sensitive parts of the models (counting modules, masked
+softmaxes, losses) leave autocast themselves with
+``torch.autocast(device_type, enabled=False)`` and run in float32.
+
+Like targets.py this module needs torch and is not imported by
+``pvqa_features`` itself.
+"""
+
+import torch
+
+
+def amp_dtype(device):
+    """Reduced precision of ``device``: float16 on GPUs, bfloat16 elsewhere."""
+    return torch.float16 if torch.device(device).type == 'cuda' else torch.bfloat16
+
+
+def autocast(device, enabled=True):
+    """Autocast context for the forward pass on ``device``, a no-op if not ``enabled``."""
+    device = torch.device(device)
+    return torch.autocast(device.type, dtype=amp_dtype(device), enabled=enabled)
+
+
+def grad_scaler(device, enabled=True):
+    """GradScaler for ``device``; only float16 (GPU) autocast needs loss scaling."""
+    device = torch.device(device)
+    return torch.amp.GradScaler(device.type, enabled=enabled and device.type == 'cuda')
+
+
+def scaler_state(scaler):
+    """State to checkpoint, None when the scaler is disabled."""
+    return scaler.state_dict() if scaler is not None and scaler.is_enabled() else None
+
+
+def load_scaler_state(scaler, state):
+    """Restore ``scaler_state``; states of runs without ``--amp`` are ignored."""
+    if scaler is not None and scaler.is_enabled() and state:
+        scaler.load_state_dict(state)
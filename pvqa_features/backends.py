@@ -0,0 +1,175 @@
+# coding=utf-8
+"""Interchangeable feature backends and the single entry point to open them.
+
+    tsv     decode the base64 tsv file at every start (no conversion needed)
+            into shared memory
+    ram     the whole split in RAM, read from a feature store when there is one
+    memmap  a memory-mapped feature store (see store.py)
+    hdf5    an HDF5 file, read image by image
+    auto    memmap if a store exists, then hdf5, then tsv
+
+Every backend is a FeatureBackend, so the datasets only ever call
+``get_features``, ``get_boxes``, ``datum``, ... and do not care where the
+features come from.
+"""
+
+import os
+
+import numpy as np
+
+from pvqa_features.base import FeatureBackend
+from pvqa_features.store import FeatureStore, store_exists, store_prefix
+from pvqa_features.tsv import load_tsv, split_of
+
+BACKENDS = ('auto', 'tsv', 'ram', 'memmap', 'hdf5')
+HDF5_SUFFIX = '.hdf5'
+
+
+class InMemoryFeatures(FeatureBackend):
+    """All boxes and features of a split packed into contiguous arrays in RAM."""
+
+    name = 'ram'
+
+    @classmethod
+    def from_backend(cls, backend):
+        """Read another backend (e.g. a feature store) completely into RAM."""
+        return cls(backend.img_ids, backend.img_w, backend.img_h, backend.offsets,
+                   np.array(backend.features), np.array(backend.boxes),
+                   {key: np.array(value) for key, value in backend.extras.items()})
+
+
+class Hdf5Features(FeatureBackend):
+    """Features in an HDF5 file with the adaptive layout of the BAN converters.
+
+    ``image_features`` (num_boxes x feat_dim), ``image_bb`` (num_boxes x 4)
+    and ``pos_boxes`` (num_images x 2), plus ``image_id``, ``image_w`` and
+    ``image_h`` per image. The file is opened lazily in every process since
+    h5py handles can not be shared across a fork.
+    """
+
+    name = 'hdf5'
+
+    def __init__(self, path):
+        import h5py
+        self.path = path
+        self._h5 = None
+        self._pid = None
+        with h5py.File(path, 'r') as hf:
+            split = hf.attrs['split']
+            img_ids = ['%s_%04d' % (split, image_id) for image_id in hf['image_id'][()]]
+            img_w = hf['image_w'][()]
+            img_h = hf['image_h'][()]
+            pos_boxes = hf['pos_boxes'][()]
+        offsets = np.append(pos_boxes[:, 0], pos_boxes[-1, 1] if len(pos_boxes) else 0)
+        super(Hdf5Features, self).__init__(img_ids, img_w, img_h, offsets, None, None)
+
+    def _file(self):
+        if self._h5 is None or self._pid != os.getpid():
+            import h5py
+            self._h5 = h5py.File(self.path, 'r')
+            self._pid = os.getpid()
+        return self._h5
+
+    @property
+    def features(self):
+        return self._file()['image_features']
+
+    @property
+    def boxes(self):
+        return self._file()['image_bb']
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_h5'] = None
+        return state
+
+
+class Hdf5FeatureWriter(object):
+    """Same interface as FeatureStoreWriter, writes an Hdf5Features file."""
+
+    def __init__(self, path, split=''):
+        import h5py
+        self.path = path
+        self.hf = h5py.File(path + '.tmp', 'w')
+        self.hf.attrs['split'] = split
+        self.image_ids, self.img_w, self.img_h, self.num_boxes = [], [], [], []
+        self.features = None
+        self.boxes = self.hf.create_dataset('image_bb', (0, 4), 'f', maxshape=(None, 4), chunks=True)
+
+    def add(self, image_id, img_w, img_h, boxes, features):
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        features = np.asarray(features, dtype=np.float32).reshape(boxes.shape[0], -1)
+        if self.features is None:
+            feat_dim = features.shape[1]
+            self.features = self.hf.create_dataset('image_features', (0, feat_dim), 'f',
+                                                   maxshape=(None, feat_dim), chunks=(36, feat_dim))
+        start = self.boxes.shape[0]
+        end = start + boxes.shape[0]
+        self.features.resize(end, axis=0)
+        self.boxes.resize(end, axis=0)
+        self.features[start:end] = features
+        self.boxes[start:end] = boxes
+        self.image_ids.append(int(image_id))
+        self.img_w.append(img_w)
+        self.img_h.append(img_h)
+        self.num_boxes.append(boxes.shape[0])
+
+    def add_datum(self, datum):
+        image_id = int(datum['img_id'].rsplit('_', 1)[-1])
+        self.add(image_id, datum['img_w'], datum['img_h'], datum['boxes'], datum['features'])
+
+    def close(self):
+        offsets = np.zeros(len(self.num_boxes) + 1, dtype=np.int64)
+        np.cumsum(self.num_boxes, out=offsets[1:])
+        self.hf.create_dataset('pos_boxes', data=np.stack([offsets[:-1], offsets[1:]], axis=1))
+        self.hf.create_dataset('image_id', data=np.asarray(self.image_ids, dtype=np.int64))
+        self.hf.create_dataset('image_w', data=np.asarray(self.img_w, dtype=np.float32))
+        self.hf.create_dataset('image_h', data=np.asarray(self.img_h, dtype=np.float32))
+        self.hf.close()
+        os.replace(self.path + '.tmp', self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.hf.close()
+
+
+def open_features(tsv_file, backend='auto', num_workers=0):
+    """Open the features of one split with the requested backend.
+
+    :param tsv_file: Path of the feature tsv/csv file. The converted store
+        (``<name>.features.bin`` ...) and HDF5 file (``<name>.hdf5``) are
+        looked up next to it.
+    :param backend: One of BACKENDS.
+    :param num_workers: Decoding processes used when the tsv file is read.
+    :return: A FeatureBackend.
+    """
+    assert backend in BACKENDS, 'unknown feature backend %s, use one of %s' % (backend, ', '.join(BACKENDS))
+    prefix = store_prefix(tsv_file)
+    if backend == 'auto':
+        if store_exists(prefix):
+            backend = 'memmap'
+        elif os.path.isfile(prefix + HDF5_SUFFIX):
+            backend = 'hdf5'
+        else:
+            print("No feature store found for %s, falling back to tsv decoding. "
+                  "Run `python -m pvqa_features.convert_tsv %s` once to speed this up." % (tsv_file, tsv_file))
+            backend = 'tsv'
+
+    print("Loading features of %s with the %s backend" % (tsv_file, backend))
+    if backend == 'memmap':
+        return FeatureStore(prefix)
+    if backend == 'hdf5':
+        return Hdf5Features(prefix + HDF5_SUFFIX)
+    if backend == 'ram' and store_exists(prefix):
+        return InMemoryFeatures.from_backend(FeatureStore(prefix))
+    # decoded image by image into shared memory, never as a list of images
+    # (shared.py builds on this module)
+    from pvqa_features.shared import SharedMemoryFeatureWriter
+    with SharedMemoryFeatureWriter() as writer:
+        load_tsv(tsv_file, split_of(tsv_file), num_workers=num_workers, sink=writer.add_datum)
+    return writer.features
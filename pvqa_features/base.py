@@ -0,0 +1,140 @@
+# coding=utf-8
+"""Common interface of the feature backends."""
+
+import numpy as np
+
+
+def normalize_bbox(im_w, im_h, bbox):
+    """Scale (num_boxes, 4) x1, y1, x2, y2 boxes to 0 ~ 1 by the image size."""
+    bbox = bbox.copy()
+    bbox[:, (0, 2)] /= im_w
+    bbox[:, (1, 3)] /= im_h
+    return bbox
+
+
+def find_invalid_box(boxes, tolerance=1e-5):
+    """Row of the first normalized box with a coordinate outside 0 ~ 1 (or NaN), None if all are valid."""
+    valid = ((boxes < 1 + tolerance) & (boxes > -tolerance)).all(axis=1)
+    rows = np.flatnonzero(~valid)
+    return int(rows[0]) if len(rows) else None
+
+
+class FeatureBackend(object):
+    """Random access to the boxes and region features of one feature file.
+
+    Images are addressed by their row ``idx`` in the file, which is also the
+    value stored in the ``*_img_id2idx.pkl`` files. Image ``idx`` owns the rows
+    ``offsets[idx]:offsets[idx + 1]`` of ``features``, ``boxes`` and of every
+    optional per box array in ``extras`` (e.g. the object labels of the
+    LXMERT pre-training files).
+
+    Subclasses only decide where ``features``, ``boxes`` and ``extras`` live
+    (RAM, memory-mapped files, HDF5, ...).
+    """
+
+    name = None
+
+    def __init__(self, img_ids, img_w, img_h, offsets, features, boxes, extras=None):
+        self.img_ids = list(img_ids)
+        self.img_w = np.asarray(img_w)
+        self.img_h = np.asarray(img_h)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.num_boxes = np.diff(self.offsets)
+        self._features = features
+        self._boxes = boxes
+        self._extras = extras or {}
+        self.img_id2idx = {img_id: idx for idx, img_id in enumerate(self.img_ids)}
+
+    @property
+    def features(self):
+        return self._features
+
+    @property
+    def boxes(self):
+        return self._boxes
+
+    @property
+    def extras(self):
+        return self._extras
+
+    @property
+    def feat_dim(self):
+        return self.features.shape[1]
+
+    def __len__(self):
+        return len(self.img_ids)
+
+    def __contains__(self, img_id):
+        return img_id in self.img_id2idx
+
+    def img_id(self, idx):
+        return self.img_ids[idx]
+
+    @property
+    def fixed_num_boxes(self):
+        """Number of boxes shared by every image, or None for adaptive features."""
+        if len(self.num_boxes) and (self.num_boxes == self.num_boxes[0]).all():
+            return int(self.num_boxes[0])
+        return None
+
+    def get_features(self, idx):
+        return self.features[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def get_boxes(self, idx):
+        return self.boxes[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def get_normalized_boxes(self, idx):
+        return normalize_bbox(self.img_w[idx], self.img_h[idx], self.get_boxes(idx))
+
+    def get_extra(self, key, idx):
+        return self.extras[key][self.offsets[idx]:self.offsets[idx + 1]]
+
+    def get_extras(self, idx):
+        """Dict of every extra array of image ``idx``."""
+        return {key: self.get_extra(key, idx) for key in self.extras}
+
+    def all_boxes(self):
+        """(total_boxes, 4) boxes of every image, read at once."""
+        return np.asarray(self.boxes[:])
+
+    def normalized_boxes(self, check=True):
+        """Boxes of every image scaled to 0 ~ 1 as one float32 (total_boxes, 4) array.
+
+        Image ``idx`` owns the rows ``offsets[idx]:offsets[idx + 1]``, so the
+        datasets normalize once at load time and slice views per sample
+        instead of calling ``get_normalized_boxes``.
+
+        :param check: Raise a ValueError naming the first image with a box
+            outside the image.
+        """
+        boxes = np.array(self.all_boxes(), dtype=np.float32)
+        boxes[:, (0, 2)] /= np.repeat(self.img_w, self.num_boxes)[:, None]
+        boxes[:, (1, 3)] /= np.repeat(self.img_h, self.num_boxes)[:, None]
+        if check:
+            row = find_invalid_box(boxes)
+            if row is not None:
+                idx = int(np.searchsorted(self.offsets, row, side='right')) - 1
+                self.check_normalized_boxes(idx, boxes[self.offsets[idx]:self.offsets[idx + 1]])
+        return boxes
+
+    def check_normalized_boxes(self, idx, boxes):
+        """Raise a ValueError if a normalized box of image ``idx`` is outside 0 ~ 1."""
+        row = find_invalid_box(boxes)
+        if row is not None:
+            raise ValueError('box %d of image %s is not inside the image: %s'
+                             % (row, self.img_id(idx), boxes[row].tolist()))
+
+    def datum(self, idx):
+        """Return image ``idx`` as the dict produced by the ``load_tsv`` functions."""
+        datum = {'img_id': self.img_id(idx),
+                 'img_w': self.img_w[idx],
+                 'img_h': self.img_h[idx],
+                 'num_boxes': int(self.num_boxes[idx]),
+                 'boxes': self.get_boxes(idx),
+                 'features': self.get_features(idx)}
+        datum.update(self.get_extras(idx))
+        return datum
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self.datum(idx)
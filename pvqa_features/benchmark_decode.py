@@ -0,0 +1,69 @@
+# coding=utf-8
+"""Compare serial and multi-process decoding of a feature tsv file.
+
+Usage:
+
+    python -m pvqa_features.benchmark_decode --images 2000 --workers 2 4 8
+
+A synthetic PathVQA style tsv is written to a temporary directory unless
+``--tsv`` points to an existing file.
+"""
+
+import argparse
+import base64
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from pvqa_features.tsv import FIELDNAMES, iter_tsv
+
+
+def write_synthetic_tsv(path, num_images, num_boxes=36, feat_dim=2048, seed=0):
+    rng = np.random.RandomState(seed)
+    with open(path, 'w') as f:
+        for image_id in range(num_images):
+            img_w, img_h = rng.randint(200, 1000, size=2)
+            xy = rng.uniform(0, 0.5, size=(num_boxes, 2)) * (img_w, img_h)
+            wh = rng.uniform(0.01, 0.5, size=(num_boxes, 2)) * (img_w, img_h)
+            boxes = np.concatenate([xy, xy + wh], axis=1).astype(np.float64)
+            features = rng.rand(num_boxes, feat_dim).astype(np.float32)
+            row = [image_id, img_w, img_h, num_boxes,
+                   str(base64.b64encode(boxes.tobytes())),
+                   str(base64.b64encode(features.tobytes()))]
+            assert len(row) == len(FIELDNAMES)
+            f.write('\t'.join(map(str, row)) + '\n')
+
+
+def time_decode(tsv_file, num_workers):
+    start_time = time.time()
+    num_images = 0
+    for _ in iter_tsv(tsv_file, split='train', num_workers=num_workers):
+        num_images += 1
+    return num_images, time.time() - start_time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tsv', type=str, default=None, help='existing tsv file to decode')
+    parser.add_argument('--images', type=int, default=2000, help='images in the synthetic tsv')
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4, os.cpu_count()])
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tsv_file = args.tsv
+        if tsv_file is None:
+            tsv_file = os.path.join(tmp_dir, 'train.csv')
+            write_synthetic_tsv(tsv_file, args.images)
+        print('decoding %s (%.1f MB)' % (tsv_file, os.path.getsize(tsv_file) / 2 ** 20))
+
+        num_images, serial_time = time_decode(tsv_file, 0)
+        print('serial:     %d images in %.2fs (%.0f images/s)' % (num_images, serial_time, num_images / serial_time))
+        for num_workers in sorted(set(args.workers)):
+            num_images, elapsed = time_decode(tsv_file, num_workers)
+            print('%2d workers: %d images in %.2fs (%.0f images/s), speedup %.2fx' % (
+                num_workers, num_images, elapsed, num_images / elapsed, serial_time / elapsed))
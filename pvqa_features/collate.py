@@ -0,0 +1,175 @@
+# coding=utf-8
+"""Padding batch collate for samples with a variable number of boxes.
+
+``trim_collate`` of BAN and ReGAT pads every tensor with ``F.pad`` before
+stacking it, tells features from adjacency matrices by comparing their last
+two dimensions and dispatches on the type of every field of every batch.
+:class:`PaddedCollate` reads the layout of the samples once, from the first
+batch, and then writes every field straight into one preallocated buffer
+(shared memory in a DataLoader worker) padded to the largest sample of the
+batch along every dimension, which covers box features (``[boxes, dim]``),
+adjacency matrices (``[boxes, boxes]``) and fixed size tensors alike.
+
+With ``image_fields``, consecutive samples of the same image (as batched by
+ImageGroupBatchSampler) share one row of the fields that only depend on the
+image, and ``batch.v_index`` maps every sample to its row, so the models can
+encode an image once for all its questions. The datasets tell the image of a
+sample by returning an :class:`ImageSample`; the features themselves are
+never compared.
+
+Like targets.py this module needs torch and is not imported by
+``pvqa_features`` itself.
+"""
+
+import functools
+import numbers
+import operator
+
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+
+from pvqa_features.targets import SparseTarget, batch_targets
+
+TENSOR, ARRAY, NUMBER, SPARSE, LIST = 'tensor', 'array', 'number', 'sparse', 'list'
+
+
+def field_layout(sample):
+    """Kind of every field of a sample: TENSOR (padded and stacked), ARRAY
+    (numpy, padded and stacked into a tensor), NUMBER (into a Long or Double
+    tensor), SPARSE (SparseTarget, batched by ``batch_targets``) or LIST
+    (kept as a list, e.g. strings)."""
+    layout = []
+    for field in sample:
+        if torch.is_tensor(field):
+            layout.append(TENSOR)
+        elif isinstance(field, np.ndarray) and field.dtype.kind in 'biuf':
+            layout.append(ARRAY)
+        elif isinstance(field, SparseTarget):
+            layout.append(SPARSE)
+        elif isinstance(field, numbers.Number):
+            layout.append(NUMBER)
+        else:
+            layout.append(LIST)
+    return tuple(layout)
+
+
+def new_buffer(elem, shape, shared=None):
+    """Uninitialized tensor of ``shape`` like ``elem``, in shared memory
+    when ``shared`` (by default: when called in a DataLoader worker)."""
+    if shared is None:
+        shared = get_worker_info() is not None
+    if not shared:
+        return elem.new_empty(shape)
+    numel = functools.reduce(operator.mul, shape, 1)
+    storage = elem.untyped_storage()._new_shared(numel * elem.element_size())
+    return elem.new(storage).resize_(shape)
+
+
+def pad_stack(tensors, shared=None):
+    """Stack tensors of the same rank, zero padded to the largest size along
+    every dimension, into one buffer."""
+    elem = tensors[0]
+    sizes = [x.shape for x in tensors]
+    max_size = tuple(max(size) for size in zip(*sizes))
+    out = new_buffer(elem, (len(tensors),) + max_size, shared)
+    if all(size == max_size for size in sizes):
+        return torch.stack(tensors, 0, out=out)
+    for i, x in enumerate(tensors):
+        sample = out[i]
+        sample[tuple(slice(0, n) for n in x.shape)] = x
+        # only the padding is zeroed, along one dimension after the other
+        for dim, n in enumerate(x.shape):
+            if n < max_size[dim]:
+                sample[tuple(slice(0, m) for m in x.shape[:dim]) + (slice(n, None),)] = 0
+    return out
+
+
+class ImageSample(tuple):
+    """The fields of a sample, with the image they were read from: row
+    ``image`` of the feature store ``store``. Unpacks like the plain tuple.
+    """
+
+    def __new__(cls, fields, image=None, store=None):
+        sample = super(ImageSample, cls).__new__(cls, fields)
+        sample.image = image
+        sample.store = store
+        return sample
+
+
+def same_image(a, b):
+    """Whether the ImageSamples ``a`` and ``b`` come from the same row of the
+    same feature store."""
+    return a.image == b.image and a.store is b.store
+
+
+class PaddedBatch(list):
+    """The collated fields of a batch, and ``num_boxes``: the largest number
+    of boxes of the batch, i.e. the padded size of the first tensor field.
+    ``v_index`` is the row of the image fields of every sample, or None when
+    every sample has its own row.
+
+    It pins its own fields, so ``pin_memory=True`` keeps the attributes.
+    """
+
+    def __init__(self, fields, num_boxes, v_index=None):
+        super(PaddedBatch, self).__init__(fields)
+        self.num_boxes = num_boxes
+        self.v_index = v_index
+
+    def pin_memory(self):
+        return PaddedBatch([field.pin_memory() if hasattr(field, 'pin_memory') else field
+                            for field in self], self.num_boxes,
+                           None if self.v_index is None else self.v_index.pin_memory())
+
+
+class PaddedCollate(object):
+    """collate_fn for tuples of tensors with a variable number of boxes,
+    numbers, strings and SparseTargets, returning a PaddedBatch.
+
+    :param layout: The field_layout of the samples, read from the first
+        batch if None.
+    :param shared: Collate into shared memory; by default only in the
+        DataLoader workers.
+    :param image_fields: Indices of the fields that only depend on the image
+        (features, boxes, graphs, ...); the samples must be ImageSamples, and
+        one of the same image as the sample before shares its row.
+    """
+
+    def __init__(self, layout=None, shared=None, image_fields=()):
+        self.layout = layout
+        self.shared = shared
+        self.image_fields = tuple(image_fields)
+
+    def __call__(self, batch):
+        if self.layout is None:
+            self.layout = field_layout(batch[0])
+        v_index, image_batch = None, batch
+        if self.image_fields:
+            if not isinstance(batch[0], ImageSample):
+                raise TypeError('image_fields needs ImageSample samples, got %s' % type(batch[0]).__name__)
+            image_batch, v_index = [batch[0]], [0]
+            for sample in batch[1:]:
+                if not same_image(sample, image_batch[-1]):
+                    image_batch.append(sample)
+                v_index.append(len(image_batch) - 1)
+            v_index = torch.tensor(v_index)
+        fields = []
+        num_boxes = None
+        for i, kind in enumerate(self.layout):
+            samples = [sample[i] for sample in (image_batch if i in self.image_fields else batch)]
+            if kind in (TENSOR, ARRAY):
+                if kind == ARRAY:
+                    samples = [torch.from_numpy(sample) for sample in samples]
+                field = pad_stack(samples, self.shared)
+                if num_boxes is None and field.dim() > 1:
+                    num_boxes = field.size(1)
+            elif kind == SPARSE:
+                field = batch_targets(samples)
+            elif kind == NUMBER:
+                integral = isinstance(samples[0], numbers.Integral)
+                field = torch.tensor(samples, dtype=torch.int64 if integral else torch.float64)
+            else:
+                field = list(samples)
+            fields.append(field)
+        return PaddedBatch(fields, num_boxes, v_index)
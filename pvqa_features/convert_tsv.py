@@ -0,0 +1,55 @@
+# coding=utf-8
+"""Convert PathVQA feature tsv files into binary feature stores.
+
+Usage (from the repository root or a model folder):
+
+    python -m pvqa_features.convert_tsv data/pvqa/images/train.csv \
+        data/pvqa/images/val.csv data/pvqa/images/test.csv
+
+Each ``<name>.csv`` is written next to itself as ``<name>.features.bin``,
+``<name>.boxes.bin`` and ``<name>.index.npz`` (or ``<name>.hdf5`` with
+``--format hdf5``). The datasets pick the converted file up automatically once
+it exists.
+"""
+
+import argparse
+import time
+
+from pvqa_features.backends import HDF5_SUFFIX, Hdf5FeatureWriter
+from pvqa_features.store import FeatureStoreWriter, store_prefix
+from pvqa_features.tsv import iter_tsv, split_of
+
+
+def convert(tsv_file, prefix=None, split=None, num_workers=0, fmt='memmap'):
+    if prefix is None:
+        prefix = store_prefix(tsv_file)
+    if split is None:
+        split = split_of(tsv_file)
+    start_time = time.time()
+    print("Converting %s to %s feature store %s" % (tsv_file, fmt, prefix))
+    if fmt == 'hdf5':
+        writer = Hdf5FeatureWriter(prefix + HDF5_SUFFIX, split)
+    else:
+        writer = FeatureStoreWriter(prefix, split)
+    with writer:
+        for datum in iter_tsv(tsv_file, split, num_workers=num_workers):
+            writer.add_datum(datum)
+    print("Wrote %d images (%d boxes) in %d seconds." % (
+        len(writer.image_ids), sum(writer.num_boxes), time.time() - start_time))
+    return prefix
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tsv_files', nargs='+', help='feature tsv/csv files to convert')
+    parser.add_argument('--split', type=str, default=None,
+                        help='split name used in the image ids, guessed from the file name by default')
+    parser.add_argument('--format', type=str, default='memmap', choices=['memmap', 'hdf5'])
+    parser.add_argument('--workers', type=int, default=0, help='number of decoding processes')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    for tsv_file in args.tsv_files:
+        convert(tsv_file, split=args.split, num_workers=args.workers, fmt=args.format)
@@ -0,0 +1,99 @@
+# coding=utf-8
+"""Distributed data-parallel helpers shared by the training scripts.
+
+The scripts are launched with ``torchrun --nproc_per_node N script.py ...``,
+which sets ``RANK``, ``LOCAL_RANK`` and ``WORLD_SIZE`` for every process.
+Without them (plain ``python script.py``) nothing is initialized and the
+helpers below reduce to the single process case. GPUs use the ``nccl``
+backend, CPU processes ``gloo``, so the distributed paths can be run
+without GPUs.
+
+Like targets.py this module needs torch and is not imported by
+``pvqa_features`` itself.
+"""
+
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend=None):
+    """Join the process group of a torchrun launch.
+
+    :param backend: ``nccl`` or ``gloo``; by default nccl when CUDA is
+        available, gloo otherwise.
+    :return: (rank, local_rank, world_size), (0, 0, 1) when not launched by
+        torchrun.
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 0, 1
+    rank = int(os.environ['RANK'])
+    local_rank = int(os.environ.get('LOCAL_RANK', rank))
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if backend == 'nccl':
+        torch.cuda.set_device(local_rank)
+    if not dist.is_initialized():
+        dist.init_process_group(backend)
+    return rank, local_rank, world_size
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """Rank 0 logs, evaluates the merged results and saves checkpoints."""
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def unwrap(model):
+    """The module inside a DistributedDataParallel (or DataParallel) wrapper,
+    for its attributes and an unprefixed state_dict."""
+    return model.module if hasattr(model, 'module') else model
+
+
+def all_reduce_sum(tensor):
+    """Sum ``tensor`` over the ranks in place and return it; the tensor must
+    be on the device of the backend (CUDA for nccl, CPU for gloo)."""
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def all_gather_objects(obj):
+    """List of the picklable ``obj`` of every rank, in rank order."""
+    if not is_distributed():
+        return [obj]
+    objs = [None] * dist.get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+
+def broadcast_object(obj, src=0):
+    """``obj`` of rank ``src`` on every rank, e.g. a randomly drawn seed."""
+    if not is_distributed():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=src)
+    return objs[0]
@@ -0,0 +1,97 @@
+# coding=utf-8
+"""Decode feature tsv files with a pool of processes.
+
+The file is cut into byte ranges aligned on line starts; every worker reads and
+decodes its own ranges, and the results are returned in file order. Only a
+bounded number of ranges is decoded ahead of the consumer.
+"""
+
+import collections
+import multiprocessing
+import os
+
+# Default ceiling on the tsv bytes of the ranges decoded ahead of the consumer
+MAX_PENDING_BYTES = 256 * 2 ** 20
+# Ranges in flight per worker: one being decoded, one waiting to be consumed
+JOBS_PER_WORKER = 2
+
+
+def line_ranges(fname, num_shards):
+    """Split ``fname`` into at most ``num_shards`` [start, end) byte ranges.
+
+    Every range starts at the beginning of a line, so a range holds exactly the
+    lines that start inside it.
+    """
+    size = os.path.getsize(fname)
+    bounds = [0]
+    with open(fname, 'rb') as f:
+        for i in range(1, num_shards):
+            f.seek(size * i // num_shards)
+            f.readline()
+            pos = f.tell()
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    if size > bounds[-1]:
+        bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_lines(fname, start=0, end=None):
+    """Yield the non-empty lines of ``fname`` that start in [start, end), one
+    at a time and without their line break."""
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        while end is None or f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            line = line.decode('utf-8').rstrip('\r\n')
+            if line:
+                yield line
+
+
+def _decode_range(job):
+    fname, start, end, decode_line = job
+    return [decode_line(line) for line in read_lines(fname, start, end)]
+
+
+def iter_parallel(fname, decode_line, num_workers, max_pending_bytes=MAX_PENDING_BYTES):
+    """Yield ``decode_line(line)`` for every line of ``fname``, in file order.
+
+    At most ``num_workers * JOBS_PER_WORKER`` ranges are submitted at a time and
+    the next one only once the oldest is consumed, so a slow consumer holds the
+    workers back instead of letting the decoded file pile up in this process.
+    The ranges are sized so that those in flight span about
+    ``max_pending_bytes`` of the file (the decoded arrays are smaller than their
+    base64 text); a line longer than a range makes a range of its own.
+
+    :param decode_line: Picklable callable (a module level function or a
+        functools.partial of one) turning one tsv line into an image dict.
+    :param num_workers: Number of decoding processes.
+    :param max_pending_bytes: Ceiling on the tsv bytes decoded ahead of the
+        consumer, None for one range per job in flight.
+    """
+    max_jobs = num_workers * JOBS_PER_WORKER
+    num_shards = max_jobs
+    if max_pending_bytes is not None:
+        shard_bytes = max(max_pending_bytes // max_jobs, 1)
+        num_shards = max(-(-os.path.getsize(fname) // shard_bytes), num_shards)
+    ranges = iter(line_ranges(fname, num_shards))
+    with multiprocessing.Pool(num_workers) as pool:
+        # results in file order, the oldest first
+        pending = collections.deque()
+
+        def submit():
+            next_range = next(ranges, None)
+            if next_range is not None:
+                start, end = next_range
+                pending.append(pool.apply_async(_decode_range, ((fname, start, end, decode_line),)))
+
+        for _ in range(max_jobs):
+            submit()
+        while pending:
+            items = pending.popleft().get()
+            submit()
+            for item in items:
+                yield item
+            del items
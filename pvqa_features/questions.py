@@ -0,0 +1,242 @@
+# coding=utf-8
+"""Pre-tokenized, array-backed store for the PathVQA questions.
+
+The datasets used to tokenize every question and answer sentence at each
+start and to keep one dict of small tensors per question, which is slow to
+build and to pickle into the DataLoader workers. A question store is built
+once from those entries and then only memory-mapped:
+
+    <prefix>.q_tokens.bin     int64 [num_questions, max_length]
+    <prefix>.ans_tokens.bin   int64 [num_questions, max_length]
+    <prefix>.questions.npz    question_id, image (feature row), label_offsets,
+                              labels, scores, ans_valid, the raw strings
+                              (image_id, question, ans_sent) and the meta data
+
+The answer labels and scores of question ``i`` are the CSR slices
+``label_offsets[i]:label_offsets[i + 1]`` of ``labels`` and ``scores``.
+
+A store remembers the fingerprint of what it was built from (vocabulary,
+max_length and the source files); :func:`open_questions` rebuilds it when
+that changes.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+QUESTIONS_VERSION = 1
+Q_TOKENS_SUFFIX = '.q_tokens.bin'
+ANS_TOKENS_SUFFIX = '.ans_tokens.bin'
+QUESTIONS_SUFFIX = '.questions.npz'
+
+
+def question_fingerprint(vocab, max_length, source_files):
+    """Hash of everything a question store depends on.
+
+    :param vocab: The words of the dictionary, in index order.
+    :param source_files: Files the entries are loaded from; their size and
+        modification time are hashed, not their content.
+    """
+    sha = hashlib.sha1()
+    sha.update(('%d\n%d\n' % (QUESTIONS_VERSION, max_length)).encode('utf-8'))
+    sha.update('\n'.join(vocab).encode('utf-8'))
+    for path in source_files:
+        stat = os.stat(path)
+        sha.update(('\n%s %d %d' % (os.path.basename(path), stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def _pad(tokens, max_length, padding_idx):
+    tokens = tokens[:max_length]
+    return tokens + [padding_idx] * (max_length - len(tokens))
+
+
+def write_question_store(prefix, entries, tokenize, padding_idx, max_length=14, fingerprint=''):
+    """Tokenize the entries of a split and write them as a question store.
+
+    :param entries: Dicts with question_id, image_id, image, question,
+        answer ({'labels', 'scores'}), ans_sent and ans_valid, as returned by
+        the ``_load_dataset_pvqa`` functions.
+    :param tokenize: Function of a sentence to its list of word indices.
+    """
+    num_questions = len(entries)
+    # several processes may build the same store at once, the last one wins
+    tmp = '.tmp%d' % os.getpid()
+    q_tokens = np.memmap(prefix + Q_TOKENS_SUFFIX + tmp, dtype=np.int64, mode='w+',
+                         shape=(max(num_questions, 1), max_length))
+    ans_tokens = np.memmap(prefix + ANS_TOKENS_SUFFIX + tmp, dtype=np.int64, mode='w+',
+                           shape=(max(num_questions, 1), max_length))
+    label_offsets = np.zeros(num_questions + 1, dtype=np.int64)
+    labels, scores = [], []
+    for i, entry in enumerate(entries):
+        q_tokens[i] = _pad(tokenize(entry['question']), max_length, padding_idx)
+        ans_tokens[i] = _pad(tokenize(entry['ans_sent']), max_length, padding_idx)
+        labels.extend(entry['answer']['labels'])
+        scores.extend(entry['answer']['scores'])
+        label_offsets[i + 1] = len(labels)
+    q_tokens.flush()
+    ans_tokens.flush()
+    del q_tokens, ans_tokens
+    # the index goes last, a store without its index is never opened
+    with open(prefix + QUESTIONS_SUFFIX + tmp, 'wb') as f:
+        np.savez(f,
+                 version=np.int64(QUESTIONS_VERSION),
+                 fingerprint=np.str_(fingerprint),
+                 max_length=np.int64(max_length),
+                 question_id=np.asarray([entry['question_id'] for entry in entries], dtype=np.int64),
+                 image=np.asarray([entry['image'] for entry in entries], dtype=np.int64),
+                 image_id=np.asarray([entry['image_id'] for entry in entries], dtype=np.str_),
+                 question=np.asarray([entry['question'] for entry in entries], dtype=np.str_),
+                 ans_sent=np.asarray([str(entry['ans_sent']) for entry in entries], dtype=np.str_),
+                 ans_valid=np.asarray([entry['ans_valid'] for entry in entries], dtype=np.int64),
+                 label_offsets=label_offsets,
+                 labels=np.asarray(labels, dtype=np.int64),
+                 scores=np.asarray(scores, dtype=np.float32))
+    for suffix in (Q_TOKENS_SUFFIX, ANS_TOKENS_SUFFIX, QUESTIONS_SUFFIX):
+        os.replace(prefix + suffix + tmp, prefix + suffix)
+
+
+class QuestionStore(object):
+    """Read-only view over a question store.
+
+    Token rows are ``np.memmap`` slices (copy-on-write, so ``torch.from_numpy``
+    takes them as they are); everything else is one numpy array per field.
+    Pickling only sends the prefix, workers map the files themselves.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with np.load(prefix + QUESTIONS_SUFFIX) as index:
+            version = int(index['version'])
+            assert version == QUESTIONS_VERSION, \
+                '%s was written with question store version %d, expected %d' % (prefix, version, QUESTIONS_VERSION)
+            self.fingerprint = str(index['fingerprint'])
+            self.max_length = int(index['max_length'])
+            self.question_id = index['question_id']
+            self.image = index['image']
+            self.image_id = index['image_id']
+            self.question = index['question']
+            self.ans_sent = index['ans_sent']
+            self.ans_valid = index['ans_valid']
+            self.label_offsets = index['label_offsets']
+            self.labels = index['labels']
+            self.scores = index['scores']
+        shape = (max(len(self.question_id), 1), self.max_length)
+        self.q_tokens = np.memmap(prefix + Q_TOKENS_SUFFIX, dtype=np.int64, mode='c', shape=shape)
+        self.ans_tokens = np.memmap(prefix + ANS_TOKENS_SUFFIX, dtype=np.int64, mode='c', shape=shape)
+
+    def __len__(self):
+        return len(self.question_id)
+
+    def answer(self, i):
+        """(labels, scores) of question ``i``, possibly empty."""
+        start, end = self.label_offsets[i], self.label_offsets[i + 1]
+        return self.labels[start:end], self.scores[start:end]
+
+    def __getstate__(self):
+        return {'prefix': self.prefix}
+
+    def __setstate__(self, state):
+        self.__init__(state['prefix'])
+
+
+def question_store_exists(prefix):
+    return all(os.path.isfile(prefix + suffix)
+               for suffix in (Q_TOKENS_SUFFIX, ANS_TOKENS_SUFFIX, QUESTIONS_SUFFIX))
+
+
+def open_questions(prefix, load_entries, tokenize, padding_idx, max_length=14, vocab=(), source_files=()):
+    """Open the question store at ``prefix``, (re)building it first if it is
+    missing or was built from another vocabulary, max_length or sources.
+
+    :param load_entries: Function returning the entries of the split, only
+        called when the store has to be built.
+    :return: A QuestionStore.
+    """
+    fingerprint = question_fingerprint(vocab, max_length, source_files)
+    if question_store_exists(prefix):
+        store = QuestionStore(prefix)
+        if store.fingerprint == fingerprint:
+            return store
+        print("Question store %s is out of date, rebuilding it" % prefix)
+    print("Tokenizing the questions into %s" % prefix)
+    write_question_store(prefix, load_entries(), tokenize, padding_idx, max_length, fingerprint)
+    return QuestionStore(prefix)
+
+
+class OtherImageSampler(object):
+    """Draws, for a question, a random question about another image in O(1).
+
+    The questions are sorted by image once; a draw picks one of the questions
+    outside the block of its own image, uniformly, so unlike rejection
+    sampling it never retries. Works on one index or an array of indices.
+
+    :param images: Image of every question, e.g. ``QuestionStore.image``.
+    """
+
+    def __init__(self, images):
+        _, self.group, counts = np.unique(np.asarray(images), return_inverse=True, return_counts=True)
+        self.order = np.argsort(self.group, kind='stable')
+        self.group_start = np.cumsum(counts) - counts
+        self.group_size = counts
+
+    def __len__(self):
+        return len(self.order)
+
+    def __call__(self, index, random_state=np.random):
+        group = self.group[index]
+        start, size = self.group_start[group], self.group_size[group]
+        num_other = len(self.order) - size
+        if np.ndim(index) == 0:
+            if num_other == 0:
+                raise ValueError('all the questions are about the same image')
+            k = random_state.randint(num_other)
+            # skip the block of the own image
+            return int(self.order[k + size if k >= start else k])
+        if np.any(num_other == 0):
+            raise ValueError('all the questions are about the same image')
+        k = random_state.randint(0, num_other)
+        return self.order[np.where(k >= start, k + size, k)]
+
+
+class QuestionEntries(object):
+    """The entries of a question store as the list of dicts the datasets used
+    to keep (``entries[i]['question']``, ...), built on access only.
+
+    :param to_tensor: Applied to the token, label and score arrays, e.g.
+        ``torch.from_numpy``.
+    """
+
+    def __init__(self, store, to_tensor=None):
+        self.store = store
+        self.to_tensor = to_tensor
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, i):
+        store = self.store
+        if i < 0:
+            i += len(store)
+        if not 0 <= i < len(store):
+            raise IndexError('question index %d out of range' % i)
+        labels, scores = store.answer(i)
+        q_token, ans_token = store.q_tokens[i], store.ans_tokens[i]
+        if self.to_tensor is not None:
+            labels, scores = self.to_tensor(labels), self.to_tensor(scores)
+            q_token, ans_token = self.to_tensor(q_token), self.to_tensor(ans_token)
+        return {'question_id': int(store.question_id[i]),
+                'image_id': str(store.image_id[i]),
+                'image': int(store.image[i]),
+                'question': str(store.question[i]),
+                'answer': {'labels': labels if len(labels) else None,
+                           'scores': scores if len(labels) else None},
+                'ans_sent': str(store.ans_sent[i]),
+                'ans_valid': int(store.ans_valid[i]),
+                'q_token': q_token,
+                'ans_token': ans_token}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
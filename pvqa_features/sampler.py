@@ -0,0 +1,172 @@
+# coding=utf-8
+"""Batch samplers that arrange the questions by their image.
+
+With adaptive features the images have 10 to 100 boxes and a batch is padded
+to its largest image, so the attention and graph layers spend most of a
+random batch on padding. :class:`BucketBatchSampler` draws the questions from
+any sampler (RandomSampler, DistributedSampler, ...), sorts every pool of
+``pool_batches`` batches by box count, cuts the pool into batches and
+shuffles the batches, so epochs stay random while a batch holds images of
+about the same size.
+
+PathVQA has several questions per image. :class:`ImageGroupBatchSampler`
+puts the questions of an image next to each other in one batch, so that
+``PaddedCollate(image_fields=...)`` keeps every image once and the models
+encode it once for all its questions.
+
+:class:`DistributedEvalSampler` shards evaluation sets over the ranks of a
+distributed run without the duplicates DistributedSampler pads with, so the
+reduced metrics count every question once.
+
+Like targets.py this module needs torch and is not imported by
+``pvqa_features`` itself.
+"""
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+from torch.utils.data.distributed import DistributedSampler
+
+
+def _per_sample(dataset, method):
+    """``dataset.<method>()``, one value per sample; ConcatDataset and Subset
+    are resolved."""
+    if hasattr(dataset, method):
+        return np.asarray(getattr(dataset, method)())
+    if hasattr(dataset, 'datasets'):  # ConcatDataset
+        return np.concatenate([_per_sample(part, method) for part in dataset.datasets])
+    if hasattr(dataset, 'indices'):  # Subset
+        return _per_sample(dataset.dataset, method)[np.asarray(dataset.indices)]
+    raise TypeError('%s has no %s()' % (type(dataset).__name__, method))
+
+
+def box_counts(dataset):
+    """Number of boxes of the image of every sample of ``dataset``, from its
+    ``box_counts()``."""
+    return _per_sample(dataset, 'box_counts')
+
+
+def sample_images(dataset):
+    """Image of every sample of ``dataset``, from its ``sample_images()``.
+
+    Images of the parts of a ConcatDataset are not told apart, which only
+    costs the reuse of an image across the parts.
+    """
+    return _per_sample(dataset, 'sample_images')
+
+
+class BucketBatchSampler(Sampler):
+    """batch_sampler yielding batches of indices with similar box counts.
+
+    :param sampler: Sampler of the dataset indices; its ``set_epoch`` is
+        called by :meth:`set_epoch`, e.g. for a DistributedSampler.
+    :param lengths: Box count of every dataset index, see :func:`box_counts`.
+    :param pool_batches: Number of batches sorted together; 1 only sorts
+        within a batch, larger pools give more uniform batches but less
+        random ones.
+    """
+
+    def __init__(self, sampler, lengths, batch_size, drop_last=False, pool_batches=50, seed=0):
+        self.sampler = sampler
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.pool_size = batch_size * pool_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        # without set_epoch the order of the batches still changes every epoch
+        self.epoch += 1
+
+        indices = np.fromiter(iter(self.sampler), dtype=np.int64)
+        batches = []
+        for start in range(0, len(indices), self.pool_size):
+            pool = indices[start:start + self.pool_size]
+            # stable, so equal box counts keep the random order of the sampler
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches.extend(pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            # pools hold whole batches, only the last one can be short
+            batches.pop()
+        for i in torch.randperm(len(batches), generator=generator).tolist():
+            yield batches[i].tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+
+class ImageGroupBatchSampler(Sampler):
+    """batch_sampler packing the questions of an image together.
+
+    The images are visited in the order of their first question. Batches
+    hold up to ``batch_size`` questions and are filled with whole images;
+    only an image with more questions than fit in an empty batch is split.
+    Meant for evaluation, where the order of the questions does not matter.
+
+    :param images: Image of every dataset index, see :func:`sample_images`.
+    :param num_replicas: Number of ranks of a distributed evaluation, rank
+        ``rank`` keeps every ``num_replicas``-th batch.
+    """
+
+    def __init__(self, images, batch_size, num_replicas=1, rank=0):
+        images = np.asarray(images)
+        _, first, inverse = np.unique(images, return_index=True, return_inverse=True)
+        # indices of the same image next to each other, images by first question
+        order = np.lexsort((np.arange(len(images)), first[inverse]))
+        self.batches = []
+        batch = []
+        for group in np.split(order, np.flatnonzero(np.diff(inverse[order])) + 1) if len(order) else []:
+            if batch and len(batch) + len(group) > batch_size:
+                self.batches.append(batch)
+                batch = []
+            for index in group.tolist():
+                if len(batch) == batch_size:
+                    self.batches.append(batch)
+                    batch = []
+                batch.append(index)
+        if batch:
+            self.batches.append(batch)
+        self.batches = self.batches[rank::num_replicas]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class DistributedEvalSampler(DistributedSampler):
+    """DistributedSampler for evaluation: rank ``r`` takes the indices
+    ``r, r + num_replicas, ...`` in order, without padding, so the ranks
+    together see every sample exactly once.
+
+    The ranks may get one batch more or less, which is fine without a
+    gradient all-reduce.
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        super(DistributedEvalSampler, self).__init__(dataset, num_replicas, rank, shuffle=False)
+        self.total_size = len(self.dataset)
+        self.num_samples = len(range(self.rank, self.total_size, self.num_replicas))
+
+    def __iter__(self):
+        return iter(range(self.rank, self.total_size, self.num_replicas))
+
+    @staticmethod
+    def merge(parts):
+        """Put the per sample results of every rank (a list of sequences in
+        rank order, e.g. from ``all_gather_objects``) back into dataset order."""
+        merged = [None] * sum(len(part) for part in parts)
+        for rank, part in enumerate(parts):
+            merged[rank::len(parts)] = list(part)
+        return merged
@@ -0,0 +1,280 @@
+# coding=utf-8
+"""Share the features of a dataset between its DataLoader workers.
+
+Datasets that keep per image dicts of numpy arrays get slowly copied into
+every worker: touching a dict or an array updates its reference count, which
+dirties the copy-on-write page it lives on. Here the features of all splits
+are packed once into a few ``multiprocessing.shared_memory`` blocks, and the
+datasets only keep the integer index of an image (``img_id2idx``) into them.
+
+Memory-mapped stores and HDF5 files are already shared through the page
+cache, so they are chained as they are instead of being copied.
+SharedMemoryFeatureWriter decodes a tsv file straight into shared memory.
+"""
+
+import tempfile
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from pvqa_features.backends import InMemoryFeatures
+from pvqa_features.base import FeatureBackend
+
+
+def _create_block(shape, dtype):
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    # a block can not be empty
+    block = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def _release(blocks, owner):
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError:
+            # a tensor still views the block, the mapping goes with the process
+            pass
+        if owner:
+            block.unlink()
+
+
+class SharedMemoryFeatures(FeatureBackend):
+    """Features, boxes and extras in shared memory blocks.
+
+    Pickling only sends the names of the blocks, so workers started with
+    ``spawn`` attach to the same memory; forked workers simply inherit the
+    mapping. The blocks are unlinked once the creating object is collected.
+    """
+
+    name = 'shm'
+
+    def __init__(self, img_ids, img_w, img_h, offsets, blocks, owner=False):
+        """
+        :param blocks: Dict of array name ('features', 'boxes' or an extra)
+            to (block name, shape, dtype).
+        :param owner: Unlink the blocks when this object is collected.
+        """
+        self._specs = blocks
+        self._blocks = []
+        arrays = {}
+        for key, (block_name, shape, dtype) in blocks.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            self._blocks.append(block)
+            arrays[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        features = arrays.pop('features')
+        boxes = arrays.pop('boxes')
+        super(SharedMemoryFeatures, self).__init__(img_ids, img_w, img_h, offsets, features, boxes, arrays)
+        self._finalizer = weakref.finalize(self, _release, self._blocks, owner)
+
+    @classmethod
+    def from_backends(cls, backends):
+        """Copy the images of one or more backends into new shared blocks."""
+        img_ids, img_w, img_h, num_boxes = [], [], [], []
+        for backend in backends:
+            img_ids.extend(backend.img_ids)
+            img_w.append(backend.img_w)
+            img_h.append(backend.img_h)
+            num_boxes.append(backend.num_boxes)
+        offsets = np.zeros(len(img_ids) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate(num_boxes), out=offsets[1:])
+        total_boxes = int(offsets[-1])
+
+        first = backends[0]
+        sources = {'features': [backend.features for backend in backends],
+                   'boxes': [backend.boxes for backend in backends]}
+        for key in first.extras:
+            if all(key in backend.extras for backend in backends):
+                sources[key] = [backend.extras[key] for backend in backends]
+
+        created, specs = [], {}
+        try:
+            for key, parts in sources.items():
+                block, array = _create_block((total_boxes,) + parts[0].shape[1:], parts[0].dtype)
+                created.append(block)
+                start = 0
+                for part in parts:
+                    array[start:start + len(part)] = part
+                    start += len(part)
+                specs[key] = (block.name, array.shape, array.dtype.str)
+                del array
+            shared = cls(img_ids, np.concatenate(img_w), np.concatenate(img_h), offsets, specs, owner=True)
+        except BaseException:
+            _release(created, True)
+            raise
+        # the object attached to its own handles, drop the creating ones
+        _release(created, False)
+        return shared
+
+    def close(self):
+        self._finalizer()
+
+    def __getstate__(self):
+        return {'img_ids': self.img_ids, 'img_w': self.img_w, 'img_h': self.img_h,
+                'offsets': self.offsets, 'blocks': self._specs}
+
+    def __setstate__(self, state):
+        self.__init__(state['img_ids'], state['img_w'], state['img_h'], state['offsets'], state['blocks'])
+
+
+class SharedMemoryFeatureWriter(object):
+    """Append images to a SharedMemoryFeatures, one image dict at a time.
+
+    Same ``add_datum`` interface as FeatureStoreWriter, e.g. as the ``sink``
+    of the ``load_tsv`` functions. The arrays of every image are appended to
+    anonymous temporary files (in ``TMPDIR``) and only read into the shared
+    blocks by :meth:`close`, so the decoded images are never held in RAM as a
+    list or twice. ``features`` is the SharedMemoryFeatures once closed.
+
+    Per box arrays other than ``boxes`` and ``features`` (object and attribute
+    labels of the LXMERT files) are kept as extras; every image must have the
+    arrays of the first one.
+    """
+
+    def __init__(self):
+        self.img_ids = []
+        self.img_w = []
+        self.img_h = []
+        self.num_boxes = []
+        # array name -> (temporary file, shape of a row, dtype)
+        self._files = {}
+        self.features = None
+
+    def add_datum(self, datum):
+        arrays = {key: np.ascontiguousarray(value) for key, value in datum.items()
+                  if isinstance(value, np.ndarray)}
+        num_boxes = len(arrays['boxes'])
+        if not self._files:
+            self._files = {key: (tempfile.TemporaryFile(), value.shape[1:], value.dtype)
+                           for key, value in arrays.items()}
+        assert arrays.keys() == self._files.keys(), \
+            'image %s has the arrays %s, not %s' % (datum['img_id'], sorted(arrays), sorted(self._files))
+        for key, value in arrays.items():
+            f, shape, dtype = self._files[key]
+            assert len(value) == num_boxes and value.shape[1:] == shape and value.dtype == dtype, \
+                '%s of image %s does not match the first image' % (key, datum['img_id'])
+            f.write(value.tobytes())
+        self.img_ids.append(datum['img_id'])
+        self.img_w.append(datum['img_w'])
+        self.img_h.append(datum['img_h'])
+        self.num_boxes.append(num_boxes)
+
+    def close(self):
+        offsets = np.zeros(len(self.num_boxes) + 1, dtype=np.int64)
+        np.cumsum(self.num_boxes, out=offsets[1:])
+        total_boxes = int(offsets[-1])
+        files = dict(self._files)
+        files.setdefault('features', (None, (0,), np.dtype(np.float32)))
+        files.setdefault('boxes', (None, (4,), np.dtype(np.float32)))
+
+        created, specs = [], {}
+        try:
+            for key, (f, shape, dtype) in files.items():
+                block, array = _create_block((total_boxes,) + shape, dtype)
+                created.append(block)
+                if f is not None:
+                    f.seek(0)
+                    _read_into(f, memoryview(block.buf)[:array.nbytes])
+                specs[key] = (block.name, array.shape, array.dtype.str)
+                del array
+            self.features = SharedMemoryFeatures(self.img_ids, np.asarray(self.img_w), np.asarray(self.img_h),
+                                                 offsets, specs, owner=True)
+        except BaseException:
+            _release(created, True)
+            raise
+        finally:
+            self._close_files()
+        # the object attached to its own handles, drop the creating ones
+        _release(created, False)
+        return self.features
+
+    def _close_files(self):
+        for f, _, _ in self._files.values():
+            f.close()
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._close_files()
+
+
+def _read_into(f, buf):
+    """Fill the memoryview ``buf`` from the file ``f``."""
+    while len(buf):
+        count = f.readinto(buf)
+        if not count:
+            raise EOFError('the temporary feature file ended early')
+        buf = buf[count:]
+
+
+class ChainedFeatures(FeatureBackend):
+    """Several backends addressed as one, image ``idx`` runs over all of them."""
+
+    name = 'chain'
+
+    def __init__(self, backends):
+        self.backends = list(backends)
+        self.starts = np.cumsum([0] + [len(backend) for backend in self.backends])
+        img_ids = [img_id for backend in self.backends for img_id in backend.img_ids]
+        offsets = np.zeros(len(img_ids) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate([backend.num_boxes for backend in self.backends]), out=offsets[1:])
+        super(ChainedFeatures, self).__init__(img_ids,
+                                              np.concatenate([backend.img_w for backend in self.backends]),
+                                              np.concatenate([backend.img_h for backend in self.backends]),
+                                              offsets, None, None)
+
+    def _locate(self, idx):
+        part = int(np.searchsorted(self.starts, idx, side='right')) - 1
+        return self.backends[part], idx - int(self.starts[part])
+
+    @property
+    def feat_dim(self):
+        return self.backends[0].feat_dim
+
+    def get_features(self, idx):
+        backend, idx = self._locate(idx)
+        return backend.get_features(idx)
+
+    def get_boxes(self, idx):
+        backend, idx = self._locate(idx)
+        return backend.get_boxes(idx)
+
+    def get_extra(self, key, idx):
+        backend, idx = self._locate(idx)
+        return backend.get_extra(key, idx)
+
+    def get_extras(self, idx):
+        backend, idx = self._locate(idx)
+        return backend.get_extras(idx)
+
+    def all_boxes(self):
+        return np.concatenate([backend.all_boxes() for backend in self.backends])
+
+    def datum(self, idx):
+        backend, idx = self._locate(idx)
+        return backend.datum(idx)
+
+
+def share_features(backends):
+    """Merge the feature backends of a dataset into one its workers share.
+
+    In-memory backends (ram) are packed into shared memory; tsv features are
+    decoded into shared memory by open_features already and, like the file
+    backed ones (memmap, hdf5), are kept and chained.
+
+    :param backends: A FeatureBackend or a list of them, e.g. one per split.
+    :return: A single FeatureBackend indexing the images of all of them.
+    """
+    if isinstance(backends, FeatureBackend):
+        backends = [backends]
+    in_memory = [backend for backend in backends if isinstance(backend, InMemoryFeatures)]
+    parts = [backend for backend in backends if not isinstance(backend, InMemoryFeatures)]
+    if in_memory:
+        parts.append(SharedMemoryFeatures.from_backends(in_memory))
+    return parts[0] if len(parts) == 1 else ChainedFeatures(parts)
@@ -0,0 +1,149 @@
+# coding=utf-8
+"""Binary, memory-mapped store for PathVQA region features.
+
+A store is three files sharing one prefix (usually the tsv path without its
+extension, e.g. ``data/pvqa/images/train``):
+
+    <prefix>.features.bin   float32 [total_boxes, feat_dim], row major
+    <prefix>.boxes.bin      float32 [total_boxes, 4], row major
+    <prefix>.index.npz      per image arrays (image_id, img_w, img_h,
+                            num_boxes, offsets) plus the store meta data
+
+Image ``i`` owns the rows ``offsets[i]:offsets[i + 1]`` of both bin files, so
+the reader only has to ``np.memmap`` them and slice; nothing is decoded or
+copied until a row is actually touched.
+"""
+
+import os
+
+import numpy as np
+
+from pvqa_features.base import FeatureBackend
+
+STORE_VERSION = 1
+FEATURES_SUFFIX = '.features.bin'
+BOXES_SUFFIX = '.boxes.bin'
+INDEX_SUFFIX = '.index.npz'
+
+
+def store_prefix(tsv_file):
+    """Return the store prefix that belongs to a feature tsv/csv file."""
+    return os.path.splitext(tsv_file)[0]
+
+
+def store_exists(prefix):
+    return all(os.path.isfile(prefix + suffix)
+               for suffix in (FEATURES_SUFFIX, BOXES_SUFFIX, INDEX_SUFFIX))
+
+
+class FeatureStoreWriter(object):
+    """Append images to a feature store, one image at a time.
+
+    The bin files are written as plain appends, the index is only written by
+    :meth:`close`, so a half written store is never picked up by a reader.
+    """
+
+    def __init__(self, prefix, split=''):
+        self.prefix = prefix
+        self.split = split
+        self.feat_dim = None
+        self.image_ids = []
+        self.img_w = []
+        self.img_h = []
+        self.num_boxes = []
+        self._features_file = open(prefix + FEATURES_SUFFIX + '.tmp', 'wb')
+        self._boxes_file = open(prefix + BOXES_SUFFIX + '.tmp', 'wb')
+
+    def add(self, image_id, img_w, img_h, boxes, features):
+        """
+        :param image_id: Integer image id as found in the tsv.
+        :param boxes: (num_boxes, 4) array in image coordinates.
+        :param features: (num_boxes, feat_dim) array.
+        """
+        boxes = np.ascontiguousarray(boxes, dtype=np.float32).reshape(-1, 4)
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        features = features.reshape(boxes.shape[0], -1)
+        if self.feat_dim is None:
+            self.feat_dim = features.shape[1]
+        assert features.shape[1] == self.feat_dim, \
+            'feature dim %d of image %s does not match %d' % (features.shape[1], image_id, self.feat_dim)
+
+        self._features_file.write(features.tobytes())
+        self._boxes_file.write(boxes.tobytes())
+        self.image_ids.append(int(image_id))
+        self.img_w.append(img_w)
+        self.img_h.append(img_h)
+        self.num_boxes.append(boxes.shape[0])
+
+    def add_datum(self, datum):
+        """Add a dict as returned by the ``load_tsv`` functions."""
+        image_id = int(datum['img_id'].rsplit('_', 1)[-1])
+        self.add(image_id, datum['img_w'], datum['img_h'], datum['boxes'], datum['features'])
+
+    def close(self):
+        self._features_file.close()
+        self._boxes_file.close()
+        num_boxes = np.asarray(self.num_boxes, dtype=np.int64)
+        offsets = np.zeros(len(num_boxes) + 1, dtype=np.int64)
+        np.cumsum(num_boxes, out=offsets[1:])
+        os.replace(self.prefix + FEATURES_SUFFIX + '.tmp', self.prefix + FEATURES_SUFFIX)
+        os.replace(self.prefix + BOXES_SUFFIX + '.tmp', self.prefix + BOXES_SUFFIX)
+        # np.savez appends '.npz' to names without it, so write through a file object
+        with open(self.prefix + INDEX_SUFFIX, 'wb') as f:
+            np.savez(f,
+                     version=np.int64(STORE_VERSION),
+                     split=np.str_(self.split),
+                     feat_dim=np.int64(self.feat_dim or 0),
+                     image_id=np.asarray(self.image_ids, dtype=np.int64),
+                     img_w=np.asarray(self.img_w, dtype=np.float32),
+                     img_h=np.asarray(self.img_h, dtype=np.float32),
+                     num_boxes=num_boxes,
+                     offsets=offsets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._features_file.close()
+            self._boxes_file.close()
+
+
+class FeatureStore(FeatureBackend):
+    """Read-only view over a feature store.
+
+    Opening a store only reads the (small) index; ``features`` and ``boxes``
+    are ``np.memmap`` objects and are paged in by the OS on access. They are
+    mapped copy-on-write so ``torch.from_numpy`` accepts them without a copy,
+    while the files on disk are never modified.
+    """
+
+    name = 'memmap'
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with np.load(prefix + INDEX_SUFFIX) as index:
+            version = int(index['version'])
+            assert version == STORE_VERSION, \
+                '%s was written with store version %d, expected %d' % (prefix, version, STORE_VERSION)
+            self.split = str(index['split'])
+            feat_dim = int(index['feat_dim'])
+            img_ids = ['%s_%04d' % (self.split, image_id) for image_id in index['image_id']]
+            img_w = index['img_w']
+            img_h = index['img_h']
+            offsets = index['offsets']
+        total_boxes = int(offsets[-1])
+        features = np.memmap(prefix + FEATURES_SUFFIX, dtype=np.float32, mode='c',
+                             shape=(total_boxes, feat_dim))
+        boxes = np.memmap(prefix + BOXES_SUFFIX, dtype=np.float32, mode='c',
+                          shape=(total_boxes, 4))
+        super(FeatureStore, self).__init__(img_ids, img_w, img_h, offsets, features, boxes)
+
+    def __getstate__(self):
+        # reopen the memmaps instead of pickling their contents into workers
+        return {'prefix': self.prefix}
+
+    def __setstate__(self, state):
+        self.__init__(state['prefix'])
@@ -0,0 +1,93 @@
+# coding=utf-8
+"""Sparse soft answer targets.
+
+A question has one or two answer labels out of thousands of candidates, so
+the datasets return the ``(labels, scores)`` of a sample as a SparseTarget
+instead of a dense ``[num_answers]`` vector. :func:`sparse_collate` joins them
+into a SparseTargets batch, which leaves the DataLoader worker as three short
+tensors, and only ``.to(device)`` / ``.cuda()`` expand it into the dense
+``[batch_size, num_answers]`` target, with one scatter on that device. The
+training loops can keep moving the target like a tensor.
+
+Unlike the rest of the package this module needs torch, so it is not
+imported by ``pvqa_features`` itself.
+"""
+
+import collections
+
+import torch
+from torch.utils.data.dataloader import default_collate
+
+
+class SparseTarget(collections.namedtuple('SparseTarget', 'labels scores num_answers')):
+    """Soft target of one sample: int64 answer labels and their float scores."""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_arrays(cls, labels, scores, num_answers):
+        return cls(torch.as_tensor(labels, dtype=torch.int64),
+                   torch.as_tensor(scores, dtype=torch.float32), num_answers)
+
+    def dense(self):
+        """The [num_answers] float target."""
+        target = torch.zeros(self.num_answers)
+        target[self.labels] = self.scores
+        return target
+
+
+class SparseTargets(collections.namedtuple('SparseTargets', 'rows labels scores batch_size num_answers')):
+    """Soft targets of a batch, ``scores[k]`` belongs to sample ``rows[k]``.
+
+    It is pinned by ``pin_memory=True`` like any other batch field.
+    """
+
+    __slots__ = ()
+
+    def dense(self, device=None, non_blocking=False):
+        """The [batch_size, num_answers] float target, built on ``device``."""
+        target = torch.zeros(self.batch_size, self.num_answers, device=device)
+        target[self.rows.to(device, non_blocking=non_blocking),
+               self.labels.to(device, non_blocking=non_blocking)] = \
+            self.scores.to(device, non_blocking=non_blocking)
+        return target
+
+    def to(self, device=None, non_blocking=False):
+        return self.dense(device, non_blocking)
+
+    def cuda(self, device=None, non_blocking=False):
+        if device is None:
+            device = torch.device('cuda')
+        elif isinstance(device, int):
+            device = torch.device('cuda', device)
+        return self.dense(device, non_blocking)
+
+    def cpu(self):
+        return self.dense()
+
+    def pin_memory(self):
+        return self._replace(rows=self.rows.pin_memory(), labels=self.labels.pin_memory(),
+                             scores=self.scores.pin_memory())
+
+
+def batch_targets(targets):
+    """Join the SparseTarget of every sample of a batch into SparseTargets."""
+    lengths = torch.tensor([len(target.labels) for target in targets], dtype=torch.int64)
+    rows = torch.repeat_interleave(torch.arange(len(targets)), lengths)
+    return SparseTargets(rows,
+                         torch.cat([target.labels for target in targets]),
+                         torch.cat([target.scores for target in targets]),
+                         len(targets), targets[0].num_answers)
+
+
+def sparse_collate(batch, collate=default_collate):
+    """``collate`` (default_collate, trim_collate, ...) for samples holding
+    SparseTarget fields, which are batched with :func:`batch_targets`.
+    """
+    elem = batch[0]
+    if isinstance(elem, SparseTarget):
+        return batch_targets(batch)
+    if isinstance(elem, (tuple, list)) and not hasattr(elem, '_fields') \
+            and any(isinstance(field, (SparseTarget, tuple, list)) for field in elem):
+        return [sparse_collate(samples, collate) for samples in zip(*batch)]
+    return collate(batch)
@@ -0,0 +1,48 @@
+"""PaddedCollate keeps the image fields once per image, told apart by the image
+of the samples and not by their features (run from the repository root with
+``python -m pytest pvqa_features/tests``)."""
+
+import os
+import pickle
+import sys
+import unittest
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from pvqa_features.collate import ImageSample, PaddedCollate
+
+
+def sample(image, store, num_boxes, question):
+    # features and boxes only depend on the number of boxes, so distinct images can be equal
+    return ImageSample((torch.zeros(num_boxes, 4), torch.ones(num_boxes, 2), question), image, store)
+
+
+class ImageFieldsTest(unittest.TestCase):
+
+    def test_v_index(self):
+        store, other_store = object(), object()
+        batch = [sample(3, store, 2, 0), sample(3, store, 2, 1), sample(5, store, 2, 2),
+                 sample(5, other_store, 2, 3), sample(5, other_store, 2, 4), sample(3, store, 1, 5)]
+        v, b, q = collated = PaddedCollate(image_fields=(0, 1))(batch)
+        self.assertEqual(collated.v_index.tolist(), [0, 0, 1, 2, 2, 3])
+        self.assertEqual(v.shape, (4, 2, 4))
+        self.assertEqual(b.shape, (4, 2, 2))
+        self.assertEqual(b[3].tolist(), [[1, 1], [0, 0]])
+        self.assertEqual(q.tolist(), list(range(6)))
+
+    def test_plain_tuples(self):
+        batch = [tuple(sample(0, None, 2, k)) for k in range(2)]
+        self.assertIsNone(PaddedCollate()(batch).v_index)
+        with self.assertRaises(TypeError):
+            PaddedCollate(image_fields=(0, 1))(batch)
+
+    def test_pickle(self):
+        store = 'store'
+        loaded = pickle.loads(pickle.dumps(sample(7, store, 2, 1)))
+        self.assertEqual((loaded.image, loaded.store), (7, store))
+        self.assertEqual(len(loaded), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+"""Serial and multi-process decoding of a feature tsv file give the same images
+(run from the repository root with ``python -m pytest pvqa_features/tests``)."""
+
+import base64
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from pvqa_features.benchmark_decode import write_synthetic_tsv
+from pvqa_features.tsv import iter_tsv, load_tsv
+
+
+def write_float_sizes(path, first_image_id, seed=1):
+    """Append images whose sizes are written as floats, integral or not."""
+    rng = np.random.RandomState(seed)
+    with open(path, 'a') as f:
+        for k, (img_w, img_h) in enumerate([('640.0', '480.0'), ('333.5', '500.25'), ('1e3', '7.0')]):
+            boxes = rng.uniform(0, 300, size=(3, 4))
+            features = rng.rand(3, 16).astype(np.float32)
+            row = [first_image_id + k, img_w, img_h, 3,
+                   str(base64.b64encode(boxes.tobytes())),
+                   str(base64.b64encode(features.tobytes()))]
+            f.write('\t'.join(map(str, row)) + '\n')
+
+
+class DecodeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.tsv_file = os.path.join(cls.tmpdir, 'train.csv')
+        write_synthetic_tsv(cls.tsv_file, 40, num_boxes=3, feat_dim=16)
+        write_float_sizes(cls.tsv_file, 40)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def assert_same_images(self, expected, result):
+        self.assertEqual(len(result), len(expected))
+        for a, b in zip(expected, result):
+            self.assertEqual(sorted(a), sorted(b))
+            for key in ('img_id', 'img_w', 'img_h', 'num_boxes'):
+                self.assertEqual(a[key], b[key], key)
+                self.assertIs(type(a[key]), type(b[key]), key)
+            for key in ('boxes', 'features'):
+                self.assertEqual(a[key].dtype, b[key].dtype)
+                np.testing.assert_array_equal(a[key], b[key])
+
+    def test_serial_and_parallel(self):
+        expected = list(iter_tsv(self.tsv_file, 'train'))
+        self.assertEqual(len(expected), 43)
+        self.assertEqual([datum['img_w'] for datum in expected[-3:]], [640, 333.5, 1000])
+        self.assertIs(type(expected[0]['img_w']), int)
+        for num_workers in (1, 3):
+            with self.subTest(num_workers=num_workers):
+                self.assert_same_images(expected, list(iter_tsv(self.tsv_file, 'train', num_workers=num_workers)))
+
+    def test_load_tsv(self):
+        expected = load_tsv(self.tsv_file, 'train')
+        self.assert_same_images(expected, load_tsv(self.tsv_file, 'train', num_workers=2))
+        received = []
+        self.assertEqual(load_tsv(self.tsv_file, 'train', num_workers=2, sink=received.append), [])
+        self.assert_same_images(expected, received)
+
+
+if __name__ == '__main__':
+    unittest.main()
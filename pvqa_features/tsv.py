@@ -0,0 +1,101 @@
+# coding=utf-8
+"""Decoding of the PathVQA Faster-RCNN feature tsv files."""
+
+import base64
+import functools
+import os
+import time
+
+import numpy as np
+
+from pvqa_features.parallel import MAX_PENDING_BYTES, iter_parallel, read_lines
+
+FIELDNAMES = ['image_id', 'image_w', 'image_h', 'num_boxes', 'boxes', 'features']
+
+
+def split_of(tsv_file):
+    """Guess the split ('train', 'val' or 'test') from a feature file name."""
+    name = os.path.basename(tsv_file).split('.')[0]
+    for split in ('train', 'test', 'val'):
+        if name.startswith(split):
+            return split
+    return name
+
+
+def _number(value):
+    """A tsv number (text or parsed by pandas) as an int when it is integral,
+    else as a float."""
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def decode_row(split, image_id, img_w, img_h, num_boxes, boxes, features):
+    """Decode one tsv row into the dict used by the datasets.
+
+    Boxes are stored as float64 and features as float32, both base64 encoded
+    behind a one character prefix. The numbers may be given as text or as
+    parsed by pandas, both give the same dict.
+    """
+    image_id, img_w, img_h, num_boxes = map(_number, (image_id, img_w, img_h, num_boxes))
+    datum = {}
+    datum['img_id'] = '%s_%04d' % (split, image_id)
+    datum['img_w'] = img_w
+    datum['img_h'] = img_h
+    datum['num_boxes'] = num_boxes
+
+    buf = base64.b64decode(boxes[1:])
+    temp = np.frombuffer(buf, dtype=np.float64).astype(np.float32)
+    datum['boxes'] = temp.reshape(num_boxes, -1)
+
+    buf = base64.b64decode(features[1:])
+    temp = np.frombuffer(buf, dtype=np.float32)
+    datum['features'] = temp.reshape(num_boxes, -1)
+    return datum
+
+
+def decode_line(line, split):
+    """Decode one raw tsv line, see decode_row."""
+    image_id, img_w, img_h, num_boxes, boxes, features = line.split('\t')
+    return decode_row(split, image_id, img_w, img_h, num_boxes, boxes, features)
+
+
+def iter_tsv(tsv_file, split=None, num_workers=0, max_pending_bytes=MAX_PENDING_BYTES):
+    """Yield the decoded images of ``tsv_file`` in file order.
+
+    The file is read and decoded line by line, so only the base64 text of one
+    image is held in memory. With ``num_workers`` > 0 the decoding is spread
+    over that many processes instead, which decode at most
+    ``max_pending_bytes`` of the file ahead of the consumer (see
+    iter_parallel).
+    """
+    if split is None:
+        split = split_of(tsv_file)
+    if num_workers > 0:
+        yield from iter_parallel(tsv_file, functools.partial(decode_line, split=split), num_workers,
+                                 max_pending_bytes)
+        return
+    for line in read_lines(tsv_file):
+        yield decode_line(line, split)
+
+
+def load_tsv(tsv_file, split=None, num_workers=0, sink=None):
+    """Decode every image of ``tsv_file``.
+
+    :param sink: Optional callable receiving every decoded image dict (e.g.
+        ``FeatureStoreWriter.add_datum``). Images handed to the sink are not
+        kept, so the memory use does not grow with the file.
+    :return: The list of image dicts, empty if a sink is given.
+    """
+    start_time = time.time()
+    print("Start to load Faster-RCNN detected objects from %s" % tsv_file)
+    data = []
+    count = 0
+    for datum in iter_tsv(tsv_file, split, num_workers=num_workers):
+        count += 1
+        if sink is not None:
+            sink(datum)
+        else:
+            data.append(datum)
+    elapsed_time = time.time() - start_time
+    print("Loaded %d images in file %s in %d seconds." % (count, tsv_file, elapsed_time))
+    return data